@@ -50,17 +50,19 @@ class ChromeApi(root_api.Service):
 
     is_enrolled = False
     start_assignment = False
+    loan_changed = False
     if device:
       if device.enrolled:
         is_enrolled = True
         if device.assigned_user == user_email:
           if device.onboarded:
-            device.loan_resumes_if_late(user_email)
+            loan_changed = device.loan_resumes_if_late(user_email)
           else:
             start_assignment = True
         else:
           device.loan_assign(user_email)
           start_assignment = True
+          loan_changed = True
 
     else:
       try:
@@ -68,8 +70,14 @@ class ChromeApi(root_api.Service):
             request.device_id, user_email)
       except device_model.DeviceCreationError as e:
         raise endpoints.NotFoundException(str(e))
+      loan_changed = True
 
-    device.record_heartbeat()
+    # Routine check-ins are buffered and written in batches by the
+    # flush_heartbeats cron; only a change in loan state warrants a put here.
+    if loan_changed:
+      device.record_heartbeat()
+    else:
+      device.buffer_heartbeat()
     silent_onboarding = config_model.Config.get('silent_onboarding')
     return chrome_messages.HeartbeatResponse(
         is_enrolled=is_enrolled,
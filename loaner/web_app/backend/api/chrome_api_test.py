@@ -57,7 +57,7 @@ class ChromeEndpointsTest(loanertest.EndpointsTestCase):
   def create_device(self, enrolled=True, assigned_user=None, asset_tag=None,
                     onboarded=None):
     loan_resumes_if_late_patcher = mock.patch.object(
-        device_model.Device, 'loan_resumes_if_late')
+        device_model.Device, 'loan_resumes_if_late', return_value=False)
     loan_resumes_if_late_patcher.start()
     self.device = device_model.Device(
         asset_tag=asset_tag,
@@ -119,6 +119,29 @@ class ChromeEndpointsTest(loanertest.EndpointsTestCase):
     self.mock_loan_resumes_if_late.assert_called_once_with(
         loanertest.USER_EMAIL)
 
+  @mock.patch.object(device_model.Device, 'record_heartbeat')
+  @mock.patch.object(device_model.Device, 'buffer_heartbeat')
+  def test_heartbeat_buffered_when_loan_unchanged(
+      self, mock_buffer_heartbeat, mock_record_heartbeat):
+    """Tests that a routine check-in is buffered rather than written."""
+    self.create_device(assigned_user=loanertest.USER_EMAIL, onboarded=True)
+
+    self.service.heartbeat(self.chrome_request)
+    mock_buffer_heartbeat.assert_called_once_with()
+    self.assertFalse(mock_record_heartbeat.called)
+
+  @mock.patch.object(device_model.Device, 'record_heartbeat')
+  @mock.patch.object(device_model.Device, 'buffer_heartbeat')
+  def test_heartbeat_written_when_loan_resumed(
+      self, mock_buffer_heartbeat, mock_record_heartbeat):
+    """Tests that a resumed loan writes the heartbeat immediately."""
+    self.create_device(assigned_user=loanertest.USER_EMAIL, onboarded=True)
+    self.mock_loan_resumes_if_late.return_value = True
+
+    self.service.heartbeat(self.chrome_request)
+    mock_record_heartbeat.assert_called_once_with()
+    self.assertFalse(mock_buffer_heartbeat.called)
+
   def test_heartbeat_unenrolled_device_with_entity(self):
     """Tests heartbeat processing for an unenrolled device with an entity."""
     self.create_device(enrolled=False)
@@ -26,7 +26,6 @@ from loaner.web_app.backend.api import auth
 from loaner.web_app.backend.api import permissions
 from loaner.web_app.backend.api import root_api
 from loaner.web_app.backend.api.messages import config_messages
-from loaner.web_app.backend.lib import utils
 from loaner.web_app.backend.models import config_model
 
 _FIELD_MISSING_MSG = 'Please double-check you provided all necessary fields.'
@@ -80,9 +79,7 @@ class ConfigAPI(root_api.Service):
     """Gets a list of all config values."""
     self.check_xsrf_token(self.request_state)
     response_message = []
-    config_defaults = utils.load_config_from_yaml()
-    for setting in config_defaults:
-      setting_value = config_model.Config.get(setting)
+    for setting, setting_value in config_model.Config.get_all().items():
       if isinstance(setting_value, basestring):
         response_message.append(config_messages.ConfigResponse(
             name=setting, string_value=setting_value))
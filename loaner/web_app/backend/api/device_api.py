@@ -30,6 +30,7 @@ from loaner.web_app.backend.api.messages import device_messages
 from loaner.web_app.backend.clients import bigquery
 from loaner.web_app.backend.clients import directory
 from loaner.web_app.backend.lib import api_utils
+from loaner.web_app.backend.lib import given_names
 from loaner.web_app.backend.lib import search_utils
 from loaner.web_app.backend.lib import user as user_lib
 from loaner.web_app.backend.models import config_model
@@ -151,14 +152,9 @@ class DeviceApi(root_api.Service):
             'You do not have the proper permission to perform this action. '
             'Please contact your IT administrator if you feel like this is in '
             'error.')
-    directory_client = directory.DirectoryApiClient(user_email)
-    try:
-      given_name = directory_client.given_name(user_email)
-    except (directory.DirectoryRPCError, directory.GivenNameDoesNotExistError):
-      given_name = None
     message = api_utils.build_device_message_from_model(
         device, config_model.Config.get('allow_guest_mode'))
-    message.given_name = given_name
+    message.given_name = given_names.get(user_email)
     return message
 
   @auth.method(
@@ -37,6 +37,7 @@ from loaner.web_app.backend.api.messages import shelf_messages
 from loaner.web_app.backend.clients import bigquery
 from loaner.web_app.backend.clients import directory
 from loaner.web_app.backend.lib import api_utils
+from loaner.web_app.backend.lib import given_names
 from loaner.web_app.backend.lib import search_utils
 from loaner.web_app.backend.models import config_model
 from loaner.web_app.backend.models import device_model
@@ -248,10 +249,7 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
     with self.assertRaises(device_api.endpoints.BadRequestException):
       self.service.device_audit_check(request)
 
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device_not_found(self, mock_directory_class):
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.return_value = 'given name value'
+  def test_get_device_not_found(self):
     request = device_messages.DeviceRequest(identifier='not-found')
     with self.assertRaises(device_api.endpoints.NotFoundException):
       self.service.get_device(request)
@@ -263,10 +261,8 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
     with self.assertRaises(device_api.endpoints.BadRequestException):
       self.service.get_device(request)
 
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device(self, mock_directory_class):
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.return_value = 'given name value'
+  @mock.patch.object(given_names, 'get', return_value='given name value')
+  def test_get_device(self, mock_given_name):
     asset_tag_response = self.service.get_device(
         device_messages.DeviceRequest(asset_tag='12345'))
     chrome_device_id_response = self.service.get_device(
@@ -286,11 +282,10 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
     self.assertEqual(self.device.serial_number,
                      asset_tag_response.serial_number)
     self.assertEqual(self.device.device_model, urlkey_response.device_model)
+    self.assertEqual('given name value', identifier_response.given_name)
+    mock_given_name.assert_called_with(loanertest.SUPER_ADMIN_EMAIL)
 
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device_no_permission(self, mock_directory_class):
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.return_value = 'given name value'
+  def test_get_device_no_permission(self):
     email = 'random@{}'.format(loanertest.USER_DOMAIN)
     self.login_endpoints_user(email=email)
     with self.assertRaises(endpoints.UnauthorizedException):
@@ -298,19 +293,13 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
           device_messages.DeviceRequest(
               serial_number=self.device.serial_number))
 
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device_has_permission(self, mock_directory_class):
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.return_value = 'given name value'
+  def test_get_device_has_permission(self):
     device = self.service.get_device(
         device_messages.DeviceRequest(serial_number=self.device.serial_number))
     self.assertIsInstance(device, device_messages.Device)
     self.assertEqual(device.serial_number, self.device.serial_number)
 
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device_assigned_user(self, mock_directory_class):
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.return_value = 'given name value'
+  def test_get_device_assigned_user(self):
     email = 'random@{}'.format(loanertest.USER_DOMAIN)
     self.login_endpoints_user(email=email)
     self.device.assigned_user = email
@@ -320,13 +309,9 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
     self.assertIsInstance(device, device_messages.Device)
     self.assertEqual(device.serial_number, self.device.serial_number)
 
-  @parameterized.parameters(directory.DirectoryRPCError,
-                            directory.GivenNameDoesNotExistError)
-  @mock.patch.object(directory, 'DirectoryApiClient', autospec=True)
-  def test_get_device_directory_errors(self, test_error, mock_directory_class):
+  @mock.patch.object(given_names, 'get', return_value=None)
+  def test_get_device_no_given_name(self, mock_given_name):
     request = device_messages.DeviceRequest(asset_tag='12345')
-    mock_directory_client = mock_directory_class.return_value
-    mock_directory_client.given_name.side_effect = test_error
     self.assertIsNone(self.service.get_device(request).given_name)
 
   @parameterized.parameters((
@@ -390,6 +375,14 @@ class DeviceApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
         has_additional_results=False)
     self.assertEqual(response, expected_response)
 
+  def test_list_devices_returns_recent_heartbeat(self):
+    last_heartbeat = datetime.datetime(2017, 11, 1, 1, 0)
+    self.device.last_heartbeat = last_heartbeat
+    self.device.put()
+    request = device_messages.Device(serial_number='123ABC')
+    response = self.service.list_devices(request)
+    self.assertEqual(response.devices[0].last_heartbeat, last_heartbeat)
+
   @mock.patch('__main__.device_api.shelf_api.get_shelf')
   def test_list_devices_with_shelf_filter(self, mock_get_shelf):
     # Test for shelf location as filter.
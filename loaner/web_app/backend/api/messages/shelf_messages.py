@@ -164,3 +164,31 @@ class ShelfAuditRequest(messages.Message):
   """
   shelf_request = messages.MessageField(ShelfRequest, 1)
   device_identifiers = messages.StringField(2, repeated=True)
+
+
+class AuditStatus(messages.Enum):
+  """The outcome of a shelf audit for a single device."""
+  ALREADY_ON_SHELF = 1
+  CHECKED_IN = 2
+  REMOVED = 3
+
+
+class DeviceAuditResult(messages.Message):
+  """DeviceAuditResult ProtoRPC message.
+
+  Attributes:
+    identifier: str, the identifier of the device as scanned, or its
+        identifier for a device removed from the shelf.
+    status: AuditStatus, the outcome of the audit for the device.
+  """
+  identifier = messages.StringField(1)
+  status = messages.EnumField(AuditStatus, 2)
+
+
+class ShelfAuditResponse(messages.Message):
+  """ShelfAuditResponse ProtoRPC message.
+
+  Attributes:
+    results: List[DeviceAuditResult], the outcome of the audit per device.
+  """
+  results = messages.MessageField(DeviceAuditResult, 1, repeated=True)
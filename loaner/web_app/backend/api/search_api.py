@@ -57,9 +57,9 @@ class SearchApi(root_api.Service):
       http_method='GET',
       permission=permissions.Permissions.REINDEX_SEARCH)
   def reindex(self, request):
-    """Reindexes a search index for the given type."""
+    """Reindexes a search index for the given type in parallel shards."""
     if request.model == search_messages.SearchIndexEnum.DEVICE:
-      deferred.defer(device_model.Device.index_entities_for_search)
+      deferred.defer(device_model.Device.reindex_in_shards)
     elif request.model == search_messages.SearchIndexEnum.SHELF:
-      deferred.defer(shelf_model.Shelf.index_entities_for_search)
+      deferred.defer(shelf_model.Shelf.reindex_in_shards)
     return message_types.VoidMessage()
@@ -58,9 +58,9 @@ class SearchApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
       mock_deferred.assert_called_once_with(expected_call)
 
   @parameterized.parameters(
-      (device_model.Device.index_entities_for_search,
+      (device_model.Device.reindex_in_shards,
        search_messages.SearchIndexEnum.DEVICE),
-      (shelf_model.Shelf.index_entities_for_search,
+      (shelf_model.Shelf.reindex_in_shards,
        search_messages.SearchIndexEnum.SHELF),
   )
   def test_reindex(self, expected_call, test_enum):
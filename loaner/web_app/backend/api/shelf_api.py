@@ -161,7 +161,7 @@ class ShelfApi(root_api.Service):
 
   @auth.method(
       shelf_messages.ShelfAuditRequest,
-      message_types.VoidMessage,
+      shelf_messages.ShelfAuditResponse,
       name='audit',
       path='audit',
       http_method='POST',
@@ -171,31 +171,46 @@ class ShelfApi(root_api.Service):
     self.check_xsrf_token(self.request_state)
     shelf = get_shelf(request.shelf_request)
     user_email = user.get_user_email()
-    devices_on_shelf = []
-    shelf_string_query = 'shelf: {}'.format(shelf.key.urlsafe())
-    devices_retrieved_on_shelf = device_model.Device.search(shelf_string_query)
+    # Every identifier is resolved before anything is changed, so an unknown
+    # identifier fails the audit without leaving it half applied.
+    devices = device_model.Device.get_multi_by_identifiers(
+        request.device_identifiers)
     for device_identifier in request.device_identifiers:
-      device = device_model.Device.get(identifier=device_identifier)
-      if not device:
+      if not devices[device_identifier]:
         raise endpoints.NotFoundException(
             _DEVICE_DOES_NOT_EXIST_MSG % device_identifier)
-      if device.shelf:
-        if device.shelf == shelf.key:
-          devices_on_shelf.append(device.key.urlsafe())
-          logging.info('Device %s is already on shelf.', device.identifier)
-          continue
-      try:
-        device.move_to_shelf(shelf=shelf, user_email=user_email)
-        devices_on_shelf.append(device.key)
-      except device_model.UnableToMoveToShelfError as err:
-        raise endpoints.BadRequestException(str(err))
-    for device in devices_retrieved_on_shelf.results:
-      if device.doc_id not in devices_on_shelf:
-        api_utils.get_ndb_key(device.doc_id).get().remove_from_shelf(
-            shelf=shelf, user_email=user_email)
-    shelf.audit(user_email=user_email, num_of_devices=len(devices_on_shelf))
-
-    return message_types.VoidMessage()
+    try:
+      audit_result = device_model.Device.audit_shelf(
+          shelf=shelf,
+          devices=[devices[identifier]
+                   for identifier in request.device_identifiers],
+          user_email=user_email)
+    except device_model.UnableToMoveToShelfError as err:
+      raise endpoints.BadRequestException(str(err))
+    for device in audit_result.already_on_shelf:
+      logging.info('Device %s is already on shelf.', device.identifier)
+    shelf.audit(
+        user_email=user_email,
+        num_of_devices=(
+            len(audit_result.already_on_shelf) + len(audit_result.checked_in)))
+
+    statuses = {}
+    for status, audited_devices in (
+        (shelf_messages.AuditStatus.ALREADY_ON_SHELF,
+         audit_result.already_on_shelf),
+        (shelf_messages.AuditStatus.CHECKED_IN, audit_result.checked_in)):
+      for device in audited_devices:
+        statuses[device.key] = status
+    results = [
+        shelf_messages.DeviceAuditResult(
+            identifier=identifier, status=statuses[devices[identifier].key])
+        for identifier in request.device_identifiers]
+    results.extend(
+        shelf_messages.DeviceAuditResult(
+            identifier=device.identifier,
+            status=shelf_messages.AuditStatus.REMOVED)
+        for device in audit_result.removed)
+    return shelf_messages.ShelfAuditResponse(results=results)
 
 
 def get_shelf(request):
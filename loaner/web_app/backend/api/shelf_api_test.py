@@ -23,8 +23,6 @@ import mock
 
 from protorpc import message_types
 
-from google.appengine.api import search
-
 import endpoints
 
 from loaner.web_app.backend.api import root_api  # pylint: disable=unused-import
@@ -220,7 +218,13 @@ class ShelfApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
       self.assertEqual(datastore_device.shelf.get().location, 'NYC')
     self.assertFalse(self.shelf.audit_requested)
     self.assertEqual(self.shelf.last_audit_by, loanertest.SUPER_ADMIN_EMAIL)
-    self.assertIsInstance(response, message_types.VoidMessage)
+    self.assertIsInstance(response, shelf_messages.ShelfAuditResponse)
+    self.assertEqual(
+        [(result.identifier, result.status) for result in response.results],
+        [('12345', shelf_messages.AuditStatus.CHECKED_IN),
+         ('54321', shelf_messages.AuditStatus.CHECKED_IN),
+         ('67890', shelf_messages.AuditStatus.ALREADY_ON_SHELF),
+         ('ABC123', shelf_messages.AuditStatus.REMOVED)])
 
   def test_audit_invalid_device(self):
     request = shelf_messages.ShelfAuditRequest(
@@ -231,23 +235,30 @@ class ShelfApiTest(parameterized.TestCase, loanertest.EndpointsTestCase):
         shelf_api._DEVICE_DOES_NOT_EXIST_MSG % 'Invalid'):
       self.service.audit(request)
 
-  @mock.patch.object(device_model.Device, 'search')
+  @mock.patch('__main__.root_api.Service.check_xsrf_token')
+  def test_audit_invalid_device_changes_nothing(self, mock_xsrf_token):
+    request = shelf_messages.ShelfAuditRequest(
+        shelf_request=shelf_messages.ShelfRequest(location='NYC'),
+        device_identifiers=[self.device1_key.get().serial_number, 'Invalid'])
+    with self.assertRaises(endpoints.NotFoundException):
+      self.service.audit(request)
+    self.assertIsNone(self.device1_key.get().shelf)
+    self.assertEqual(self.device4_key.get().shelf, self.shelf.key)
+
+  @mock.patch('__main__.root_api.Service.check_xsrf_token')
+  def test_audit_disabled_shelf(self, mock_xsrf_token):
+    request = shelf_messages.ShelfAuditRequest(
+        shelf_request=shelf_messages.ShelfRequest(
+            location=self.disabled_shelf.location),
+        device_identifiers=self.device_identifiers)
+    with self.assertRaises(endpoints.BadRequestException):
+      self.service.audit(request)
+
   @mock.patch.object(shelf_api, 'get_shelf', autospec=True)
-  def test_audit_remove_devices(
-      self, mock_get_shelf, mock_model_device_search):
+  def test_audit_remove_devices(self, mock_get_shelf):
     shelf = self.device2_key.get()
     shelf.shelf = self.shelf.key
     shelf.put()
-    mock_model_device_search.return_value = (
-        search.SearchResults(
-            results=[
-                search.ScoredDocument(
-                    doc_id=self.device2_key.urlsafe()),
-                search.ScoredDocument(
-                    doc_id=self.device3_key.urlsafe()),
-                search.ScoredDocument(
-                    doc_id=self.device4_key.urlsafe())],
-            number_found=3))
     mock_get_shelf.return_value = self.shelf
     request = shelf_messages.ShelfAuditRequest(
         shelf_request=shelf_messages.ShelfRequest(location=self.shelf.location),
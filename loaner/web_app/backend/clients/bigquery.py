@@ -18,7 +18,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import logging
+import threading
+import time
 
 from loaner.web_app.backend.common import google_cloud_lib_fixer  # pylint: disable=unused-import
 # pylint: disable=g-bad-import-order,g-import-not-at-top
@@ -48,6 +51,19 @@ DEVICE_QUERY = (""" SELECT *
                                 table=constants.BIGQUERY_DEVICE_TABLE,
                                 serial='{}')  # Serial will be added later.
 
+# How long table metadata is reused before it is fetched again.
+_TABLE_CACHE_SECONDS = 10 * 60
+# BigQuery recommends at most 500 rows per streaming insert request.
+_MAX_ROWS_PER_INSERT = 500
+# Kept well under the 10MB limit on a streaming insert request.
+_MAX_BYTES_PER_INSERT = 5 * 1024 * 1024
+
+# The bigquery.Client shared by every BigQueryClient in this instance, and the
+# tables it has fetched, keyed by name, as (table, expiry time) pairs.
+_client_lock = threading.Lock()
+_shared_client = None
+_table_cache = {}
+
 
 class Error(Exception):
   """Base error class for this module."""
@@ -79,7 +95,7 @@ class BigQueryClient(object):
   def __init__(self):
     if constants.ON_LOCAL:
       return
-    self._client = bigquery.Client()
+    self._client = _get_shared_client()
     self._dataset_ref = bigquery.DatasetReference(
         self._client.project, constants.BIGQUERY_DATASET_NAME)
 
@@ -125,11 +141,12 @@ class BigQueryClient(object):
       merged_schema = _merge_schemas(table.schema, table_schema)
       table.schema = merged_schema
       table = self._client.update_table(table, ['schema'])
+      _table_cache.pop(table_name, None)
       logging.info('Table %s updated.', table_name)
     else:
       logging.info('Table %s created.', table_name)
 
-  def stream_table(self, table_name, table_data):
+  def stream_table(self, table_name, table_data, row_ids=None):
     """Inserts table rows into BigQuery.
 
       For each row in a given table, we include a row_id, which is derived
@@ -138,9 +155,14 @@ class BigQueryClient(object):
 
       https://cloud.google.com/bigquery/streaming-data-into-bigquery#dataconsistency
 
+      Rows are sent in as few requests as the streaming insert limits allow.
+      The table's schema is cached for a few minutes and refetched after a
+      failed insert, in case the rows were rejected because it changed.
+
     Args:
       table_name: str, table name to stream to.
       table_data: List[tuple], rows for the insert request to the BigQuery API.
+      row_ids: List[str], an optional insert ID for each row in table_data.
 
     Raises:
       GetTableError: if an invalid table is passed in or the table is not
@@ -151,17 +173,78 @@ class BigQueryClient(object):
       logging.debug('On local, not connecting to BQ.')
       return
 
+    for start, stop in _chunk_rows(table_data):
+      bq_table = self._get_table(table_name)
+      try:
+        errors = self._client.insert_rows(
+            bq_table, table_data[start:stop],
+            row_ids=row_ids[start:stop] if row_ids else None)
+      except cloud.exceptions.BadRequest as err:
+        errors = [err.message]
+      if errors:
+        _table_cache.pop(table_name, None)
+        logging.error('BigQuery insert generated errors.')
+        logging.error(errors)
+        raise InsertError(
+            'BigQuery insert generated errors {}.'.format(errors))
+
+  def stream_tables(self, tables, row_ids=None):
+    """Inserts rows into several tables concurrently.
+
+    Args:
+      tables: dict, table names mapped to a List[tuple] of rows for the table.
+      row_ids: dict, table names mapped to an optional List[str] of insert IDs
+          for the rows of the table.
+
+    Raises:
+      GetTableError: if an invalid table is passed in or the table is not
+          initialized.
+      InsertError: if the insert fails for any table. The other tables are
+          still streamed.
+    """
+    errors = []
+
+    def stream(table_name, table_data):
+      try:
+        self.stream_table(
+            table_name, table_data, (row_ids or {}).get(table_name))
+      except Exception as err:  # pylint: disable=broad-except
+        # Re-raised below, in the calling thread.
+        errors.append(err)
+
+    threads = [
+        threading.Thread(target=stream, args=(table_name, table_data))
+        for table_name, table_data in tables.items()]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+
+  def _get_table(self, table_name):
+    """Gets a table, reusing one fetched in the last few minutes.
+
+    Args:
+      table_name: str, name of the table to get.
+
+    Returns:
+      The bigquery.Table.
+
+    Raises:
+      GetTableError: if the table does not exist.
+    """
+    cached = _table_cache.get(table_name)
+    if cached and cached[1] > time.time():
+      return cached[0]
     table_ref = self._dataset_ref.table(table_name)
     try:
       bq_table = self._client.get_table(table_ref)
     except cloud.exceptions.NotFound:
       raise GetTableError(
           'Table {} does not exist or is not initialized'.format(table_name))
-    errors = self._client.insert_rows(bq_table, table_data)
-    if errors:
-      logging.error('BigQuery insert generated errors.')
-      logging.error(errors)
-      raise InsertError('BigQuery insert generated errors {}.'.format(errors))
+    _table_cache[table_name] = (bq_table, time.time() + _TABLE_CACHE_SECONDS)
+    return bq_table
 
   def get_device_info(self, serial):
     """Return historical data of a device by quering serial number.
@@ -176,6 +259,46 @@ class BigQueryClient(object):
     return [row for row in query_job]
 
 
+def clear_cache():
+  """Drops this instance's shared client and cached tables."""
+  global _shared_client  # pylint: disable=global-statement
+  with _client_lock:
+    _shared_client = None
+    _table_cache.clear()
+
+
+def _get_shared_client():
+  """Returns this instance's bigquery.Client, creating it on first use."""
+  global _shared_client  # pylint: disable=global-statement
+  with _client_lock:
+    if _shared_client is None:
+      _shared_client = bigquery.Client()
+    return _shared_client
+
+
+def _chunk_rows(rows):
+  """Splits rows into chunks that each fit in one streaming insert request.
+
+  Args:
+    rows: List[tuple], the rows to insert.
+
+  Yields:
+    A (start, stop) pair of indexes into rows for each chunk.
+  """
+  start = 0
+  chunk_bytes = 0
+  for index, row in enumerate(rows):
+    row_bytes = len(json.dumps(row, default=str))
+    if index > start and (index - start >= _MAX_ROWS_PER_INSERT or
+                          chunk_bytes + row_bytes > _MAX_BYTES_PER_INSERT):
+      yield start, index
+      start = index
+      chunk_bytes = 0
+    chunk_bytes += row_bytes
+  if start < len(rows):
+    yield start, len(rows)
+
+
 def _generate_entity_schema(entity):
   """Converts an ndb.Model to a BigQuery schema.
 
@@ -22,6 +22,7 @@ import datetime
 
 from absl.testing import parameterized
 
+import freezegun
 import mock
 
 # pylint: disable=g-bad-import-order
@@ -43,6 +44,8 @@ class BigQueryClientTest(loanertest.TestCase, parameterized.TestCase):
 
   def setUp(self):
     super(BigQueryClientTest, self).setUp()
+    bigquery.clear_cache()
+    self.addCleanup(bigquery.clear_cache)
     bq_patcher = mock.patch.object(gcloud_bq, 'Client', autospec=True)
     self.addCleanup(bq_patcher.stop)
     self.bq_mock = bq_patcher.start()
@@ -108,7 +111,53 @@ class BigQueryClientTest(loanertest.TestCase, parameterized.TestCase):
   def test_stream_table(self):
     self.client.stream_table('Device', self.test_table)
     self.client._client.insert_rows.assert_called_once_with(
-        self.table, self.test_table)
+        self.table, self.test_table, row_ids=None)
+
+  def test_shared_client(self):
+    self.bq_mock.reset_mock()
+    self.bq_mock.return_value.project = 'test-project'
+    bigquery.BigQueryClient()
+    bigquery.BigQueryClient()
+    self.assertEqual(self.bq_mock.call_count, 1)
+
+  def test_stream_table_cached_table(self):
+    with freezegun.freeze_time('2018-01-01 00:00:00') as frozen_time:
+      self.client.stream_table('Device', self.test_table)
+      self.client.stream_table('Device', self.test_table)
+      self.assertEqual(self.client._client.get_table.call_count, 1)
+
+      frozen_time.tick(datetime.timedelta(
+          seconds=bigquery._TABLE_CACHE_SECONDS + 1))
+      self.client.stream_table('Device', self.test_table)
+      self.assertEqual(self.client._client.get_table.call_count, 2)
+
+  @mock.patch.object(bigquery, '_MAX_ROWS_PER_INSERT', 2)
+  def test_stream_table_chunked(self):
+    self.client.stream_table(
+        'Device', self.test_table * 3, row_ids=['a', 'b', 'c'])
+    self.client._client.insert_rows.assert_has_calls([
+        mock.call(self.table, self.test_table * 2, row_ids=['a', 'b']),
+        mock.call(self.table, self.test_table, row_ids=['c'])])
+    self.assertEqual(self.client._client.get_table.call_count, 1)
+
+  def test_stream_tables(self):
+    self.client.stream_tables(
+        {'Device': self.test_table, 'Shelf': self.test_table},
+        row_ids={'Device': ['a'], 'Shelf': ['b']})
+    self.client._client.insert_rows.assert_has_calls(
+        [mock.call(self.table, self.test_table, row_ids=['a']),
+         mock.call(self.table, self.test_table, row_ids=['b'])],
+        any_order=True)
+    self.assertEqual(self.client._client.get_table.call_count, 2)
+
+  def test_stream_tables_error(self):
+    self.client._client.insert_rows.side_effect = [
+        None, 'Oh no it exploded']
+    with self.assertRaises(bigquery.InsertError):
+      self.client.stream_tables(
+          {'Device': self.test_table, 'Shelf': self.test_table})
+    # The table that did not fail was still streamed.
+    self.assertEqual(self.client._client.insert_rows.call_count, 2)
 
   def test_stream_row_no_table(self):
     self.client._client.get_table.side_effect = cloud.exceptions.NotFound(
@@ -122,6 +171,18 @@ class BigQueryClientTest(loanertest.TestCase, parameterized.TestCase):
     self.assertRaises(
         bigquery.InsertError,
         self.client.stream_table, 'Device', self.test_table)
+    # The table is fetched again in case its schema changed.
+    self.assertRaises(
+        bigquery.InsertError,
+        self.client.stream_table, 'Device', self.test_table)
+    self.assertEqual(self.client._client.get_table.call_count, 2)
+
+  def test_stream_row_bad_request(self):
+    self.client._client.insert_rows.side_effect = (
+        cloud.exceptions.BadRequest('Invalid rows'))
+    self.assertRaises(
+        bigquery.InsertError,
+        self.client.stream_table, 'Device', self.test_table)
 
   def test_get_device_info(self):
     test_serial = 'ABC1234'
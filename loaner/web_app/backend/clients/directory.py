@@ -21,6 +21,7 @@ from __future__ import print_function
 
 import httplib
 import logging
+import threading
 
 # pylint: disable=unused-import,g-bad-import-order,g-import-not-at-top
 from loaner.web_app.backend.common import google_cloud_lib_fixer
@@ -28,6 +29,7 @@ from loaner.web_app.backend.common import google_cloud_lib_fixer
 import google_auth_httplib2
 from googleapiclient import errors
 from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from google.oauth2 import service_account
 
 from loaner.web_app import constants
@@ -38,6 +40,12 @@ MODEL = u'model'
 ORG_UNIT_PATH = u'orgUnitPath'
 SERIAL_NUMBER = u'serialNumber'
 _NEXT_PAGE = 'nextPageToken'
+# The number of calls sent in one batch HTTP request.
+_BATCH_SIZE = 50
+# The number of device IDs sent in one moveDevicesToOu call.
+_MOVE_DEVICES_CHUNK = 50
+# The largest page of Chrome devices the list call returns.
+_LIST_DEVICES_PAGE_SIZE = 300
 
 _NO_DEVICE_MSG = 'Device with serial number %s does not exist in the directory.'
 
@@ -66,6 +74,70 @@ class GivenNameDoesNotExistError(Error):
   """Rasied when a given name does not exist for a user."""
 
 
+class _ServiceCache(object):
+  """A process-wide cache of Directory API credentials and service objects.
+
+  Credentials are shared by every thread. A service object holds its own
+  authorized HTTP connection, which is not thread-safe, so each thread builds
+  one service per subject and scopes and reuses it for later requests. The
+  services are kept in thread-local storage, so they are dropped with their
+  thread.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    """Drops every cached credential, service and discovery document."""
+    with self._lock:
+      self._credentials = {}
+      self._local = threading.local()
+      self._discovery_document = None
+
+  def get_service(self, subject, scopes):
+    """Returns this thread's Directory API service for subject and scopes.
+
+    Args:
+      subject: str, the email address of the account to act as.
+      scopes: Sequence[str], the OAuth2 scopes to request.
+
+    Returns:
+      Google Admin SDK Directory API service object.
+    """
+    credentials_key = (subject, tuple(scopes))
+    local = self._local
+    services = getattr(local, 'services', None)
+    if services is None:
+      services = local.services = {}
+    service = services.get(credentials_key)
+    if service is not None:
+      return service
+    with self._lock:
+      credentials = self._credentials.get(credentials_key)
+      if credentials is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            filename=constants.SECRETS_FILE, scopes=scopes, subject=subject)
+        self._credentials[credentials_key] = credentials
+        logging.info('Created delegated credentials for %s.', subject)
+      if (self._discovery_document is None and
+          constants.DIRECTORY_DISCOVERY_DOCUMENT):
+        with open(constants.DIRECTORY_DISCOVERY_DOCUMENT) as document:
+          self._discovery_document = document.read()
+      discovery_document = self._discovery_document
+
+    http = google_auth_httplib2.AuthorizedHttp(credentials=credentials)
+    if discovery_document:
+      service = build_from_document(discovery_document, http=http)
+    else:
+      service = build(serviceName='admin', version='directory_v1', http=http)
+    services[credentials_key] = service
+    return service
+
+
+_service_cache = _ServiceCache()
+
+
 class DirectoryApiClient(object):
   """Directory service instance."""
 
@@ -85,20 +157,11 @@ class DirectoryApiClient(object):
     Raises:
       UnauthorizedUserError: If a user email is not provided.
     """
-    if user_email and user_email.split('@')[1] in constants.APP_DOMAINS:
-      credentials = service_account.Credentials.from_service_account_file(
-          filename=constants.SECRETS_FILE,
-          scopes=constants.DIRECTORY_SCOPES,
-          subject=constants.ADMIN_EMAIL)
-
-      logging.info('Created delegated credentials for %s.', user_email)
-    else:
+    if not user_email or user_email.split('@')[1] not in constants.APP_DOMAINS:
       raise UnauthorizedUserError('User Email not provided.')
 
-    return build(
-        serviceName='admin',
-        version='directory_v1',
-        http=google_auth_httplib2.AuthorizedHttp(credentials=credentials))
+    return _service_cache.get_service(
+        constants.ADMIN_EMAIL, constants.DIRECTORY_SCOPES)
 
   def get_chrome_device(self, device_id):
     """Query for a Chrome device inside of an organization by deviceId.
@@ -156,6 +219,189 @@ class DirectoryApiClient(object):
       logging.error(_NO_DEVICE_MSG, serial_number)
       raise DeviceDoesNotExistError(_NO_DEVICE_MSG % serial_number)
 
+  def get_chrome_devices(self, device_ids):
+    """Query for many Chrome devices by deviceId using batch requests.
+
+    Args:
+      device_ids: List[str], the unique IDs of the Chrome devices.
+
+    Returns:
+      A dictionary mapping each device ID to a dictionary based on a JSON
+      object of kind admin#directory#chromeosdevice, or to None if the device
+      does not exist.
+
+    Raises:
+      DirectoryRPCError: An error when the RPC call to the directory API fails.
+    """
+    chromeosdevices = self._client.chromeosdevices()
+    responses = self._execute_batch({
+        device_id: chromeosdevices.get(
+            customerId=constants.CUSTOMER_ID,
+            deviceId=device_id,
+            fields=constants.CHROME_FIELDS_MASK)
+        for device_id in set(device_ids)})
+    devices = {}
+    for device_id, (response, err) in responses.items():
+      if err is None:
+        devices[device_id] = response
+      elif (isinstance(err, errors.HttpError) and
+            err.resp.status == httplib.NOT_FOUND):
+        devices[device_id] = None
+      else:
+        raise self._batch_error('get Chrome device', err)
+    return devices
+
+  def get_chrome_devices_by_serial(self, serial_numbers):
+    """Query for many Chrome devices by serial number using batch requests.
+
+    Args:
+      serial_numbers: List[str], the serial numbers of the Chrome devices.
+
+    Returns:
+      A dictionary mapping each serial number to a dictionary based on a JSON
+      object of kind admin#directory#chromeosdevice, or to None if the device
+      does not exist.
+
+    Raises:
+      DirectoryRPCError: An error when the RPC call to the directory API fails.
+    """
+    chromeosdevices = self._client.chromeosdevices()
+    responses = self._execute_batch({
+        serial_number: chromeosdevices.list(
+            customerId=constants.CUSTOMER_ID,
+            maxResults=1,
+            query='id:' + serial_number,
+            fields=constants.CHROME_LIST_FIELDS_MASK)
+        for serial_number in set(serial_numbers)})
+    devices = {}
+    for serial_number, (response, err) in responses.items():
+      if err is not None:
+        raise self._batch_error('get Chrome device', err)
+      try:
+        devices[serial_number] = response['chromeosdevices'][0]
+      except (KeyError, IndexError):
+        logging.error(_NO_DEVICE_MSG, serial_number)
+        devices[serial_number] = None
+    return devices
+
+  def move_chrome_devices_org_unit(self, device_ids, org_unit_path):
+    """Move many Chrome devices into a new Organizational Unit.
+
+    The devices are looked up with batch requests first, since moveDevicesToOu
+    does not fail for devices that do not exist in this organization, and the
+    ones that exist are moved with one moveDevicesToOu call per chunk.
+
+    Args:
+      device_ids: List[str], the unique Chrome DeviceIds.
+      org_unit_path: String, The OrgUnitPath for the Organizational Unit to
+        which these Chrome devices should now belong.
+
+    Returns:
+      A list of the device IDs that do not exist in the directory and so were
+      not moved.
+
+    Raises:
+      DirectoryRPCError: An error when the RPC call to the directory API fails.
+    """
+    devices = self.get_chrome_devices(device_ids)
+    existing = sorted(
+        device_id for device_id, device in devices.items() if device)
+    missing = sorted(
+        device_id for device_id, device in devices.items() if not device)
+    logging.info(
+        'Moving %d devices to OU %r.', len(existing), org_unit_path)
+    for start in range(0, len(existing), _MOVE_DEVICES_CHUNK):
+      try:
+        self._client.chromeosdevices().moveDevicesToOu(
+            customerId=constants.CUSTOMER_ID,
+            orgUnitPath=org_unit_path,
+            body={
+                'deviceIds': existing[start:start + _MOVE_DEVICES_CHUNK]
+            }).execute()
+      except errors.HttpError as err:
+        logging.error(
+            'Directory API move Chrome device Org Unit failed with a %s '
+            'exception because %s.', str(type(err)), err.resp.reason)
+        raise DirectoryRPCError(err.resp.reason)
+    return missing
+
+  def _execute_batch(self, requests):
+    """Executes requests in batch HTTP requests of up to _BATCH_SIZE calls.
+
+    Args:
+      requests: Dict[str, googleapiclient.http.HttpRequest], the requests to
+          execute keyed by a unique request ID.
+
+    Returns:
+      A dictionary mapping each request ID to a tuple of the response and the
+      exception raised for that call, one of which is None.
+
+    Raises:
+      DirectoryRPCError: An error when a batch HTTP request itself fails.
+    """
+    responses = {}
+
+    def callback(request_id, response, exception):
+      responses[request_id] = (response, exception)
+
+    request_ids = sorted(requests)
+    for start in range(0, len(request_ids), _BATCH_SIZE):
+      batch = self._client.new_batch_http_request(callback=callback)
+      for request_id in request_ids[start:start + _BATCH_SIZE]:
+        batch.add(requests[request_id], request_id=request_id)
+      try:
+        batch.execute()
+      except errors.HttpError as err:
+        raise self._batch_error('batch request', err)
+    return responses
+
+  def _batch_error(self, action, err):
+    """Logs a failed call from a batch and returns the error to raise.
+
+    Args:
+      action: str, a description of the call that failed.
+      err: Exception, the exception raised for the call.
+
+    Returns:
+      A DirectoryRPCError for the failure.
+    """
+    reason = err.resp.reason if isinstance(err, errors.HttpError) else str(err)
+    logging.error(
+        'Directory API %s failed with a %s exception because %s.',
+        action, str(type(err)), reason)
+    return DirectoryRPCError(reason)
+
+  def list_chrome_devices(self, query=None, page_token=None):
+    """List a page of the Chrome devices in the organization.
+
+    Args:
+      query: String, an optional Directory API search query, e.g.
+          'sync:2018-01-01..' for devices that synced on or after a date.
+      page_token: String, The optional page token to query for.
+
+    Returns:
+      A dictionary based on a JSON object of kind
+        admin#directory#chromeosdevices, with the devices' deviceId,
+        serialNumber, model, orgUnitPath and lastSync, and a nextPageToken if
+        there are more devices.
+
+    Raises:
+      DirectoryRPCError: An error when the RPC call to the directory API fails.
+    """
+    try:
+      return self._client.chromeosdevices().list(
+          customerId=constants.CUSTOMER_ID,
+          maxResults=_LIST_DEVICES_PAGE_SIZE,
+          orderBy='lastSync',
+          query=query,
+          pageToken=page_token,
+          fields=constants.CHROME_SYNC_FIELDS_MASK).execute()
+    except errors.HttpError as err:
+      logging.error(
+          'Directory API list Chrome devices failed with a %s exception '
+          'because %s.', str(type(err)), err.resp.reason)
+      raise DirectoryRPCError(err.resp.reason)
+
   def get_org_unit(self, org_unit_path):
     """Query for an Organizational Unit inside of an organization by full path.
 
@@ -323,6 +569,35 @@ class DirectoryApiClient(object):
           'The given name for this user (%s) does not exist.', user_email)
       raise GivenNameDoesNotExistError(str(err))
 
+  def given_names(self, user_emails):
+    """Get the given names of many users using batch requests.
+
+    Args:
+      user_emails: List[str], the email addresses of the users.
+
+    Returns:
+      A dictionary mapping each email address to the user's given name, or to
+      None if the user does not exist or has no given name.
+
+    Raises:
+      DirectoryRPCError: An error when the RPC call to the directory API fails.
+    """
+    users = self._client.users()
+    responses = self._execute_batch({
+        user_email: users.get(
+            userKey=user_email, fields=constants.USER_NAME_FIELDS_MASK)
+        for user_email in set(user_emails)})
+    given_names = {}
+    for user_email, (response, err) in responses.items():
+      if err is None:
+        given_names[user_email] = response.get('name', {}).get('givenName')
+      elif (isinstance(err, errors.HttpError) and
+            err.resp.status == httplib.NOT_FOUND):
+        given_names[user_email] = None
+      else:
+        raise self._batch_error('given_name', err)
+    return given_names
+
   def get_all_users_in_group(self, group_email):
     """Retrieves all of the users in a particular Google Group.
 
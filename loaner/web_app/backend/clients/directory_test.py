@@ -18,6 +18,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
+import threading
+
 from absl.testing import parameterized
 
 from googleapiclient import errors
@@ -35,11 +38,39 @@ class FakeResponse(object):
     self.status = status
 
 
+class FakeBatch(object):
+  """A batch HTTP request that answers each call from a dictionary."""
+
+  def __init__(self, answers, callback):
+    self.answers = answers
+    self.callback = callback
+    self.request_ids = []
+
+  def add(self, request, request_id):
+    del request  # Unused.
+    self.request_ids.append(request_id)
+
+  def execute(self):
+    for request_id in self.request_ids:
+      answer = self.answers[request_id]
+      if isinstance(answer, Exception):
+        self.callback(request_id, None, answer)
+      else:
+        self.callback(request_id, answer, None)
+
+
 class DirectoryClientTest(parameterized.TestCase, loanertest.TestCase):
   """Test for the Directory API Client library."""
 
   def setUp(self):  # pylint: disable=arguments-differ
     super(DirectoryClientTest, self).setUp()
+    directory._service_cache.clear()
+    self.addCleanup(directory._service_cache.clear)
+    # Build from the mocked discovery service unless a test sets the document.
+    self.patcher_document = mock.patch.object(
+        directory.constants, 'DIRECTORY_DISCOVERY_DOCUMENT', '')
+    self.patcher_document.start()
+    self.addCleanup(self.patcher_document.stop)
     self.patcher_build = mock.patch.object(directory, 'build', autospec=True)
     self.patcher_creds = mock.patch.object(
         directory.service_account, 'Credentials', autospec=True)
@@ -80,6 +111,46 @@ class DirectoryClientTest(parameterized.TestCase, loanertest.TestCase):
     directory.DirectoryApiClient(user_email=self.user_email)
     self.assertEqual(self.mock_creds.from_service_account_file.call_count, 1)
 
+  def test_create_directory_api_client_cached(self):
+    client1 = directory.DirectoryApiClient(user_email=self.user_email)
+    client2 = directory.DirectoryApiClient(user_email=self.user_email)
+    self.assertIs(client1._client, client2._client)
+    self.assertEqual(self.mock_creds.from_service_account_file.call_count, 1)
+    self.assertEqual(self.mock_build.call_count, 1)
+
+  def test_create_directory_api_client_per_thread(self):
+    clients = []
+    thread = threading.Thread(
+        target=lambda: clients.append(
+            directory.DirectoryApiClient(user_email=self.user_email)))
+    thread.start()
+    thread.join()
+    directory.DirectoryApiClient(user_email=self.user_email)
+    # Credentials are shared across threads but services are not.
+    self.assertEqual(self.mock_creds.from_service_account_file.call_count, 1)
+    self.assertEqual(self.mock_build.call_count, 2)
+
+  @mock.patch.object(directory, 'build_from_document', autospec=True)
+  @mock.patch.object(
+      directory.constants, 'DIRECTORY_DISCOVERY_DOCUMENT', '/discovery.json')
+  def test_create_directory_api_client_from_document(
+      self, mock_build_from_document):
+    with mock.patch.object(
+        directory, 'open', mock.mock_open(read_data='{}'), create=True):
+      directory.DirectoryApiClient(user_email=self.user_email)
+    mock_build_from_document.assert_called_once_with('{}', http=mock.ANY)
+    self.assertFalse(self.mock_build.called)
+
+  def test_directory_discovery_document(self):
+    self.patcher_document.stop()
+    self.addCleanup(self.patcher_document.start)
+    with open(directory.constants.DIRECTORY_DISCOVERY_DOCUMENT) as document:
+      discovery = json.load(document)
+    self.assertEqual(discovery['name'], 'admin')
+    self.assertEqual(discovery['version'], 'directory_v1')
+    self.assertIn('moveDevicesToOu', discovery['resources'][
+        'chromeosdevices']['methods'])
+
   def test_create_directory_api_client_no_auth(self):
     with self.assertRaises(directory.UnauthorizedUserError):
       directory.DirectoryApiClient()
@@ -171,6 +242,34 @@ class DirectoryClientTest(parameterized.TestCase, loanertest.TestCase):
       directory_client.get_chrome_device_by_serial(self.serial_number)
     self.assertEqual(mock_logging.error.call_count, 1)
 
+  def test_list_chrome_devices(self):
+    mock_list = self.mock_client.chromeosdevices.return_value.list
+    mock_list.return_value.execute.return_value = {
+        'chromeosdevices': [loanertest.TEST_DIR_DEVICE1],
+        'nextPageToken': 'next_page',
+    }
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    response = directory_client.list_chrome_devices(
+        query='sync:2018-01-01..', page_token='this_page')
+    self.assertEqual(response['nextPageToken'], 'next_page')
+    mock_list.assert_called_once_with(
+        customerId=directory.constants.CUSTOMER_ID,
+        maxResults=directory._LIST_DEVICES_PAGE_SIZE,
+        orderBy='lastSync',
+        query='sync:2018-01-01..',
+        pageToken='this_page',
+        fields=directory.constants.CHROME_SYNC_FIELDS_MASK)
+
+  @mock.patch.object(directory, 'logging', autospec=True)
+  def test_list_chrome_devices_rpc_error(self, mock_logging):
+    mock_list = self.mock_client.chromeosdevices.return_value.list
+    mock_list.return_value.execute.side_effect = errors.HttpError(
+        FakeResponse('Forbidden', 403), 'NOT USED.')
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    with self.assertRaises(directory.DirectoryRPCError):
+      directory_client.list_chrome_devices()
+    self.assertEqual(mock_logging.error.call_count, 1)
+
   def test_get_org_unit(self):
     mock_orgunits = mock.Mock()
     self.mock_client.orgunits = mock_orgunits
@@ -261,6 +360,74 @@ class DirectoryClientTest(parameterized.TestCase, loanertest.TestCase):
     self.assertEqual(mock_execute.call_count, 1)
     self.assertEqual(2, mock_logging.info.call_count)
 
+  def _mock_batches(self, answers):
+    batches = []
+
+    def new_batch_http_request(callback):
+      batches.append(FakeBatch(answers, callback))
+      return batches[-1]
+
+    self.mock_client.new_batch_http_request.side_effect = new_batch_http_request
+    return batches
+
+  def test_get_chrome_devices(self):
+    not_found = errors.HttpError(FakeResponse('Not found', 404), 'NOT USED.')
+    batches = self._mock_batches(
+        {'device_1': loanertest.TEST_DIR_DEVICE1, 'device_2': not_found})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    self.assertEqual(
+        directory_client.get_chrome_devices(['device_1', 'device_2']),
+        {'device_1': loanertest.TEST_DIR_DEVICE1, 'device_2': None})
+    self.assertLen(batches, 1)
+
+  def test_get_chrome_devices_chunked(self):
+    device_ids = ['device_%d' % i for i in range(directory._BATCH_SIZE + 1)]
+    batches = self._mock_batches(
+        {device_id: {'deviceId': device_id} for device_id in device_ids})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    self.assertLen(
+        directory_client.get_chrome_devices(device_ids), len(device_ids))
+    self.assertEqual(
+        [len(batch.request_ids) for batch in batches],
+        [directory._BATCH_SIZE, 1])
+
+  def test_get_chrome_devices_error(self):
+    self._mock_batches({'device_1': errors.HttpError(
+        FakeResponse('Server error', 500), 'NOT USED.')})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    with self.assertRaises(directory.DirectoryRPCError):
+      directory_client.get_chrome_devices(['device_1'])
+
+  def test_get_chrome_devices_by_serial(self):
+    self._mock_batches({
+        'serial_1': {'chromeosdevices': [loanertest.TEST_DIR_DEVICE1]},
+        'serial_2': {}})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    self.assertEqual(
+        directory_client.get_chrome_devices_by_serial(['serial_1', 'serial_2']),
+        {'serial_1': loanertest.TEST_DIR_DEVICE1, 'serial_2': None})
+
+  def test_move_chrome_devices_org_unit(self):
+    device_ids = [
+        'device_%d' % i for i in range(directory._MOVE_DEVICES_CHUNK + 1)]
+    answers = {device_id: {'deviceId': device_id} for device_id in device_ids}
+    answers['missing'] = errors.HttpError(
+        FakeResponse('Not found', 404), 'NOT USED.')
+    self._mock_batches(answers)
+    mock_move_devices_to_ou = (
+        self.mock_client.chromeosdevices.return_value.moveDevicesToOu)
+
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    missing = directory_client.move_chrome_devices_org_unit(
+        device_ids + ['missing'], self.org_unit_path)
+    self.assertEqual(missing, ['missing'])
+    self.assertEqual(mock_move_devices_to_ou.call_count, 2)
+    moved = []
+    for call in mock_move_devices_to_ou.call_args_list:
+      self.assertEqual(call[1]['orgUnitPath'], self.org_unit_path)
+      moved.extend(call[1]['body']['deviceIds'])
+    self.assertCountEqual(moved, device_ids)
+
   @mock.patch.object(directory, 'logging', autospec=True)
   def test_move_chrome_device_org_unit_error(self, mock_logging):
 
@@ -393,6 +560,27 @@ class DirectoryClientTest(parameterized.TestCase, loanertest.TestCase):
       directory_client.given_name(loanertest.USER_EMAIL)
     self.assertEqual(mock_logging.info.call_count, 2)
 
+  def test_given_names(self):
+    batches = self._mock_batches({
+        'user_1@example.com': {'name': {'givenName': 'Dare'}},
+        'user_2@example.com': {},
+        'user_3@example.com': errors.HttpError(
+            FakeResponse('Not found', 404), 'NOT USED.')})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    self.assertEqual(
+        directory_client.given_names([
+            'user_1@example.com', 'user_2@example.com', 'user_3@example.com']),
+        {'user_1@example.com': 'Dare', 'user_2@example.com': None,
+         'user_3@example.com': None})
+    self.assertLen(batches, 1)
+
+  def test_given_names_error(self):
+    self._mock_batches({'user_1@example.com': errors.HttpError(
+        FakeResponse('Server error', 500), 'NOT USED.')})
+    directory_client = directory.DirectoryApiClient(user_email=self.user_email)
+    with self.assertRaises(directory.DirectoryRPCError):
+      directory_client.given_names(['user_1@example.com'])
+
   @parameterized.named_parameters(
       {'testcase_name': 'NoPageToken',
        'returns': [
@@ -0,0 +1,38 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.handlers.cron.flush_heartbeats."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mock
+
+from loaner.web_app.backend.models import device_model
+from loaner.web_app.backend.testing import handlertest
+
+
+class FlushHeartbeatsHandlerTest(handlertest.HandlerTestCase):
+  """Test the FlushHeartbeatsHandler."""
+
+  @mock.patch.object(device_model.Device, 'flush_heartbeats')
+  def test_get(self, mock_flush_heartbeats):
+    response = self.testapp.get(r'/_cron/flush_heartbeats')
+    self.assertEqual(response.status_int, 200)
+    mock_flush_heartbeats.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  handlertest.main()
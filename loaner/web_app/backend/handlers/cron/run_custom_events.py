@@ -18,32 +18,109 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import datetime
 import logging
 import webapp2
 
+from google.appengine.ext import ndb
+
 from loaner.web_app.backend.lib import events
+from loaner.web_app.backend.lib import mapper
 from loaner.web_app.backend.models import device_model  # pylint: disable=unused-import
 from loaner.web_app.backend.models import event_models
 from loaner.web_app.backend.models import shelf_model  # pylint: disable=unused-import
 
+_EVENTS_EDITED_MSG = 'Stopping the run for events %s, as they were edited.'
+
 
 class RunCustomEventsHandler(webapp2.RequestHandler):
-  """Handler for processing Custom Events."""
+  """Handler for processing Custom Events.
+
+  Each group of events sharing a query is processed by a mapper run, in
+  resumable slices on the action-system service. Each page is recorded as
+  mapped before its events are raised, so a failed task does not raise them
+  again for the same entities.
+  """
 
   def get(self):
     """Process an Action task with the correct Action class."""
     custom_events = event_models.CustomEvent.get_all_enabled()
-    for custom_event in custom_events:
-      for entity in custom_event.get_matching_entities():
-        device = (entity if custom_event.model.lower() == 'device' else None)
-        shelf = (entity if custom_event.model.lower() == 'shelf' else None)
-        try:
-          events.raise_event(
-              event_name=custom_event.name, device=device, shelf=shelf)
-        except events.EventActionsError as err:
-          # We log the error instead of raising an error so that we do not
-          # disrupt the handler for executing other devices/shelves when one of
-          # them fails.
-          logging.error(
-              'The following error occurred while trying to perform the event '
-              '%r: %s', custom_event.name, err)
+    now = datetime.datetime.utcnow()
+    for _, matchers in event_models.CustomEvent.build_matchers(
+        custom_events, now):
+      group = [custom_event for custom_event, _ in matchers]
+      mapper.start(
+          'run_custom_events_%s' % ','.join(
+              sorted(custom_event.name for custom_event in group)),
+          _query_entities, _raise_events,
+          args=(
+              [custom_event.key for custom_event in group],
+              [custom_event.rule_version for custom_event in group], now),
+          at_most_once=True)
+
+
+def _get_matchers(event_keys, rule_versions, now):
+  """Rebuilds the query and matchers for a group of events.
+
+  Args:
+    event_keys: List[ndb.Key], the keys of the events in the group.
+    rule_versions: List[tuple], the rule_version of each event when the run
+        started.
+    now: datetime, the time the run started.
+
+  Returns:
+    A (query, matchers) tuple as from CustomEvent.build_matchers, or
+    (None, []) if any of the events was deleted, disabled or edited since,
+    which stops the run.
+  """
+  custom_events = ndb.get_multi(event_keys)
+  if not all(custom_event and custom_event.enabled
+             for custom_event in custom_events):
+    return None, []
+  if [custom_event.rule_version
+      for custom_event in custom_events] != rule_versions:
+    logging.info(_EVENTS_EDITED_MSG, [key.id() for key in event_keys])
+    return None, []
+  groups = event_models.CustomEvent.build_matchers(custom_events, now)
+  if len(groups) != 1:
+    return None, []
+  return groups[0]
+
+
+def _query_entities(event_keys, rule_versions, now):
+  """Builds the query for the entities that may match a group of events."""
+  query, _ = _get_matchers(event_keys, rule_versions, now)
+  return query
+
+
+def _raise_events(entities, event_keys, rule_versions, now):
+  """Raises each event of a group for the entities matching it.
+
+  Args:
+    entities: List[ndb.Model], devices or shelves queried for the group.
+    event_keys: List[ndb.Key], the keys of the events in the group.
+    rule_versions: List[tuple], the rule_version of each event when the run
+        started.
+    now: datetime, the time the run started.
+
+  Returns:
+    An empty list, as the event actions put the entities themselves.
+  """
+  _, matchers = _get_matchers(event_keys, rule_versions, now)
+  for entity in entities:
+    for custom_event, match in matchers:
+      if not match(entity):
+        continue
+      device = (entity if custom_event.model.lower() == 'device' else None)
+      shelf = (entity if custom_event.model.lower() == 'shelf' else None)
+      try:
+        events.raise_event(
+            event_name=custom_event.name, device=device, shelf=shelf)
+      except events.EventActionsError as err:
+        # We log the error instead of raising an error so that we do not
+        # disrupt the handler for executing other devices/shelves when one of
+        # them fails.
+        logging.error(
+            'The following error occurred while trying to perform the event '
+            '%r: %s', custom_event.name, err)
+  return []
@@ -38,6 +38,13 @@ _THREE_DAYS_AGO_DELTA = event_models.create_timedelta(-3, 'd')
 class RunCustomEventsHandlerTest(handlertest.HandlerTestCase):
   """Test the RunCustomEventsHandler."""
 
+  def setUp(self):
+    super(RunCustomEventsHandlerTest, self).setUp()
+    # Run the mapper's slices as soon as they are deferred.
+    defer_patcher = loanertest.run_deferred_immediately()
+    self.mock_defer = defer_patcher.start()
+    self.addCleanup(defer_patcher.stop)
+
   @mock.patch('__main__.directory.DirectoryApiClient', autospec=True)
   def setup_devices(self, mock_directoryclass):
     mock_directoryclient = mock_directoryclass.return_value
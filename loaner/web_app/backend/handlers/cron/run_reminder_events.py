@@ -22,7 +22,10 @@ import datetime
 from absl import logging
 import webapp2
 
+from google.appengine.ext import ndb
+
 from loaner.web_app.backend.lib import events
+from loaner.web_app.backend.lib import mapper
 from loaner.web_app.backend.models import config_model
 from loaner.web_app.backend.models import device_model
 from loaner.web_app.backend.models import event_models
@@ -40,10 +43,21 @@ _DEVICE_SET_REMINDER_MSG = (
 _DEVICE_REMINDING_NOW_MSG = 'Reminding for Device %s at level %s.'
 _EVENT_ACTION_ERROR_MSG = (
     'The following error occurred while trying to set a device reminder: %s')
+_EVENT_EDITED_MSG = (
+    'Stopping the run for reminder level %d, as its event was edited.')
 
 
 class RunReminderEventsHandler(webapp2.RequestHandler):
-  """Handler for processing Reminder Events."""
+  """Handler for processing Reminder Events.
+
+  The devices for each reminder level, and the devices due a reminder, are
+  each processed by a mapper run, in resumable slices on the action-system
+  service. The levels are run one after another, in order, so a device that
+  matches several levels is marked for the last of them. Each device is marked
+  in its own transaction, so reminders sent concurrently are not overwritten.
+  Each page of devices due a reminder is recorded as mapped before they are
+  reminded, so a failed task does not remind them twice.
+  """
 
   def __init__(self, *args, **kwargs):
     super(RunReminderEventsHandler, self).__init__(*args, **kwargs)
@@ -53,75 +67,207 @@ class RunReminderEventsHandler(webapp2.RequestHandler):
   def get(self):
     """Process the Reminder Action task if need be."""
     self.reminder_events = event_models.ReminderEvent.get_all_enabled()
+    now = datetime.datetime.utcnow()
     if self.request.GET.get('find_remindable_devices') == 'true':
-      self._find_remindable_devices()
+      self._find_remindable_devices(now)
     if self.request.GET.get('remind_for_devices') == 'true':
-      self._remind_for_devices()
+      mapper.start(
+          'remind_for_devices', _query_due_devices, _remind_for_devices,
+          args=(now,), at_most_once=True)
 
-  def _find_remindable_devices(self):
-    """Find devices in a remindable state and mark them so."""
+  def _find_remindable_devices(self, now):
+    """Starts marking the devices in a remindable state for each level."""
     if not self.reminder_events:
       logging.error(_NO_REMINDER_EVENTS_MSG)
-    for reminder_event in self.reminder_events:
-      for device in reminder_event.get_matching_entities():
-
-        # Device has been marked pending return within the grace period.
-        if device.mark_pending_return_date:
-          logging.info(
-              _DEVICE_MARKED_RETURNED_MSG, device.identifier,
-              reminder_event.level)
-          continue
-
-        # Device already marked for a reminder at this level.
-        if device.next_reminder and (
-            device.next_reminder.level == reminder_event.level):
-          logging.info(
-              _DEVICE_ALREADY_NOTED_MSG, device.identifier,
-              reminder_event.level)
-          continue
-
-        # Device already had a reminder at this level.
-        if (
-            device.last_reminder and
-            device.last_reminder.level == reminder_event.level):
-
-          # We shouldn't remind again.
-          if not reminder_event.repeat_interval:
-            continue
-          else:
-
-            # We shouldn't remind again if insufficient time has elapsed.
-            time_since_reminder = (
-                datetime.datetime.utcnow() - device.last_reminder.time)
-            if (
-                time_since_reminder.total_seconds() <
-                reminder_event.interval * 86400):
-              logging.info(
-                  _DEVICE_REPEAT_WAITING_MSG, device.identifier,
-                  reminder_event.level, reminder_event.repeat_interval)
-              continue
-
-        # We should set a reminder with the delay from configuration settings.
-        device.set_next_reminder(
-            reminder_event.level, self.reminder_delay_delta)
-        logging.info(
-            _DEVICE_SET_REMINDER_MSG, device.identifier,
-            reminder_event.level, str(device.next_reminder.time))
-
-  def _remind_for_devices(self):
-    """Find devices marked as being in a remindable state and raise event."""
-    for device in device_model.Device.query(
-        device_model.Device.next_reminder.time <= datetime.datetime.utcnow()
-    ).fetch():
+      return
+    levels = [
+        (reminder_event.level, reminder_event.rule_version)
+        for reminder_event in sorted(
+            self.reminder_events, key=lambda event: event.level)]
+    _start_level_runs(levels, now, self.reminder_delay_delta)
+
+
+def _start_level_runs(levels, now, delay_delta):
+  """Starts the run for the first reminder level, then the others in order.
+
+  Args:
+    levels: List[tuple], the level and rule_version of each reminder event
+        left to run, in order.
+    now: datetime, the time the runs started.
+    delay_delta: datetime.timedelta, the time to wait before reminding.
+  """
+  (level, rule_version), rest = levels[0], levels[1:]
+  mapper.start(
+      'find_remindable_devices_%d' % level,
+      _query_remindable_devices, _find_remindable_devices,
+      args=(level, rule_version, now, delay_delta),
+      on_finish=(_start_level_runs, (rest, now, delay_delta)) if rest else None)
+
+
+def _get_matcher(level, rule_version, now):
+  """Rebuilds the query and matcher for a reminder level.
+
+  Args:
+    level: int, the level of the reminder event.
+    rule_version: tuple, the rule_version of the event when the run started.
+    now: datetime, the time the run started.
+
+  Returns:
+    A tuple of the ReminderEvent, the query for the devices that may match it
+    and a function checking a device matches it, or (None, None, None) if the
+    event was deleted or edited since, which stops the run.
+  """
+  reminder_event = event_models.ReminderEvent.get(level)
+  if not reminder_event:
+    return None, None, None
+  if reminder_event.rule_version != rule_version:
+    logging.info(_EVENT_EDITED_MSG, level)
+    return None, None, None
+  [(query, [(_, match)])] = event_models.CustomEvent.build_matchers(
+      [reminder_event], now)
+  return reminder_event, query, match
+
+
+def _query_remindable_devices(level, rule_version, now, delay_delta):
+  """Builds the query for the devices that may match a reminder event."""
+  del delay_delta  # Unused.
+  _, query, _ = _get_matcher(level, rule_version, now)
+  return query
+
+
+def _find_remindable_devices(devices, level, rule_version, now, delay_delta):
+  """Marks the devices in a remindable state for a level.
+
+  Args:
+    devices: List[device_model.Device], devices queried for the level.
+    level: int, the level of the reminder event.
+    rule_version: tuple, the rule_version of the event when the run started.
+    now: datetime, the time the run started.
+    delay_delta: datetime.timedelta, the time to wait before reminding.
+
+  Returns:
+    An empty list, as each device is put in its own transaction.
+  """
+  reminder_event, _, match = _get_matcher(level, rule_version, now)
+  if not reminder_event:
+    return []
+  futures = [
+      _mark_device(device.key, reminder_event, match, now, delay_delta)
+      for device in devices
+      if _is_remindable(device, reminder_event, match, now)]
+  ndb.Future.wait_all(futures)
+  for future in futures:
+    future.check_success()
+  return []
+
+
+def _is_remindable(device, reminder_event, match, now):
+  """Checks whether a device should be marked for a reminder level.
+
+  Args:
+    device: device_model.Device, the device to check.
+    reminder_event: event_models.ReminderEvent, the event for the level.
+    match: function, checks a device matches the event's conditions.
+    now: datetime, the time the run started.
+
+  Returns:
+    True if the device should get a reminder at the level.
+  """
+  if not match(device):
+    return False
+
+  # Device has been marked pending return within the grace period.
+  if device.mark_pending_return_date:
+    logging.info(
+        _DEVICE_MARKED_RETURNED_MSG, device.identifier, reminder_event.level)
+    return False
+
+  # Device already marked for a reminder at this level.
+  if device.next_reminder and (
+      device.next_reminder.level == reminder_event.level):
+    logging.info(
+        _DEVICE_ALREADY_NOTED_MSG, device.identifier, reminder_event.level)
+    return False
+
+  # Device already had a reminder at this level.
+  if (
+      device.last_reminder and
+      device.last_reminder.level == reminder_event.level):
+
+    # We shouldn't remind again.
+    if not reminder_event.repeat_interval:
+      return False
+
+    # We shouldn't remind again if insufficient time has elapsed.
+    time_since_reminder = now - device.last_reminder.time
+    if (
+        time_since_reminder.total_seconds() <
+        reminder_event.interval * 86400):
       logging.info(
-          _DEVICE_REMINDING_NOW_MSG, device.identifier,
-          device.next_reminder.level)
-      try:
-        events.raise_event(
-            event_name=event_models.ReminderEvent.make_name(
-                device.next_reminder.level),
-            device=device)
-      except events.EventActionsError as err:
-        # We log the error so that a single device does not disrupt all other
-        # devices that need reminders set.
-        logging.error(_EVENT_ACTION_ERROR_MSG, err)
+          _DEVICE_REPEAT_WAITING_MSG, device.identifier,
+          reminder_event.level, reminder_event.repeat_interval)
+      return False
+  return True
+
+
+# Cross-group, as the device's put hook may write its DeviceLookup entities.
+@ndb.transactional_tasklet(xg=True)
+def _mark_device(key, reminder_event, match, now, delay_delta):
+  """Marks a device for a reminder level if it is still remindable.
+
+  The device is read again within the transaction, so a reminder sent since
+  the page was fetched is not overwritten.
+
+  Args:
+    key: ndb.Key, the key of the device.
+    reminder_event: event_models.ReminderEvent, the event for the level.
+    match: function, checks a device matches the event's conditions.
+    now: datetime, the time the run started.
+    delay_delta: datetime.timedelta, the time to wait before reminding.
+
+  Returns:
+    A future for whether the device was marked.
+  """
+  device = yield key.get_async()
+  if not device or not _is_remindable(device, reminder_event, match, now):
+    raise ndb.Return(False)
+  # We should set a reminder with the delay from configuration settings.
+  device.set_next_reminder(reminder_event.level, delay_delta, put=False)
+  yield device.put_async()
+  logging.info(
+      _DEVICE_SET_REMINDER_MSG, device.identifier,
+      reminder_event.level, str(device.next_reminder.time))
+  raise ndb.Return(True)
+
+
+def _query_due_devices(now):
+  """Builds the query for the devices due a reminder."""
+  return device_model.Device.query(
+      device_model.Device.next_reminder.time <= now)
+
+
+def _remind_for_devices(devices, now):
+  """Raises the reminder event for devices due a reminder.
+
+  Args:
+    devices: List[device_model.Device], devices with a reminder due.
+    now: datetime, the time the run started.
+
+  Returns:
+    An empty list, as the reminder actions put the devices themselves.
+  """
+  del now  # Unused.
+  for device in devices:
+    logging.info(
+        _DEVICE_REMINDING_NOW_MSG, device.identifier,
+        device.next_reminder.level)
+    try:
+      events.raise_event(
+          event_name=event_models.ReminderEvent.make_name(
+              device.next_reminder.level),
+          device=device)
+    except events.EventActionsError as err:
+      # We log the error so that a single device does not disrupt all other
+      # devices that need reminders set.
+      logging.error(_EVENT_ACTION_ERROR_MSG, err)
+  return []
@@ -38,6 +38,13 @@ _NOW = datetime.datetime.utcnow()
 class RunReminderEventsHandlerTest(handlertest.HandlerTestCase):
   """Tests the RunReminderEventsHandler."""
 
+  def setUp(self):
+    super(RunReminderEventsHandlerTest, self).setUp()
+    # Run the mapper's slices as soon as they are deferred.
+    defer_patcher = loanertest.run_deferred_immediately()
+    self.mock_defer = defer_patcher.start()
+    self.addCleanup(defer_patcher.stop)
+
   @mock.patch('__main__.directory.DirectoryApiClient', autospec=True)
   def setup_devices(self, mock_directoryclass):
     mock_directoryclient = mock_directoryclass.return_value
@@ -168,6 +175,46 @@ class RunReminderEventsHandlerTest(handlertest.HandlerTestCase):
         run_reminder_events._DEVICE_ALREADY_NOTED_MSG,
         self.device1.identifier, 0)
 
+  def test_find_levels_in_order(self):
+    """Tests that a device matching two levels is marked for the last one."""
+    self.setup_events()
+    self.setup_devices()  # pylint: disable=no-value-for-parameter
+    reminder_soon_event = event_models.ReminderEvent.create(1)
+    reminder_soon_event.conditions = [
+        event_models.CustomEventCondition(
+            name='due_date', opsymbol='<',
+            value=event_models.create_timedelta(2, 'd'))]
+    reminder_soon_event.put()
+    self.device1.due_date = _NOW + datetime.timedelta(hours=23)
+    self.device1.put()
+
+    self.testapp.get(
+        r'/_cron/run_reminder_events?find_remindable_devices=true')
+
+    self.assertEqual(self.device1.key.get().next_reminder.level, 1)
+    # The level 1 run was started once the level 0 run finished.
+    self.assertTrue(any(
+        call[0][0] is run_reminder_events._start_level_runs
+        for call in self.mock_defer.call_args_list))
+
+  def test_find_keeps_concurrent_reminder(self):
+    """Tests that marking a device does not overwrite a reminder sent since."""
+    self.setup_events()
+    self.setup_devices()  # pylint: disable=no-value-for-parameter
+    self.device1.due_date = _NOW + datetime.timedelta(hours=23)
+    self.device1.put()
+    fetched_device = self.device1.key.get()
+    # The reminder is sent after the page was fetched.
+    self.device1.set_last_reminder(0)
+
+    run_reminder_events._find_remindable_devices(
+        [fetched_device], 0, self.reminder_due_event.rule_version, _NOW,
+        datetime.timedelta(hours=2))
+
+    retrieved_device1 = self.device1.key.get()
+    self.assertEqual(retrieved_device1.last_reminder.level, 0)
+    self.assertIsNone(retrieved_device1.next_reminder)
+
   @mock.patch('__main__.run_reminder_events.logging.info')
   def test_device_marked_returned(self, mock_loginfo):
     """Tests that a marked returned device is not reminded."""
@@ -0,0 +1,38 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.handlers.cron.stream_bigquery_rows."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mock
+
+from loaner.web_app.backend.models import bigquery_row_model
+from loaner.web_app.backend.testing import handlertest
+
+
+class StreamBigQueryRowsHandlerTest(handlertest.HandlerTestCase):
+  """Test the StreamBigQueryRowsHandler."""
+
+  @mock.patch.object(bigquery_row_model.BigQueryRow, 'stream_rows')
+  def test_get(self, mock_stream_rows):
+    response = self.testapp.get(r'/_cron/stream_bigquery_rows')
+    self.assertEqual(response.status_int, 200)
+    mock_stream_rows.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  handlertest.main()
@@ -0,0 +1,31 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Handler for mirroring Chrome OS directory devices with a cron job."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import webapp2
+
+from loaner.web_app.backend.models import directory_device_model
+
+
+class SyncDirectoryDevicesHandler(webapp2.RequestHandler):
+  """Cron handler for mirroring Chrome OS devices from the directory."""
+
+  def get(self):
+    """Get method for handler."""
+    directory_device_model.sync_directory_devices()
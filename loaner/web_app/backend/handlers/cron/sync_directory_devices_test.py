@@ -0,0 +1,38 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.handlers.cron.sync_directory_devices."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mock
+
+from loaner.web_app.backend.models import directory_device_model
+from loaner.web_app.backend.testing import handlertest
+
+
+class SyncDirectoryDevicesHandlerTest(handlertest.HandlerTestCase):
+  """Test the SyncDirectoryDevicesHandler."""
+
+  @mock.patch.object(directory_device_model, 'sync_directory_devices')
+  def test_get(self, mock_sync):
+    response = self.testapp.get(r'/_cron/sync_directory_devices')
+    self.assertEqual(response.status_int, 200)
+    mock_sync.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  handlertest.main()
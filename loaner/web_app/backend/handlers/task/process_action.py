@@ -18,13 +18,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pickle
-
 from absl import logging
 import webapp2
 
-from google.appengine.api import taskqueue
 from loaner.web_app.backend.lib import action_loader
+from loaner.web_app.backend.lib import task_collector
+from loaner.web_app.backend.lib import task_payloads
 
 
 class ProcessActionHandler(webapp2.RequestHandler):
@@ -42,7 +41,7 @@ class ProcessActionHandler(webapp2.RequestHandler):
 
   def post(self):
     """Process an async Action task with the correct Action class."""
-    payload = pickle.loads(self.request.body)
+    payload = task_payloads.decode_action(self.request.body)
     async_actions = payload.pop('async_actions')
     action_name = async_actions.pop(0)
     action_instance = self.actions['async'].get(action_name)
@@ -63,7 +62,7 @@ class ProcessActionHandler(webapp2.RequestHandler):
 
     if async_actions:
       payload['async_actions'] = async_actions
-      taskqueue.add(
+      task_collector.add(
           queue_name='process-action',
-          payload=pickle.dumps(payload),
+          payload=task_payloads.encode_action(payload),
           target='default')
@@ -18,13 +18,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pickle
-
 from absl import logging
 
 import mock
 
 from loaner.web_app.backend.lib import action_loader  # pylint: disable=unused-import
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import device_model
 from loaner.web_app.backend.testing import handlertest
 
@@ -53,7 +52,7 @@ class ProcessActionHandlerTest(handlertest.HandlerTestCase):
             'sample2': ActionSample()
         }}
     test_device = device_model.Device()
-    payload = pickle.dumps({
+    payload = task_payloads.encode_action({
         'device': test_device, 'shelf': None,
         'async_actions': ['sample1', 'sample2']})
     response = self.testapp.post(r'/_ah/queue/process-action', payload)
@@ -68,9 +67,45 @@ class ProcessActionHandlerTest(handlertest.HandlerTestCase):
 
     # Task for sample1 Action created a task for sample2 Action.
     self.assertLen(self.taskqueue_add.mock_calls, 1)
-    task_payload = pickle.loads(
+    task_payload = task_payloads.decode_action(
         self.taskqueue_add.call_args_list[0][1]['payload'])
     self.assertEqual(task_payload['async_actions'], ['sample2'])
 
+  @mock.patch('__main__.action_loader.load_actions')
+  def test_process_action_handler_chain_keeps_writes(self, mock_importactions):
+    """Test that chained Actions keep each other's device writes."""
+
+    class LockAction(object):
+
+      def run(self, device=None, shelf=None):
+        del shelf  # Unused.
+        device.locked = True
+        device.put()
+
+    class RemindAction(object):
+
+      def run(self, device=None, shelf=None):
+        del shelf  # Unused.
+        device.next_reminder = None
+        device.put()
+
+    mock_importactions.return_value = {
+        'async': {'lock': LockAction(), 'remind': RemindAction()}}
+    test_device = device_model.Device(
+        serial_number='123456', chrome_device_id='unique_id',
+        next_reminder=device_model.Reminder(level=3))
+    test_device.put()
+    payload = task_payloads.encode_action({
+        'device': test_device, 'async_actions': ['lock', 'remind']})
+
+    self.testapp.post(r'/_ah/queue/process-action', payload)
+    self.testapp.post(
+        r'/_ah/queue/process-action',
+        self.taskqueue_add.call_args_list[0][1]['payload'])
+
+    stored_device = test_device.key.get()
+    self.assertTrue(stored_device.locked)
+    self.assertIsNone(stored_device.next_reminder)
+
 if __name__ == '__main__':
   handlertest.main()
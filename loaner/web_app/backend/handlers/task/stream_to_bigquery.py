@@ -12,45 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Streams any unstreamed BigQuery Datastore rows to BigQuery."""
+"""Moves rows from the legacy stream-bq push queue to the row pull queue."""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import logging
-import pickle
 import webapp2
 
-from google.appengine.ext import deferred
-from google.appengine.ext import ndb
-
-from loaner.web_app.backend.models import bigquery_row_model
+from loaner.web_app import constants
+from loaner.web_app.backend.lib import task_collector
 
 
 class StreamToBigQueryHandler(webapp2.RequestHandler):
-  """Handler to add a row and stream to BigQuery if a threshold is reached."""
+  """Handler for rows enqueued on stream-bq before rows were pulled in batches.
 
-  @ndb.transactional
-  def stream_rows_wrapper(self):
-    """Streams rows ensuring that it is transactional."""
-    deferred.defer(
-        bigquery_row_model.BigQueryRow.stream_rows, _transactional=True)
+  Each task body is a row payload, which is moved unchanged onto the pull
+  queue for the next BigQuery flush to stream.
+  """
 
   def post(self):
-    """Adds a BigQuery row to Datastore and streams it using a deferred task.
-
-    Raises:
-      deferred.PermanentTaskFailure: if we encounter any exception to avoid
-        adding duplicate rows during task retries.
-    """
-    payload = pickle.loads(self.request.body)
-    bigquery_row_model.BigQueryRow.add(**payload)
-    try:
-      if bigquery_row_model.BigQueryRow.threshold_reached():
-        self.stream_rows_wrapper()
-      else:
-        logging.info('Not streaming rows, thresholds not met.')
-    except Exception as e:  # pylint: disable=broad-except
-      raise deferred.PermanentTaskFailure(
-          'Exception caught for BigQuery streaming: %s.' % e)
+    """Moves the row payload onto the BigQuery row pull queue."""
+    task_collector.add(
+        queue_name=constants.BIGQUERY_ROW_QUEUE,
+        payload=self.request.body,
+        method='PULL')
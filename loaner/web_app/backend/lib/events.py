@@ -19,16 +19,16 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
-import pickle
-
-from google.appengine.api import taskqueue
 
 from loaner.web_app.backend.actions import base_action
 from loaner.web_app.backend.lib import action_loader
+from loaner.web_app.backend.lib import task_collector
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import event_models
 
 _NO_ACTIONS_MSG = 'No actions for event %s.'
 _CACHED_EVENT_ACTION_MAPPINGS = None
+_CACHED_PARALLEL_EVENTS = None
 
 
 class Error(Exception):
@@ -47,9 +47,11 @@ def raise_event(event_name, device=None, shelf=None):
   """Raises an Event, running its sync and async Actions.
 
   This function runs sync Actions serially, accumulating changes from each
-  action, and then kicks off async Actions via a single task that will spawn
-  more tasks for additional actions. Supply either a device or shelf arg, but
-  not both.
+  action, and then kicks off async Actions. Async Actions run in order from a
+  single task that spawns a task for each following action, so each one sees
+  the changes of the previous ones. Events whose async Actions are independent
+  can opt to give each Action its own task, so they run in parallel. Supply
+  either a device or shelf arg, but not both.
 
   Args:
     event_name: str, the name of the Event.
@@ -108,15 +110,32 @@ def raise_event(event_name, device=None, shelf=None):
     if errors:
       raise EventActionsError(errors)
     if event_async_actions:
-      action_kwargs['async_actions'] = event_async_actions
-      taskqueue.add(
-          queue_name='process-action',
-          payload=pickle.dumps(action_kwargs),
-          target='default')
+      _enqueue_async_actions(event_name, action_kwargs, event_async_actions)
 
   return model
 
 
+def _enqueue_async_actions(event_name, action_kwargs, async_actions):
+  """Enqueues the async Actions of an Event, in one batch.
+
+  Args:
+    event_name: str, the name of the Event.
+    action_kwargs: dict, the 'device' or 'shelf' to run the Actions with.
+    async_actions: List[str], the names of the async Actions, in order.
+  """
+  if runs_async_actions_in_parallel(event_name):
+    chains = [[action] for action in async_actions]
+  else:
+    chains = [async_actions]
+  with task_collector.collect():
+    for chain in chains:
+      payload = dict(action_kwargs, async_actions=chain)
+      task_collector.add(
+          queue_name='process-action',
+          payload=task_payloads.encode_action(payload),
+          target='default')
+
+
 def get_actions_for_event(event_name):
   """Gets all Action mappings for a given Event.
 
@@ -137,17 +156,32 @@ def get_actions_for_event(event_name):
   return all_mappings.get(event_name)
 
 
+def runs_async_actions_in_parallel(event_name):
+  """Gets whether an Event runs its async Actions in parallel.
+
+  Args:
+    event_name: str, the name of the Event.
+
+  Returns:
+    True if the Event runs its async Actions in parallel, False if they run in
+    order, one at a time.
+  """
+  get_all_event_action_mappings()
+  return event_name in (_CACHED_PARALLEL_EVENTS or ())
+
+
 def get_all_event_action_mappings():
   """Gets all Event-Action mappings and caches them if necessary."""
-  global _CACHED_EVENT_ACTION_MAPPINGS
+  global _CACHED_EVENT_ACTION_MAPPINGS, _CACHED_PARALLEL_EVENTS
   if not _CACHED_EVENT_ACTION_MAPPINGS:
+    all_events = (
+        event_models.CoreEvent.query().fetch() +
+        event_models.ShelfAuditEvent.query().fetch() +
+        event_models.CustomEvent.query().fetch() +
+        event_models.ReminderEvent.query().fetch()
+    )
     _CACHED_EVENT_ACTION_MAPPINGS = {
-        event.name: event.actions
-        for event in (
-            event_models.CoreEvent.query().fetch() +
-            event_models.ShelfAuditEvent.query().fetch() +
-            event_models.CustomEvent.query().fetch() +
-            event_models.ReminderEvent.query().fetch()
-        )
-    }
+        event.name: event.actions for event in all_events}
+    _CACHED_PARALLEL_EVENTS = frozenset(
+        event.name for event in all_events if event.parallel_async_actions)
   return _CACHED_EVENT_ACTION_MAPPINGS
@@ -19,14 +19,13 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
-import pickle
 
 import mock
 
-from google.appengine.api import taskqueue
 from loaner.web_app.backend.actions import base_action
 from loaner.web_app.backend.lib import action_loader
 from loaner.web_app.backend.lib import events
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import device_model
 from loaner.web_app.backend.models import event_models
 from loaner.web_app.backend.testing import loanertest
@@ -43,12 +42,11 @@ class EventsTest(loanertest.TestCase):
 
   @mock.patch.object(logging, 'error')
   @mock.patch.object(logging, 'info')
-  @mock.patch.object(taskqueue, 'add')
   @mock.patch.object(events, 'get_actions_for_event')
   @mock.patch.object(action_loader, 'load_actions')
   def test_raise_event(
       self, mock_loadactions, mock_getactionsforevent,
-      mock_taskqueueadd, mock_loginfo, mock_logerror):
+      mock_loginfo, mock_logerror):
     """Tests raising an Action if the Event is configured for Actions."""
     self.testbed.raise_event_patcher.stop()  # Disable patcher; use real method.
 
@@ -77,20 +75,16 @@ class EventsTest(loanertest.TestCase):
     test_device = device_model.Device(
         chrome_device_id='4815162342', serial_number='123456')
 
-    expected_async_payload = pickle.dumps({
-        'async_actions': ['async_action1', 'async_action2', 'async_action3'],
-        'device': test_device
-    })
-
     events.raise_event('sample_event', device=test_device)
 
-    expected_calls = [
-        mock.call(
-            queue_name='process-action',
-            payload=expected_async_payload,
-            target='default'),
-    ]
-    mock_taskqueueadd.assert_has_calls(expected_calls)
+    # The async actions run in order from a single chained task.
+    self.taskqueue_add.assert_called_once_with(
+        queue_name='process-action',
+        payload=task_payloads.encode_action({
+            'async_actions': [
+                'async_action1', 'async_action2', 'async_action3'],
+            'device': test_device}),
+        target='default')
     mock_sync_action.run.assert_called_once_with(device=test_device)
 
     # A sync action raises a catchable exception.
@@ -115,6 +109,34 @@ class EventsTest(loanertest.TestCase):
 
     self.testbed.raise_event_patcher.start()  # Because cleanup will stop().
 
+  @mock.patch.object(action_loader, 'load_actions')
+  def test_raise_event_parallel(self, mock_loadactions):
+    """Tests raising an Event that runs its async Actions in parallel."""
+    self.testbed.raise_event_patcher.stop()  # Disable patcher; use real method.
+    self.addCleanup(self.testbed.raise_event_patcher.start)
+    mock_loadactions.return_value = {
+        'sync': {}, 'async': {'async_action1': 'fake_async_action1',
+                              'async_action2': 'fake_async_action2'}}
+    event = event_models.CoreEvent.create('parallel_event')
+    event.actions = ['async_action2', 'async_action1']
+    event.parallel_async_actions = True
+    event.put()
+    events._CACHED_EVENT_ACTION_MAPPINGS = None
+    self.addCleanup(setattr, events, '_CACHED_EVENT_ACTION_MAPPINGS', None)
+    test_device = device_model.Device(
+        chrome_device_id='4815162342', serial_number='123456')
+
+    events.raise_event('parallel_event', device=test_device)
+
+    # Each async action gets its own task.
+    self.assertEqual(self.taskqueue_add.call_args_list, [
+        mock.call(
+            queue_name='process-action',
+            payload=task_payloads.encode_action(
+                {'async_actions': [action], 'device': test_device}),
+            target='default')
+        for action in ('async_action1', 'async_action2')])
+
   @mock.patch.object(events, 'get_all_event_action_mappings')
   def test_get_actions_for_event(self, mock_getalleventmappings):
     """Tests simple get_actions_for_event function."""
@@ -0,0 +1,169 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of users' given names from the Directory API.
+
+Names are held in memcache, fronted by a per-instance LRU cache. Users without
+a given name are cached too, so they do not cost a Directory API call on every
+lookup. A miss never calls the Directory API inline; the name is fetched by a
+deferred task and is available to later requests.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+from loaner.web_app import constants
+from loaner.web_app.backend.clients import directory
+from loaner.web_app.backend.lib import utils
+
+_NAMESPACE = 'given_name'
+_PENDING_NAMESPACE = 'given_name_pending'
+# Given names rarely change, so cache them for a day.
+_GIVEN_NAME_TTL = 24 * 60 * 60
+# Users without a given name may gain one, so recheck them sooner.
+_NO_GIVEN_NAME_TTL = 6 * 60 * 60
+# How long a scheduled fill suppresses scheduling another for the same user.
+_PENDING_TTL = 60
+# Stored in place of None for users without a given name.
+_NO_GIVEN_NAME = ''
+
+_FILL_FAILED_MSG = 'Unable to fetch given names for %d users: %s'
+
+_local_cache = utils.LRUCache(1000)
+
+
+def get(user_email):
+  """Gets a user's given name from the cache.
+
+  Args:
+    user_email: str, the email address of the user.
+
+  Returns:
+    The user's given name, or None if the user has no given name or the name
+    is not cached yet.
+  """
+  return get_multi([user_email]).get(user_email)
+
+
+def get_multi(user_emails):
+  """Gets many users' given names from the cache.
+
+  Users whose names are not cached are filled by a deferred task, so this never
+  waits on the Directory API.
+
+  Args:
+    user_emails: List[str], the email addresses of the users.
+
+  Returns:
+    A dictionary mapping each email address to the user's given name, or to
+    None if the user has no given name or the name is not cached yet.
+  """
+  given_names = {}
+  misses = []
+  for user_email in set(user_emails):
+    cached = _local_cache.get(user_email)
+    if cached is None:
+      misses.append(user_email)
+    else:
+      given_names[user_email] = cached
+  if misses:
+    found = memcache.get_multi(misses, namespace=_NAMESPACE)
+    for user_email, given_name in found.items():
+      _local_cache.set(user_email, given_name, ttl=_ttl(given_name))
+      given_names[user_email] = given_name
+    _schedule_fill([user_email for user_email in misses
+                    if user_email not in found])
+  return {user_email: given_names.get(user_email) or None
+          for user_email in user_emails}
+
+
+def fill(user_emails):
+  """Fetches users' given names from the Directory API and caches them.
+
+  Args:
+    user_emails: List[str], the email addresses of the users.
+
+  Returns:
+    A dictionary mapping each email address to the user's given name, or to
+    None if the user has no given name.
+
+  Raises:
+    directory.DirectoryRPCError: if the call to the Directory API fails.
+  """
+  directory_client = directory.DirectoryApiClient(constants.ADMIN_EMAIL)
+  given_names = directory_client.given_names(user_emails)
+  named = {}
+  unnamed = {}
+  for user_email, given_name in given_names.items():
+    if given_name:
+      named[user_email] = given_name
+    else:
+      unnamed[user_email] = _NO_GIVEN_NAME
+    _local_cache.set(
+        user_email, given_name or _NO_GIVEN_NAME, ttl=_ttl(given_name))
+  if named:
+    memcache.set_multi(named, time=_GIVEN_NAME_TTL, namespace=_NAMESPACE)
+  if unnamed:
+    memcache.set_multi(unnamed, time=_NO_GIVEN_NAME_TTL, namespace=_NAMESPACE)
+  memcache.delete_multi(list(given_names), namespace=_PENDING_NAMESPACE)
+  return given_names
+
+
+def _ttl(given_name):
+  """Gets how long to cache a given name, or the lack of one, for."""
+  return _GIVEN_NAME_TTL if given_name else _NO_GIVEN_NAME_TTL
+
+
+def clear_local_cache():
+  """Empties this instance's LRU cache, leaving memcache untouched."""
+  _local_cache.clear()
+
+
+def _schedule_fill(user_emails):
+  """Defers a fill for users that do not already have one pending.
+
+  Args:
+    user_emails: List[str], the email addresses of the users to fill.
+  """
+  if not user_emails:
+    return
+  # memcache.add_multi returns the keys that were already present.
+  already_pending = memcache.add_multi(
+      {user_email: True for user_email in user_emails},
+      time=_PENDING_TTL, namespace=_PENDING_NAMESPACE)
+  to_fill = sorted(set(user_emails) - set(already_pending))
+  if not to_fill:
+    return
+  try:
+    deferred.defer(_fill_task, to_fill)
+  except taskqueue.Error as err:
+    # Failing to schedule a fill only means the name shows up later.
+    logging.warning(_FILL_FAILED_MSG, len(to_fill), err)
+    memcache.delete_multi(to_fill, namespace=_PENDING_NAMESPACE)
+
+
+def _fill_task(user_emails):
+  """Deferred task filling the cache for the given users."""
+  try:
+    fill(user_emails)
+  except directory.DirectoryRPCError as err:
+    logging.warning(_FILL_FAILED_MSG, len(user_emails), err)
+    memcache.delete_multi(user_emails, namespace=_PENDING_NAMESPACE)
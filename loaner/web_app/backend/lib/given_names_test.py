@@ -0,0 +1,105 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.lib.given_names."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mock
+
+from google.appengine.api import memcache
+
+from loaner.web_app.backend.clients import directory
+from loaner.web_app.backend.lib import given_names
+from loaner.web_app.backend.testing import loanertest
+
+_NAMED_USER = 'named@example.com'
+_UNNAMED_USER = 'unnamed@example.com'
+
+
+class GivenNamesTest(loanertest.TestCase):
+  """Tests for the given name cache."""
+
+  def setUp(self):
+    super(GivenNamesTest, self).setUp()
+    patcher = mock.patch.object(
+        given_names.directory, 'DirectoryApiClient', autospec=True)
+    self.mock_client = patcher.start().return_value
+    self.addCleanup(patcher.stop)
+    self.mock_client.given_names.return_value = {
+        _NAMED_USER: 'Named', _UNNAMED_USER: None}
+    defer_patcher = mock.patch.object(
+        given_names.deferred, 'defer', autospec=True)
+    self.mock_defer = defer_patcher.start()
+    self.addCleanup(defer_patcher.stop)
+
+  def test_get_miss_defers_fill(self):
+    self.assertIsNone(given_names.get(_NAMED_USER))
+    self.mock_defer.assert_called_once_with(
+        given_names._fill_task, [_NAMED_USER])
+    self.assertFalse(self.mock_client.given_names.called)
+
+    # A second miss while the fill is pending does not schedule another.
+    self.assertIsNone(given_names.get(_NAMED_USER))
+    self.assertEqual(self.mock_defer.call_count, 1)
+
+  def test_fill(self):
+    given_names.fill([_NAMED_USER, _UNNAMED_USER])
+    self.mock_client.given_names.assert_called_once_with(
+        [_NAMED_USER, _UNNAMED_USER])
+    self.assertEqual(
+        given_names.get_multi([_NAMED_USER, _UNNAMED_USER]),
+        {_NAMED_USER: 'Named', _UNNAMED_USER: None})
+    # Users without a given name are cached and not fetched again.
+    self.assertFalse(self.mock_defer.called)
+
+  def test_get_from_memcache(self):
+    given_names.fill([_NAMED_USER, _UNNAMED_USER])
+    given_names.clear_local_cache()
+    with mock.patch.object(
+        given_names.memcache, 'get_multi',
+        wraps=memcache.get_multi) as mock_get_multi:
+      self.assertEqual(given_names.get(_NAMED_USER), 'Named')
+      self.assertEqual(given_names.get(_NAMED_USER), 'Named')
+    # The second lookup is served by the local cache.
+    self.assertEqual(mock_get_multi.call_count, 1)
+    self.assertFalse(self.mock_defer.called)
+
+  def test_local_cache_expires(self):
+    given_names.fill([_NAMED_USER, _UNNAMED_USER])
+    now = given_names.utils.time.time()
+    with mock.patch.object(
+        given_names.memcache, 'get_multi',
+        wraps=memcache.get_multi) as mock_get_multi:
+      with mock.patch.object(
+          given_names.utils.time, 'time',
+          return_value=now + given_names._NO_GIVEN_NAME_TTL):
+        # The unnamed user's entry expires first, like its memcache entry.
+        given_names.get_multi([_NAMED_USER, _UNNAMED_USER])
+    mock_get_multi.assert_called_once_with(
+        [_UNNAMED_USER], namespace=given_names._NAMESPACE)
+
+  def test_fill_task_error(self):
+    self.mock_client.given_names.side_effect = directory.DirectoryRPCError
+    given_names.get(_NAMED_USER)
+    given_names._fill_task([_NAMED_USER])
+    # The pending marker is cleared so a later lookup retries the fill.
+    given_names.get(_NAMED_USER)
+    self.assertEqual(self.mock_defer.call_count, 2)
+
+
+if __name__ == '__main__':
+  loanertest.main()
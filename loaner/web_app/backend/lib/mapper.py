@@ -0,0 +1,532 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Maps a function over the results of a query in sharded, resumable slices.
+
+start() records a run and defers the split of the query's results into slices
+of consecutive cursors, which is done with keys-only pages. Each slice is then
+mapped by its own deferred task on the action-system service: the map function
+gets a page of entities at a time and returns those it changed, which are put
+with one batch per page. Slices save their cursor and counters after every
+page, so a task that fails or times out is retried from its last page rather
+than from the start. The run is logged with its totals when its last slice
+finishes, and its slices are deleted.
+
+Runs are keyed by name and a run is not started while another of the same name
+is still going, so a cron job that outlasts its schedule is not mapped twice at
+once. A run can defer a function once it is done, for example to start another
+run that must not overlap with it. Queries that need several datastore queries
+(those with != or IN filters) cannot be resumed from cursors, so they are
+mapped in the request that starts them instead.
+
+By default a page can be mapped again after a failure, so map functions must be
+safe to run more than once on the same entities. Map functions with side
+effects that must not be repeated, such as sending email, should be started
+with at_most_once, which records each page as mapped before mapping it: a page
+that fails part way is then skipped rather than mapped again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import datetime
+import logging
+import time
+import uuid
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+_TARGET = 'action-system'
+# The number of entities in a slice.
+_SLICE_SIZE = 500
+# The number of entities mapped and put in one batch.
+_PAGE_SIZE = 100
+# The number of slices created by one split task before it defers the rest.
+_SPLIT_PAGES_PER_TASK = 50
+# How long a run may go unfinished before another of its name may replace it.
+_RUN_TIMEOUT = datetime.timedelta(hours=1)
+
+_RUN_START_MSG = 'Started mapper run %s for %s.'
+_RUN_RUNNING_MSG = 'Not starting mapper run for %s, run %s is still going.'
+_RUN_DONE_MSG = (
+    'Mapper run %s for %s scanned %d and updated %d entities in %d slices, '
+    'taking %.1f seconds.')
+_RUN_FAILED_MSG = 'Mapper run %s for %s failed: %s'
+_MULTI_QUERY_MSG = (
+    'The query for %s cannot be resumed from cursors, mapping it in this '
+    'request.')
+_INLINE_DONE_MSG = (
+    'Mapping %s in one request scanned %d and updated %d entities, taking '
+    '%.1f seconds.')
+_INLINE_FAILED_MSG = 'Mapping %s in one request failed: %s'
+
+# The functions and arguments of a run, passed on to each of its tasks.
+_Job = collections.namedtuple(
+    '_Job', (
+        'query_fn', 'map_fn', 'args', 'slice_size', 'at_most_once',
+        'on_finish'))
+
+
+class _MapperRun(ndb.Model):
+  """The latest run of a mapper, keyed by its name.
+
+  Attributes:
+    run_id: str, a unique ID for the run, which its tasks check to stop once
+        the run is replaced.
+    started: datetime, when the run was started.
+    finished: datetime, when the run's last slice finished or the run failed.
+    failed: bool, whether the run was stopped by an error.
+    split_cursor: str, the urlsafe cursor the split continues from.
+    split_slices: int, the number of slices created so far.
+    slice_count: int, the number of slices, once the split is done.
+    scanned: int, the number of entities mapped, once the run is finished.
+    updated: int, the number of entities put, once the run is finished.
+    seconds: float, the time spent mapping, once the run is finished.
+  """
+  run_id = ndb.StringProperty(indexed=False)
+  started = ndb.DateTimeProperty(indexed=False)
+  finished = ndb.DateTimeProperty(indexed=False)
+  failed = ndb.BooleanProperty(default=False, indexed=False)
+  split_cursor = ndb.StringProperty(indexed=False)
+  split_slices = ndb.IntegerProperty(default=0, indexed=False)
+  slice_count = ndb.IntegerProperty(indexed=False)
+  scanned = ndb.IntegerProperty(default=0, indexed=False)
+  updated = ndb.IntegerProperty(default=0, indexed=False)
+  seconds = ndb.FloatProperty(default=0.0, indexed=False)
+
+
+class _MapperSlice(ndb.Model):
+  """A slice of a run's query results, keyed by the run ID and its number.
+
+  Slices are root entities so that their progress is not written to a single
+  entity group.
+
+  Attributes:
+    start_cursor: str, the urlsafe cursor the slice starts at, if any.
+    end_cursor: str, the urlsafe cursor the slice ends at, if any.
+    cursor: str, the urlsafe cursor after the last page mapped.
+    scanned: int, the number of entities mapped so far.
+    updated: int, the number of entities put so far.
+    seconds: float, the time spent mapping the slice so far.
+    completed: bool, whether the whole slice was mapped.
+  """
+  start_cursor = ndb.StringProperty(indexed=False)
+  end_cursor = ndb.StringProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  scanned = ndb.IntegerProperty(default=0, indexed=False)
+  updated = ndb.IntegerProperty(default=0, indexed=False)
+  seconds = ndb.FloatProperty(default=0.0, indexed=False)
+  completed = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class RunStats(object):
+  """Counters for a mapper run, summed over its slices.
+
+  Attributes:
+    name: str, the name of the run.
+    run_id: str, the ID of the run.
+    slices: int, the number of slices created so far.
+    completed_slices: int, the number of slices mapped in full.
+    scanned: int, the number of entities mapped.
+    updated: int, the number of entities put.
+    seconds: float, the time spent mapping, over all slices.
+    finished: bool, whether the run is done.
+    failed: bool, whether the run was stopped by an error.
+  """
+
+  def __init__(self, run, slices):
+    self.name = run.key.id()
+    self.run_id = run.run_id
+    self.finished = bool(run.finished)
+    self.failed = run.failed
+    if self.finished and not self.failed:
+      # The slices of a finished run are deleted, its totals are on the run.
+      self.slices = self.completed_slices = run.slice_count
+      self.scanned = run.scanned
+      self.updated = run.updated
+      self.seconds = run.seconds
+    else:
+      self.slices = len(slices)
+      self.completed_slices = sum(1 for slice_ in slices if slice_.completed)
+      self.scanned = sum(slice_.scanned for slice_ in slices)
+      self.updated = sum(slice_.updated for slice_ in slices)
+      self.seconds = sum(slice_.seconds for slice_ in slices)
+
+
+def start(
+    name, query_fn, map_fn, args=(), slice_size=_SLICE_SIZE,
+    at_most_once=False, on_finish=None):
+  """Starts mapping a function over the results of a query.
+
+  The functions are called in deferred tasks, so they must be module-level
+  functions and the arguments must be picklable. The query is rebuilt by every
+  task with query_fn, so any time it is relative to should be in args, and
+  query_fn should return None if whatever it is built from has changed since
+  the run started.
+
+  Args:
+    name: str, a name for the run, unique to the query and map function.
+    query_fn: function, called with args to build the ndb.Query to map over,
+        or to return None if there is nothing left to map.
+    map_fn: function, called with a list of entities from the query followed
+        by args, which returns a list of the entities it changed to put.
+    args: tuple, the arguments for query_fn and map_fn.
+    slice_size: int, the number of entities in each slice.
+    at_most_once: bool, whether to record each page as mapped before mapping
+        it, so that a page is never mapped twice.
+    on_finish: tuple, a module-level function and a tuple of its arguments,
+        deferred once the run has finished or failed. It is not called if the
+        run is not started because another of the same name is still going.
+
+  Returns:
+    The run ID, or None if a run of the same name is still going or the query
+    was mapped in this request.
+  """
+  job = _Job(
+      query_fn, map_fn, tuple(args), slice_size, at_most_once, on_finish)
+  query = query_fn(*job.args)
+  if query is not None and query._needs_multi_query():  # pylint: disable=protected-access
+    logging.warning(_MULTI_QUERY_MSG, name)
+    _map_in_request(name, query, job)
+    return None
+
+  run, replaced = _begin_run(name)
+  if not run:
+    logging.info(_RUN_RUNNING_MSG, name, replaced.run_id)
+    return None
+  if replaced:
+    _delete_slices(replaced.run_id, replaced.split_slices)
+  logging.info(_RUN_START_MSG, run.run_id, name)
+  deferred.defer(_split, run.key, run.run_id, job, _target=_TARGET)
+  return run.run_id
+
+
+def get_stats(name):
+  """Gets the counters for the latest mapper run of a name.
+
+  Args:
+    name: str, the name the run was started with.
+
+  Returns:
+    The RunStats of the run, or None if there is no such run.
+  """
+  run = _MapperRun.get_by_id(name)
+  if not run:
+    return None
+  slices = []
+  if not run.finished:
+    slices = [
+        slice_ for slice_ in ndb.get_multi(
+            _slice_keys(run.run_id, run.split_slices)) if slice_]
+  return RunStats(run, slices)
+
+
+@ndb.transactional
+def _begin_run(name):
+  """Records a new run of a name unless one is still going.
+
+  Args:
+    name: str, the name of the run.
+
+  Returns:
+    A tuple of the new _MapperRun, or None if a run is still going, and the
+    run it replaces, if any.
+  """
+  now = datetime.datetime.utcnow()
+  replaced = _MapperRun.get_by_id(name)
+  if (replaced and not replaced.finished and
+      now - replaced.started < _RUN_TIMEOUT):
+    return None, replaced
+  run = _MapperRun(id=name, run_id=uuid.uuid4().hex, started=now)
+  run.put()
+  return run, replaced
+
+
+def _get_run(run_key, run_id):
+  """Gets a run if it is still going, or None if it was finished or replaced."""
+  run = run_key.get()
+  if not run or run.run_id != run_id or run.finished:
+    return None
+  return run
+
+
+@ndb.transactional
+def _save_run(run):
+  """Puts a run unless it was finished or replaced, returning whether it did."""
+  if not _get_run(run.key, run.run_id):
+    return False
+  run.put()
+  return True
+
+
+def _slice_keys(run_id, count):
+  """Returns the keys of the first count slices of a run."""
+  return [
+      ndb.Key(_MapperSlice, '%s-%d' % (run_id, number))
+      for number in range(1, count + 1)]
+
+
+def _delete_slices(run_id, count):
+  """Deletes the first count slices of a run."""
+  if count:
+    ndb.delete_multi(_slice_keys(run_id, count))
+
+
+def _fetch_page(run_key, run_id, job, query, page_size, **options):
+  """Fetches a page of a run's query, failing the run if it cannot.
+
+  Args:
+    run_key: ndb.Key, the key of the _MapperRun.
+    run_id: str, the ID of the run.
+    job: _Job, the functions and arguments of the run.
+    query: ndb.Query, the query of the run.
+    page_size: int, the number of results to fetch.
+    **options: the options for ndb.Query.fetch_page.
+
+  Returns:
+    A tuple of the results, the cursor after them and whether there are more.
+
+  Raises:
+    deferred.PermanentTaskFailure: if the query cannot be paged with cursors,
+        so that its task is not retried.
+  """
+  try:
+    return query.fetch_page(page_size, **options)
+  except datastore_errors.BadArgumentError as err:
+    _fail_run(run_key, run_id, job, err)
+    raise deferred.PermanentTaskFailure(str(err))
+
+
+def _fail_run(run_key, run_id, job, err):
+  """Marks a run finished and failed and deletes its slices."""
+  logging.error(_RUN_FAILED_MSG, run_id, run_key.id(), err)
+
+  @ndb.transactional
+  def _fail():
+    run = _get_run(run_key, run_id)
+    if run:
+      run.finished = datetime.datetime.utcnow()
+      run.failed = True
+      run.put()
+    return run
+
+  run = _fail()
+  if run:
+    _delete_slices(run_id, run.split_slices)
+    _defer_on_finish(job)
+
+
+def _defer_on_finish(job):
+  """Defers the function a job runs once it is done, if any."""
+  if job.on_finish:
+    function, args = job.on_finish
+    deferred.defer(function, *args, _target=_TARGET)
+
+
+def _split(run_key, run_id, job):
+  """Splits a run's query results into slices and defers mapping them.
+
+  Args:
+    run_key: ndb.Key, the key of the _MapperRun.
+    run_id: str, the ID of the run.
+    job: _Job, the functions and arguments of the run.
+  """
+  run = _get_run(run_key, run_id)
+  if not run or run.slice_count is not None:
+    return
+  query = job.query_fn(*job.args)
+  for _ in range(_SPLIT_PAGES_PER_TASK):
+    keys, more = [], False
+    if query is not None:
+      start_cursor = (
+          datastore_query.Cursor(urlsafe=run.split_cursor)
+          if run.split_cursor else None)
+      keys, cursor, more = _fetch_page(
+          run_key, run_id, job, query, job.slice_size,
+          start_cursor=start_cursor, keys_only=True)
+      if keys:
+        _add_slice(
+            run_key, run_id, run.split_slices + 1, run.split_cursor,
+            cursor.urlsafe() if more else None, job)
+        run.split_slices += 1
+        run.split_cursor = cursor.urlsafe() if cursor else None
+    if not (more and keys):
+      run.slice_count = run.split_slices
+      if _save_run(run):
+        _finish_if_done(run_key, run_id, job)
+      return
+    if not _save_run(run):
+      return
+  deferred.defer(_split, run_key, run_id, job, _target=_TARGET)
+
+
+def _add_slice(run_key, run_id, number, start_cursor, end_cursor, job):
+  """Records a slice and defers mapping it.
+
+  The slice is only inserted if it does not exist and the task is named after
+  it, so a split that is retried after adding it neither resets its progress
+  nor maps it twice.
+
+  Args:
+    run_key: ndb.Key, the key of the _MapperRun.
+    run_id: str, the ID of the run.
+    number: int, the number of the slice in the run, from 1.
+    start_cursor: str, the urlsafe cursor the slice starts at, if any.
+    end_cursor: str, the urlsafe cursor the slice ends at, if any.
+    job: _Job, the functions and arguments of the run.
+  """
+  slice_ = _MapperSlice.get_or_insert(
+      '%s-%d' % (run_id, number), start_cursor=start_cursor,
+      end_cursor=end_cursor)
+  try:
+    deferred.defer(
+        _map_slice, run_key, run_id, slice_.key, job, _target=_TARGET,
+        _name='mapper-%s-%d' % (run_id, number))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _map_slice(run_key, run_id, slice_key, job):
+  """Maps a slice of a run's query results, resuming from its last page.
+
+  Args:
+    run_key: ndb.Key, the key of the _MapperRun.
+    run_id: str, the ID of the run.
+    slice_key: ndb.Key, the key of the _MapperSlice.
+    job: _Job, the functions and arguments of the run.
+  """
+  slice_ = slice_key.get()
+  if not slice_ or not _get_run(run_key, run_id):
+    return
+  query = job.query_fn(*job.args)
+  cursor = slice_.cursor or slice_.start_cursor
+  cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+  end_cursor = (
+      datastore_query.Cursor(urlsafe=slice_.end_cursor)
+      if slice_.end_cursor else None)
+
+  while not slice_.completed:
+    start = time.time()
+    entities, more = [], False
+    if query is not None:
+      entities, cursor, more = _fetch_page(
+          run_key, run_id, job, query, _PAGE_SIZE, start_cursor=cursor,
+          end_cursor=end_cursor)
+    slice_.scanned += len(entities)
+    slice_.cursor = cursor.urlsafe() if cursor else None
+    slice_.completed = not (more and entities)
+    if job.at_most_once:
+      slice_.put()
+    changed = job.map_fn(entities, *job.args) if entities else []
+    if changed:
+      _put_multi(changed)
+    slice_.updated += len(changed)
+    slice_.seconds += time.time() - start
+    slice_.put()
+  _finish_if_done(run_key, run_id, job)
+
+
+def _map_in_request(name, query, job):
+  """Maps a function over all of a query's results in this request.
+
+  Args:
+    name: str, the name of the run.
+    query: ndb.Query, the query to map over.
+    job: _Job, the functions and arguments of the run.
+  """
+  start = time.time()
+  scanned = updated = 0
+  page = []
+  try:
+    for entity in query.iter(batch_size=_PAGE_SIZE):
+      page.append(entity)
+      if len(page) == _PAGE_SIZE:
+        updated += _map_page(page, job)
+        scanned += len(page)
+        page = []
+  except datastore_errors.BadArgumentError as err:
+    logging.error(_INLINE_FAILED_MSG, name, err)
+    _defer_on_finish(job)
+    return
+  if page:
+    updated += _map_page(page, job)
+    scanned += len(page)
+  logging.info(_INLINE_DONE_MSG, name, scanned, updated, time.time() - start)
+  _defer_on_finish(job)
+
+
+def _map_page(entities, job):
+  """Maps a page of entities and puts those changed, returning their number."""
+  changed = job.map_fn(entities, *job.args)
+  if changed:
+    _put_multi(changed)
+  return len(changed or [])
+
+
+def _put_multi(entities):
+  """Puts entities in one batch, updating their search documents in bulk."""
+  put_multi_and_index = getattr(
+      type(entities[0]), 'put_multi_and_index', None)
+  if put_multi_and_index:
+    put_multi_and_index(entities)
+  else:
+    ndb.put_multi(entities)
+
+
+def _finish_if_done(run_key, run_id, job):
+  """Records and logs a run's totals once all of its slices are mapped.
+
+  Each slice is marked completed before this checks the others, so the last
+  of any slices finishing at the same time always sees them all completed.
+  The slices are looked up by key, which is strongly consistent, and deleted
+  once their totals are on the run.
+
+  Args:
+    run_key: ndb.Key, the key of the _MapperRun.
+    run_id: str, the ID of the run.
+    job: _Job, the functions and arguments of the run.
+  """
+  run = _get_run(run_key, run_id)
+  if not run or run.slice_count is None:
+    return
+  slices = ndb.get_multi(_slice_keys(run_id, run.slice_count))
+  if not all(slice_ and slice_.completed for slice_ in slices):
+    return
+  stats = RunStats(run, slices)
+
+  @ndb.transactional
+  def _finish():
+    run = _get_run(run_key, run_id)
+    if not run:
+      return None
+    run.finished = datetime.datetime.utcnow()
+    run.scanned = stats.scanned
+    run.updated = stats.updated
+    run.seconds = stats.seconds
+    run.put()
+    return run
+
+  run = _finish()
+  if run:
+    _delete_slices(run_id, run.slice_count)
+    logging.info(
+        _RUN_DONE_MSG, run_id, run_key.id(), run.scanned, run.updated,
+        run.slice_count, (run.finished - run.started).total_seconds())
+    _defer_on_finish(job)
@@ -0,0 +1,230 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.lib.mapper."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+
+import mock
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from loaner.web_app.backend.lib import mapper
+from loaner.web_app.backend.testing import loanertest
+
+
+class _TestModel(ndb.Model):
+  value = ndb.IntegerProperty()
+  mapped = ndb.BooleanProperty(default=False)
+
+
+def _query_from(minimum):
+  return _TestModel.query(_TestModel.value >= minimum)
+
+
+def _query_in(values):
+  return _TestModel.query(_TestModel.value.IN(values))
+
+
+def _query_nothing(minimum):
+  del minimum  # Unused.
+  return None
+
+
+def _mark_even(entities, minimum):
+  del minimum  # Unused.
+  changed = [
+      entity for entity in entities
+      if entity.value % 2 == 0 and not entity.mapped]
+  for entity in changed:
+    entity.mapped = True
+  return changed
+
+
+def _mapped_values():
+  return [entity.value for entity in _TestModel.query(
+      _TestModel.mapped == True)]  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
+
+
+class MapperTest(loanertest.TestCase):
+  """Tests for the sharded, resumable mapper."""
+
+  def setUp(self):
+    super(MapperTest, self).setUp()
+    ndb.put_multi([_TestModel(value=value) for value in range(10)])
+    defer_patcher = loanertest.run_deferred_immediately()
+    self.mock_defer = defer_patcher.start()
+    self.addCleanup(defer_patcher.stop)
+
+  def test_start(self):
+    run_id = mapper.start(
+        'test', _query_from, _mark_even, args=(2,), slice_size=3)
+
+    for call in self.mock_defer.call_args_list:
+      self.assertEqual(call[1]['_target'], 'action-system')
+    stats = mapper.get_stats('test')
+    self.assertEqual(stats.name, 'test')
+    self.assertEqual(stats.run_id, run_id)
+    self.assertEqual(stats.slices, 3)
+    self.assertEqual(stats.completed_slices, 3)
+    self.assertEqual(stats.scanned, 8)
+    self.assertEqual(stats.updated, 4)
+    self.assertTrue(stats.finished)
+    self.assertFalse(stats.failed)
+    self.assertCountEqual(_mapped_values(), [2, 4, 6, 8])
+    # The slices are deleted once their totals are on the run.
+    self.assertFalse(mapper._MapperSlice.query().fetch(keys_only=True))
+
+  def test_start_on_finish(self):
+    on_finish = mock.Mock(
+        side_effect=lambda _: self.assertTrue(
+            mapper.get_stats('test').finished))
+    mapper.start(
+        'test', _query_from, _mark_even, args=(2,), slice_size=3,
+        on_finish=(on_finish, ('next',)))
+
+    on_finish.assert_called_once_with('next')
+
+  def test_start_nothing_to_map(self):
+    mapper.start('test', _query_nothing, _mark_even, args=(2,))
+
+    stats = mapper.get_stats('test')
+    self.assertEqual(stats.slices, 0)
+    self.assertTrue(stats.finished)
+
+  def test_start_while_running(self):
+    self.mock_defer.side_effect = None
+    run_id = mapper.start('test', _query_from, _mark_even, args=(0,))
+
+    self.assertIsNone(mapper.start('test', _query_from, _mark_even, args=(0,)))
+    self.assertEqual(self.mock_defer.call_count, 1)
+    self.assertEqual(mapper.get_stats('test').run_id, run_id)
+
+  @mock.patch.object(mapper, '_RUN_TIMEOUT', datetime.timedelta(0))
+  def test_start_replaces_stale_run(self):
+    self.mock_defer.side_effect = None
+    mapper.start('test', _query_from, _mark_even, args=(0,))
+    stale_split_args = self.mock_defer.call_args[0]
+    run_id = mapper.start('test', _query_from, _mark_even, args=(0,))
+    self.assertIsNotNone(run_id)
+
+    # The stale run's tasks stop once it is replaced.
+    stale_split_args[0](*stale_split_args[1:])
+    self.assertEqual(self.mock_defer.call_count, 2)
+    self.assertEqual(mapper.get_stats('test').run_id, run_id)
+
+  def test_start_multi_query(self):
+    on_finish = mock.Mock()
+    self.assertIsNone(
+        mapper.start(
+            'test', _query_in, _mark_even, args=([2, 3, 4],),
+            on_finish=(on_finish, ())))
+
+    self.mock_defer.assert_called_once_with(on_finish, _target='action-system')
+    self.assertIsNone(mapper.get_stats('test'))
+    self.assertCountEqual(_mapped_values(), [2, 4])
+
+  @mock.patch.object(ndb.Query, 'fetch_page', autospec=True)
+  def test_start_bad_query(self, mock_fetch_page):
+    mock_fetch_page.side_effect = datastore_errors.BadArgumentError
+
+    on_finish = mock.Mock()
+
+    with self.assertRaises(deferred.PermanentTaskFailure):
+      mapper.start(
+          'test', _query_from, _mark_even, args=(0,),
+          on_finish=(on_finish, ()))
+    stats = mapper.get_stats('test')
+    self.assertTrue(stats.finished)
+    self.assertTrue(stats.failed)
+    on_finish.assert_called_once_with()
+
+  @mock.patch.object(mapper, '_PAGE_SIZE', 2)
+  def test_map_slice_resumes(self):
+    self.mock_defer.side_effect = None
+    mapper.start('test', _query_from, _mark_even, args=(0,))
+    split_args = self.mock_defer.call_args[0]
+    split_args[0](*split_args[1:])
+    map_args = self.mock_defer.call_args[0]
+    self.assertEqual(map_args[0], mapper._map_slice)
+    run_key, run_id, slice_key, job = map_args[1:]
+
+    # The slice task fails after its first page.
+    mock_map = mock.Mock(side_effect=[[], RuntimeError])
+    with self.assertRaises(RuntimeError):
+      mapper._map_slice(run_key, run_id, slice_key, job._replace(
+          map_fn=mock_map))
+    self.assertEqual(mapper.get_stats('test').scanned, 2)
+
+    # The retried task picks up from the page after the saved cursor.
+    mock_map = mock.Mock(return_value=[])
+    mapper._map_slice(run_key, run_id, slice_key, job._replace(
+        map_fn=mock_map))
+    self.assertEqual(
+        [entity.value for entity in mock_map.call_args_list[0][0][0]], [2, 3])
+    stats = mapper.get_stats('test')
+    self.assertEqual(stats.scanned, 10)
+    self.assertTrue(stats.finished)
+
+  @mock.patch.object(mapper, '_PAGE_SIZE', 2)
+  def test_map_slice_at_most_once(self):
+    self.mock_defer.side_effect = None
+    mapper.start(
+        'test', _query_from, _mark_even, args=(0,), at_most_once=True)
+    split_args = self.mock_defer.call_args[0]
+    split_args[0](*split_args[1:])
+    run_key, run_id, slice_key, job = self.mock_defer.call_args[0][1:]
+
+    # The slice task fails while mapping its first page.
+    mock_map = mock.Mock(side_effect=RuntimeError)
+    with self.assertRaises(RuntimeError):
+      mapper._map_slice(run_key, run_id, slice_key, job._replace(
+          map_fn=mock_map))
+
+    # The retried task skips the page rather than mapping it again.
+    mock_map = mock.Mock(return_value=[])
+    mapper._map_slice(run_key, run_id, slice_key, job._replace(
+        map_fn=mock_map))
+    self.assertEqual(
+        [entity.value for entity in mock_map.call_args_list[0][0][0]], [2, 3])
+    self.assertTrue(mapper.get_stats('test').finished)
+
+  def test_split_retried(self):
+    self.mock_defer.side_effect = None
+    run_id = mapper.start(
+        'test', _query_from, _mark_even, args=(0,), slice_size=5)
+    split_args = self.mock_defer.call_args[0]
+    # The first slice was added and started mapping before the split failed.
+    mapper._MapperSlice(id='%s-1' % run_id, cursor='cursor', scanned=2).put()
+    self.mock_defer.side_effect = [taskqueue.TaskAlreadyExistsError, None]
+    split_args[0](*split_args[1:])
+
+    self.assertEqual(mapper.get_stats('test').slices, 2)
+    first_slice = mapper._MapperSlice.get_by_id('%s-1' % run_id)
+    self.assertEqual(first_slice.cursor, 'cursor')
+    self.assertEqual(first_slice.scanned, 2)
+
+  def test_get_stats_no_run(self):
+    self.assertIsNone(mapper.get_stats('missing'))
+
+
+if __name__ == '__main__':
+  loanertest.main()
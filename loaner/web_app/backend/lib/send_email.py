@@ -23,8 +23,8 @@ import logging
 
 import html2text
 
-from google.appengine.api import taskqueue
 from loaner.web_app import constants
+from loaner.web_app.backend.lib import task_collector
 from loaner.web_app.backend.models import config_model
 
 
@@ -125,4 +125,4 @@ def _send_email(**kwargs):
     elif constants.ON_QA:
       kwargs['subject'] = '[qa] ' + kwargs['subject']
 
-  taskqueue.add(queue_name='send-email', params=kwargs, target='default')
+  task_collector.add(queue_name='send-email', params=kwargs, target='default')
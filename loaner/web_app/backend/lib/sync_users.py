@@ -18,7 +18,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import datetime
+import hashlib
 import logging
+import threading
 
 from google.appengine.ext import ndb
 
@@ -26,60 +30,163 @@ from loaner.web_app import constants
 from loaner.web_app.backend.clients import directory
 from loaner.web_app.backend.models import user_model
 
+_SUPERADMIN = 'superadmin'
+# The number of users read or written in one datastore batch.
+_BATCH_SIZE = 100
+# Groups are resynced from scratch at least this often, even when their
+# membership has not changed, to repair roles changed outside of the sync.
+_FULL_SYNC_INTERVAL = datetime.timedelta(hours=24)
+
+_GROUP_UNCHANGED_MSG = 'Membership of %s is unchanged, skipping role %r.'
+_SYNC_SUMMARY_MSG = 'Updated roles of %d users from %d changed groups.'
+
+
+class _GroupSyncState(ndb.Model):
+  """The membership of a role's group as of the last sync, keyed by role.
+
+  Attributes:
+    membership_hash: str, a hash of the group and its sorted member emails.
+    full_sync: datetime, the last time the role was synced from scratch.
+  """
+  membership_hash = ndb.StringProperty(indexed=False)
+  full_sync = ndb.DateTimeProperty(indexed=False)
+
 
 def sync_user_roles():
-  """Syncs all of the elevated user roles for each user in Google groups."""
-  logging.info('Syncing user roles.')
+  """Syncs all of the elevated user roles for each user in Google groups.
 
-  client = directory.DirectoryApiClient(constants.ADMIN_EMAIL)
-  superadmins_from_group = client.get_all_users_in_group(
-      constants.SUPERADMINS_GROUP)
-  _add_or_remove_user_roles(superadmins_from_group, 'superadmin')
+  Group memberships are fetched concurrently and compared against a hash of
+  the membership seen by the last sync, so unchanged groups cost no datastore
+  queries or writes. The role changes for the remaining groups are computed in
+  memory and applied with batched gets and puts.
+  """
+  logging.info('Syncing user roles.')
 
-  all_roles = user_model.Role.query().fetch()
-  for role in all_roles:
+  groups = {_SUPERADMIN: constants.SUPERADMINS_GROUP}
+  for role in user_model.Role.query().fetch():
     if role.associated_group:
-      users_from_group = client.get_all_users_in_group(role.associated_group)
-      _add_or_remove_user_roles(users_from_group, role.name)
+      groups[role.name] = role.associated_group
+  members = _get_group_members(groups)
+
+  now = datetime.datetime.utcnow()
+  states = dict(zip(groups, ndb.get_multi(
+      [ndb.Key(_GroupSyncState, role) for role in groups])))
+  changed = {}
+  for role, group_email in groups.items():
+    membership_hash = _membership_hash(group_email, members[role])
+    state = states[role]
+    if (state and state.membership_hash == membership_hash and
+        state.full_sync and now - state.full_sync < _FULL_SYNC_INTERVAL):
+      logging.info(_GROUP_UNCHANGED_MSG, group_email, role)
+      continue
+    changed[role] = _GroupSyncState(
+        id=role, membership_hash=membership_hash, full_sync=now)
 
+  role_changes = _get_role_changes(
+      {role: members[role] for role in changed})
+  _apply_role_changes(role_changes)
+  # Only record the new hashes once the roles they describe are written.
+  ndb.put_multi(list(changed.values()))
+  logging.info(_SYNC_SUMMARY_MSG, len(role_changes), len(changed))
 
-def _add_or_remove_user_roles(group_users, role):
-  """Add or remove a user's role based on Google group membership.
 
-  This will check the datastore users that are passed (ndb_users) against the
-  users in the Google group that are passed (group_users). It will do nothing
-  with the union of both. It will add the given role to the users that are in
-  the Google group and not in the datastore users (creating a user object in
-  datastore if nessesary). Similarly, it will remove the user permissions if
-  the ndb_users are not in group_users.
+def _get_group_members(groups):
+  """Fetches the members of many groups concurrently.
+
+  Each thread builds its own client, since the service objects it wraps are not
+  thread-safe.
 
   Args:
-    group_users: list, a list of users from a Google Group.
-    role: str, the role to add or remove from user.
+    groups: dict, role names mapped to the email of the role's group.
+
+  Returns:
+    A dict of role names mapped to the set of member emails of their group.
+
+  Raises:
+    directory.DirectoryRPCError: if fetching any group fails.
   """
-  if role == 'superadmin':
-    users_keys = user_model.User.query(
-        user_model.User.superadmin == True).fetch(keys_only=True)  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
-  else:
-    role_key = ndb.Key(user_model.Role, role)
-    users_keys = user_model.User.query(
-        user_model.User.roles.IN([role_key])).fetch(keys_only=True)
-  ndb_user_ids = [user.id() for user in users_keys]
-  users_to_add_role = set(group_users) - set(ndb_user_ids)
-  users_to_remove_role = set(ndb_user_ids) - set(group_users)
-  for user_email in users_to_add_role:
-    user = user_model.User.get_user(user_email)
-    if role == 'superadmin':
-      user.update(superadmin=True)
-    else:
-      new_roles = user.role_names
-      new_roles.append(role)
-      user.update(roles=new_roles)
-  for user_email in users_to_remove_role:
-    user = user_model.User.get_user(user_email)
-    if role == 'superadmin':
-      user.update(superadmin=False)
+  members = {}
+  errors = []
+
+  def fetch(role, group_email):
+    try:
+      client = directory.DirectoryApiClient(constants.ADMIN_EMAIL)
+      members[role] = set(client.get_all_users_in_group(group_email) or [])
+    except Exception as err:  # pylint: disable=broad-except
+      # Re-raised below, in the calling thread.
+      errors.append(err)
+
+  threads = [
+      threading.Thread(target=fetch, args=(role, group_email))
+      for role, group_email in groups.items()]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  return members
+
+
+def _membership_hash(group_email, member_emails):
+  """Returns a stable hash of a group and its members."""
+  digest = hashlib.sha1(group_email.encode('utf-8'))
+  for email in sorted(member_emails):
+    digest.update(b'\n' + email.encode('utf-8'))
+  return digest.hexdigest()
+
+
+def _get_role_changes(group_members):
+  """Computes the role changes needed to match the given group memberships.
+
+  Args:
+    group_members: dict, role names mapped to the set of emails of the users
+        that should hold the role.
+
+  Returns:
+    A dict of user emails mapped to a dict of role names mapped to True if the
+    role should be added and False if it should be removed.
+  """
+  queries = {}
+  for role in group_members:
+    if role == _SUPERADMIN:
+      query = user_model.User.query(
+          user_model.User.superadmin == True)  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
     else:
-      new_roles = user.role_names
-      new_roles.remove(role)
-      user.update(roles=new_roles)
+      query = user_model.User.query(
+          user_model.User.roles == ndb.Key(user_model.Role, role))
+    queries[role] = query.fetch_async(keys_only=True)
+
+  role_changes = collections.defaultdict(dict)
+  for role, group_users in group_members.items():
+    ndb_user_ids = set(key.id() for key in queries[role].get_result())
+    for user_email in group_users - ndb_user_ids:
+      role_changes[user_email][role] = True
+    for user_email in ndb_user_ids - group_users:
+      role_changes[user_email][role] = False
+  return role_changes
+
+
+def _apply_role_changes(role_changes):
+  """Applies role changes with batched gets and puts.
+
+  Args:
+    role_changes: dict, as returned by _get_role_changes.
+  """
+  user_emails = sorted(role_changes)
+  for start in range(0, len(user_emails), _BATCH_SIZE):
+    batch = user_emails[start:start + _BATCH_SIZE]
+    users = ndb.get_multi([ndb.Key(user_model.User, email) for email in batch])
+    for index, (email, user) in enumerate(zip(batch, users)):
+      if user is None:
+        user = users[index] = user_model.User(id=email)
+      for role, has_role in role_changes[email].items():
+        if role == _SUPERADMIN:
+          user.superadmin = has_role
+          continue
+        role_key = ndb.Key(user_model.Role, role)
+        if has_role and role_key not in user.roles:
+          user.roles.append(role_key)
+        elif not has_role and role_key in user.roles:
+          user.roles.remove(role_key)
+    ndb.put_multi(users)
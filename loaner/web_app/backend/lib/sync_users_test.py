@@ -18,8 +18,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import datetime
+
+import freezegun
 import mock
 
+from google.appengine.ext import ndb
+
 from loaner.web_app import constants
 from loaner.web_app.backend.clients import directory
 from loaner.web_app.backend.lib import sync_users
@@ -39,6 +44,7 @@ class SyncUsersTest(loanertest.EndpointsTestCase):
     mock_directory = patcher.start()
     self.addCleanup(patcher.stop)
     mock_users_for_group = mock_directory.return_value.get_all_users_in_group
+    self.mock_users_for_group = mock_users_for_group
 
     def group_client_side_effect(*args, **kwargs):  # pylint: disable=unused-argument
       if args[0] == constants.SUPERADMINS_GROUP:
@@ -101,6 +107,40 @@ class SyncUsersTest(loanertest.EndpointsTestCase):
         'keep-technician@{}'.format(loanertest.USER_DOMAIN), ['technician'],
         False)
 
+  @mock.patch.object(sync_users.ndb, 'put_multi', wraps=ndb.put_multi)
+  def test_sync_user_roles__unchanged_groups_skipped(self, mock_put_multi):
+    sync_users.sync_user_roles()
+    self.make_assertions(
+        'need-technician@{}'.format(loanertest.USER_DOMAIN), ['technician'],
+        False)
+    mock_put_multi.reset_mock()
+
+    # Roles changed outside of the sync are left alone until a full sync.
+    user_model.User.get_user(
+        'need-technician@{}'.format(loanertest.USER_DOMAIN)).update(roles=[])
+    sync_users.sync_user_roles()
+    mock_put_multi.assert_called_once_with([])
+    self.make_assertions(
+        'need-technician@{}'.format(loanertest.USER_DOMAIN), [], False)
+
+    now = datetime.datetime.utcnow()
+    with freezegun.freeze_time(now + sync_users._FULL_SYNC_INTERVAL):
+      sync_users.sync_user_roles()
+    self.make_assertions(
+        'need-technician@{}'.format(loanertest.USER_DOMAIN), ['technician'],
+        False)
+
+  def test_sync_user_roles__group_error(self):
+    self.mock_users_for_group.side_effect = directory.DirectoryRPCError
+    user_model.User.get_user(
+        'remove-superadmin@{}'.format(loanertest.USER_DOMAIN)
+    ).update(superadmin=True)
+
+    with self.assertRaises(directory.DirectoryRPCError):
+      sync_users.sync_user_roles()
+    self.make_assertions(
+        'remove-superadmin@{}'.format(loanertest.USER_DOMAIN), [], True)
+
   def make_assertions(self, user_id, roles, superadmin):
     """Asserts that users have correct roles/superadmin.
 
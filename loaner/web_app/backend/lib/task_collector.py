@@ -0,0 +1,217 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collects the tasks enqueued by a request and adds them in batches.
+
+Within a collect() block, add() holds tasks back and the block adds them with
+one Queue.add call per queue when it exits, whether or not it raised. A queue
+that reaches taskqueue.MAX_TASKS_PER_ADD held back tasks is added right away,
+so long requests do not hold on to an unbounded number of tasks. If the block
+raised, that exception is the one raised by collect(); a failure adding the
+tasks is only logged. Outside of one, add() enqueues the task right away, like
+taskqueue.add. Middleware wraps a WSGI application so that each request is a
+collect() block, except for cron requests, which enqueue their tasks as they
+go.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+import six
+
+from google.appengine.api import taskqueue
+
+_DEFAULT_QUEUE = 'default'
+# Requests under these paths are not collected by Middleware. Cron handlers
+# run long enough that a flush at the end could be cut off by the deadline.
+_UNCOLLECTED_PATH_PREFIXES = ('/_cron/',)
+
+_STATS_MSG = 'Enqueued %d tasks (%d bytes) in %.3f seconds.'
+_DROPPED_TASKS_MSG = 'Failed to add %d tasks to queue %r: %s'
+_FLUSH_AFTER_ERROR_MSG = (
+    'Failed to add the tasks of a request that raised; re-raising the '
+    'request error.')
+
+# The collector of the request being handled by the current thread, if any.
+_local = threading.local()
+
+
+class RequestStats(object):
+  """Counters for the tasks enqueued during one request.
+
+  Attributes:
+    tasks: int, the number of tasks enqueued.
+    bytes: int, the total size of the tasks enqueued.
+    seconds: float, the time spent adding tasks to their queues.
+  """
+
+  def __init__(self):
+    self.tasks = 0
+    self.bytes = 0
+    self.seconds = 0.0
+
+
+class _Collector(object):
+  """The tasks held back by a collect() block, grouped by queue."""
+
+  def __init__(self):
+    self.queues = collections.OrderedDict()
+    self.stats = RequestStats()
+
+  def add(self, queue_name, tasks, transactional=False):
+    """Adds tasks to a queue now, recording them in the counters."""
+    start = time.time()
+    try:
+      taskqueue.Queue(queue_name).add(tasks, transactional=transactional)
+    finally:
+      self.stats.seconds += time.time() - start
+    self.stats.tasks += len(tasks)
+    self.stats.bytes += sum(task.size for task in tasks)
+
+  def hold(self, queue_name, task):
+    """Holds back a task, adding its queue's batch once it is full.
+
+    Raises:
+      taskqueue.Error: if adding a full batch failed.
+    """
+    tasks = self.queues.setdefault(queue_name, [])
+    tasks.append(task)
+    if len(tasks) >= taskqueue.MAX_TASKS_PER_ADD:
+      del self.queues[queue_name]
+      self._add_batch(queue_name, tasks)
+
+  def flush(self):
+    """Adds the held back tasks with one call per queue.
+
+    Raises:
+      taskqueue.Error: if adding the tasks to any queue failed. The tasks for
+          the other queues are still added.
+    """
+    errors = []
+    for queue_name, tasks in self.queues.items():
+      try:
+        self._add_batch(queue_name, tasks)
+      except taskqueue.Error as err:
+        errors.append(err)
+    self.queues.clear()
+    if errors:
+      raise errors[0]
+
+  def _add_batch(self, queue_name, tasks):
+    """Adds held back tasks, logging their queue and number if that fails."""
+    try:
+      self.add(queue_name, tasks)
+    except taskqueue.Error as err:
+      logging.error(_DROPPED_TASKS_MSG, len(tasks), queue_name, err)
+      raise
+
+
+def add(queue_name=_DEFAULT_QUEUE, transactional=False, **kwargs):
+  """Enqueues a task, or holds it back until the current request ends.
+
+  Args:
+    queue_name: str, the name of the queue to add the task to.
+    transactional: bool, whether the task should only be enqueued if the
+        current datastore transaction commits. Transactional tasks are always
+        enqueued right away.
+    **kwargs: the arguments for the taskqueue.Task, e.g. payload or target.
+
+  Raises:
+    taskqueue.Error: if the task, or the full batch it completed, could not be
+        added.
+  """
+  collector = getattr(_local, 'collector', None)
+  if collector is None:
+    if transactional:
+      kwargs['transactional'] = True
+    taskqueue.add(queue_name=queue_name, **kwargs)
+  elif transactional:
+    collector.add(queue_name, [taskqueue.Task(**kwargs)], transactional=True)
+  else:
+    collector.hold(queue_name, taskqueue.Task(**kwargs))
+
+
+@contextlib.contextmanager
+def collect():
+  """Holds back the tasks enqueued by add() until the block exits.
+
+  A collect() block within another one collects into the outer block.
+
+  Yields:
+    The RequestStats of the outermost block, which are complete once it exits.
+
+  Raises:
+    taskqueue.Error: if the block succeeded but adding the collected tasks
+        failed.
+  """
+  collector = getattr(_local, 'collector', None)
+  if collector is not None:
+    yield collector.stats
+    return
+  collector = _local.collector = _Collector()
+  try:
+    yield collector.stats
+  except:  # pylint: disable=bare-except
+    exc_info = sys.exc_info()
+    _local.collector = None
+    try:
+      _flush(collector)
+    except taskqueue.Error:
+      logging.exception(_FLUSH_AFTER_ERROR_MSG)
+    six.reraise(*exc_info)
+  else:
+    _local.collector = None
+    _flush(collector)
+
+
+def _flush(collector):
+  """Adds a collector's held back tasks and logs its counters."""
+  try:
+    collector.flush()
+  finally:
+    if collector.stats.tasks:
+      logging.info(
+          _STATS_MSG, collector.stats.tasks, collector.stats.bytes,
+          collector.stats.seconds)
+
+
+def get_stats():
+  """Gets the counters for the request being handled.
+
+  Returns:
+    The RequestStats so far, or None outside of a collect() block.
+  """
+  collector = getattr(_local, 'collector', None)
+  return collector.stats if collector else None
+
+
+class Middleware(object):
+  """WSGI middleware adding the tasks each request enqueues in batches."""
+
+  def __init__(self, app):
+    self._app = app
+
+  def __call__(self, environ, start_response):
+    if environ.get('PATH_INFO', '').startswith(_UNCOLLECTED_PATH_PREFIXES):
+      return self._app(environ, start_response)
+    with collect():
+      return self._app(environ, start_response)
@@ -0,0 +1,151 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.lib.task_collector."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mock
+
+from google.appengine.api import taskqueue
+
+from loaner.web_app.backend.lib import task_collector
+from loaner.web_app.backend.testing import loanertest
+
+
+class TaskCollectorTest(loanertest.TestCase):
+  """Tests for the request task collector."""
+
+  def setUp(self):
+    super(TaskCollectorTest, self).setUp()
+    self.testbed.collect_patcher.stop()  # Disable patcher; use real method.
+    self.addCleanup(self.testbed.collect_patcher.start)
+    queue_patcher = mock.patch.object(taskqueue, 'Queue', autospec=True)
+    self.mock_queue = queue_patcher.start()
+    self.addCleanup(queue_patcher.stop)
+
+  def test_add_outside_collect(self):
+    task_collector.add(queue_name='send-email', params={'to': 'a'})
+    self.taskqueue_add.assert_called_once_with(
+        queue_name='send-email', params={'to': 'a'})
+    self.assertIsNone(task_collector.get_stats())
+
+  def test_collect(self):
+    with task_collector.collect() as stats:
+      task_collector.add(queue_name='process-action', payload='1')
+      task_collector.add(queue_name='send-email', params={'to': 'a'})
+      with task_collector.collect():
+        task_collector.add(queue_name='process-action', payload='2')
+      # Nothing is added until the outermost block exits.
+      self.assertFalse(self.mock_queue.called)
+      self.assertIs(task_collector.get_stats(), stats)
+
+    self.assertFalse(self.taskqueue_add.called)
+    self.assertEqual(
+        self.mock_queue.call_args_list,
+        [mock.call('process-action'), mock.call('send-email')])
+    tasks = self.mock_queue.return_value.add.call_args_list[0][0][0]
+    self.assertEqual([task.payload for task in tasks], ['1', '2'])
+    self.assertEqual(stats.tasks, 3)
+    self.assertGreater(stats.bytes, 0)
+    self.assertIsNone(task_collector.get_stats())
+
+  def test_collect_batches(self):
+    with task_collector.collect():
+      for _ in range(taskqueue.MAX_TASKS_PER_ADD + 1):
+        task_collector.add(payload='task')
+      # A full batch is added without waiting for the block to exit.
+      self.mock_queue.return_value.add.assert_called_once_with(
+          mock.ANY, transactional=False)
+      self.assertLen(
+          self.mock_queue.return_value.add.call_args[0][0],
+          taskqueue.MAX_TASKS_PER_ADD)
+    self.assertEqual(self.mock_queue.return_value.add.call_count, 2)
+
+  def test_collect_transactional(self):
+    with task_collector.collect() as stats:
+      task_collector.add(payload='task', transactional=True)
+      # Transactional tasks are added within the transaction.
+      self.mock_queue.return_value.add.assert_called_once_with(
+          mock.ANY, transactional=True)
+    self.assertEqual(stats.tasks, 1)
+
+  def test_collect_error(self):
+    self.mock_queue.return_value.add.side_effect = [
+        taskqueue.TransientError, None]
+    with self.assertRaises(taskqueue.TransientError):
+      with task_collector.collect():
+        task_collector.add(queue_name='process-action', payload='1')
+        task_collector.add(queue_name='send-email', params={'to': 'a'})
+    # The tasks for the other queue are still added.
+    self.assertEqual(self.mock_queue.return_value.add.call_count, 2)
+
+  @mock.patch.object(task_collector.logging, 'error')
+  def test_collect_error_logs_dropped_tasks(self, mock_error):
+    self.mock_queue.return_value.add.side_effect = [
+        None, taskqueue.TransientError]
+    with self.assertRaises(taskqueue.TransientError):
+      with task_collector.collect():
+        task_collector.add(queue_name='process-action', payload='1')
+        task_collector.add(queue_name='send-email', params={'to': 'a'})
+        task_collector.add(queue_name='send-email', params={'to': 'b'})
+    mock_error.assert_called_once_with(
+        task_collector._DROPPED_TASKS_MSG, 2, 'send-email', mock.ANY)
+
+  @mock.patch.object(task_collector.logging, 'exception')
+  def test_collect_error_after_block_error(self, mock_exception):
+    self.mock_queue.return_value.add.side_effect = taskqueue.TransientError
+    with self.assertRaises(ValueError):
+      with task_collector.collect():
+        task_collector.add(payload='task')
+        raise ValueError('request failed')
+    # The tasks are still added, and their failure is logged, not raised.
+    self.mock_queue.return_value.add.assert_called_once_with(
+        mock.ANY, transactional=False)
+    mock_exception.assert_called_once_with(
+        task_collector._FLUSH_AFTER_ERROR_MSG)
+    self.assertIsNone(task_collector.get_stats())
+
+  def test_middleware(self):
+    def app(environ, start_response):
+      del environ, start_response  # Unused.
+      task_collector.add(payload='task')
+      self.assertFalse(self.mock_queue.called)
+      return ['body']
+
+    middleware = task_collector.Middleware(app)
+    self.assertEqual(middleware({}, mock.Mock()), ['body'])
+    self.mock_queue.assert_called_once_with('default')
+
+  def test_middleware_cron(self):
+    def app(environ, start_response):
+      del environ, start_response  # Unused.
+      task_collector.add(payload='task')
+      self.assertIsNone(task_collector.get_stats())
+      return ['body']
+
+    middleware = task_collector.Middleware(app)
+    self.assertEqual(
+        middleware({'PATH_INFO': '/_cron/sync_user_roles'}, mock.Mock()),
+        ['body'])
+    # Cron requests enqueue their tasks right away.
+    self.taskqueue_add.assert_called_once_with(
+        queue_name='default', payload='task')
+    self.assertFalse(self.mock_queue.called)
+
+
+if __name__ == '__main__':
+  loanertest.main()
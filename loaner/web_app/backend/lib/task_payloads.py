@@ -0,0 +1,173 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact, versioned payloads for the stream-bq and process-action queues.
+
+Payloads are JSON objects tagged with a format version. Tasks enqueued before
+this format existed carry a pickled dict, so decoding falls back to pickle for
+any body that is not a JSON object.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import datetime
+import json
+import pickle
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+_VERSION = 1
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_MODEL_ARGS = ('device', 'shelf')
+
+_UNKNOWN_VERSION_MSG = 'Unsupported task payload version %r.'
+
+
+class Error(Exception):
+  """General Error class for this module."""
+
+
+class UnknownVersionError(Error):
+  """Raised when a payload was written in a format this code cannot read."""
+
+
+def encode_bigquery_row(model_instance, timestamp, actor, method, summary):
+  """Encodes a row for the stream-bq queue.
+
+  The entity is carried as its key and to_json_dict() snapshot, which is all
+  the row needs, rather than as the pickled entity.
+
+  Args:
+    model_instance: base_model.BaseModel, the instance of the affected model.
+    timestamp: datetime, a timestamp of when the change occurred.
+    actor: str, user performing the action.
+    method: str, the method name performing the action.
+    summary: str, human-readable summary of what is occurring.
+
+  Returns:
+    The payload as a str.
+  """
+  return json.dumps({
+      'v': _VERSION,
+      'key': model_instance.key.urlsafe(),
+      'model_type': type(model_instance).__name__,
+      'entity': model_instance.to_json_dict(),
+      'timestamp': timestamp.strftime(_TIMESTAMP_FORMAT),
+      'actor': actor,
+      'method': method,
+      'summary': summary,
+  }, separators=(',', ':'), sort_keys=True)
+
+
+def decode_bigquery_row(payload):
+  """Decodes a stream-bq payload.
+
+  Args:
+    payload: str, a payload from encode_bigquery_row or a legacy pickled dict.
+
+  Returns:
+    A dict of property values for a bigquery_row_model.BigQueryRow.
+
+  Raises:
+    UnknownVersionError: if the payload is from a newer format.
+  """
+  data = _loads(payload)
+  if data is None:
+    legacy = pickle.loads(payload)
+    model_instance = legacy.pop('model_instance')
+    legacy.update(
+        ndb_key=model_instance.key,
+        model_type=type(model_instance).__name__,
+        entity=model_instance.to_json_dict())
+    return legacy
+  return {
+      'ndb_key': ndb.Key(urlsafe=data['key']),
+      'model_type': data['model_type'],
+      'entity': data['entity'],
+      'timestamp': datetime.datetime.strptime(
+          data['timestamp'], _TIMESTAMP_FORMAT),
+      'actor': data['actor'],
+      'method': data['method'],
+      'summary': data['summary'],
+  }
+
+
+def encode_action(action_kwargs):
+  """Encodes an async action chain for the process-action queue.
+
+  The device or shelf is carried as its datastore protocol buffer, which keeps
+  the unsaved changes of the event that raised the chain and does not depend
+  on the pickle protocol or the module layout of a deploy.
+
+  Args:
+    action_kwargs: dict, the 'device' or 'shelf' model and the list of
+        'async_actions' still to run.
+
+  Returns:
+    The payload as a str.
+  """
+  data = {'v': _VERSION, 'async_actions': action_kwargs['async_actions']}
+  for name in _MODEL_ARGS:
+    model = action_kwargs.get(name)
+    if model is not None:
+      data[name] = base64.b64encode(
+          ndb.ModelAdapter().entity_to_pb(model).Encode())
+  return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def decode_action(payload):
+  """Decodes a process-action payload.
+
+  Args:
+    payload: str, a payload from encode_action or a legacy pickled dict.
+
+  Returns:
+    A dict with the 'device' or 'shelf' model and the 'async_actions' list.
+
+  Raises:
+    UnknownVersionError: if the payload is from a newer format.
+  """
+  data = _loads(payload)
+  if data is None:
+    return pickle.loads(payload)
+  action_kwargs = {'async_actions': data['async_actions']}
+  for name in _MODEL_ARGS:
+    if data.get(name):
+      action_kwargs[name] = ndb.ModelAdapter().pb_to_entity(
+          entity_pb.EntityProto(base64.b64decode(data[name])))
+  return action_kwargs
+
+
+def _loads(payload):
+  """Parses a versioned JSON payload.
+
+  Args:
+    payload: str, the task body.
+
+  Returns:
+    The payload as a dict, or None if it is a legacy pickled payload.
+
+  Raises:
+    UnknownVersionError: if the payload is from a newer format.
+  """
+  if not payload.startswith('{'):
+    return None
+  data = json.loads(payload)
+  if data.get('v') != _VERSION:
+    raise UnknownVersionError(_UNKNOWN_VERSION_MSG % data.get('v'))
+  return data
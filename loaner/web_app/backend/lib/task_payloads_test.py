@@ -0,0 +1,97 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.lib.task_payloads."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import json
+import pickle
+
+from loaner.web_app.backend.lib import task_payloads
+from loaner.web_app.backend.models import device_model
+from loaner.web_app.backend.models import shelf_model
+from loaner.web_app.backend.testing import loanertest
+
+
+class TaskPayloadsTest(loanertest.TestCase):
+  """Tests for the task payload format."""
+
+  def setUp(self):
+    super(TaskPayloadsTest, self).setUp()
+    self.shelf = shelf_model.Shelf(location='NYC', capacity=10)
+    self.shelf.put()
+    self.timestamp = datetime.datetime(2018, 1, 2, 3, 4, 5, 678)
+
+  def test_bigquery_row(self):
+    payload = task_payloads.encode_bigquery_row(
+        self.shelf, self.timestamp, 'user@example.com', 'enroll', 'Enrolled.')
+    self.assertEqual(json.loads(payload)['v'], task_payloads._VERSION)
+    self.assertLess(
+        len(payload),
+        len(pickle.dumps({
+            'model_instance': self.shelf, 'timestamp': self.timestamp,
+            'actor': 'user@example.com', 'method': 'enroll',
+            'summary': 'Enrolled.'})))
+
+    self.assertEqual(
+        task_payloads.decode_bigquery_row(payload), {
+            'ndb_key': self.shelf.key,
+            'model_type': 'Shelf',
+            'entity': self.shelf.to_json_dict(),
+            'timestamp': self.timestamp,
+            'actor': 'user@example.com',
+            'method': 'enroll',
+            'summary': 'Enrolled.',
+        })
+
+  def test_bigquery_row_legacy(self):
+    payload = pickle.dumps({
+        'model_instance': self.shelf, 'timestamp': self.timestamp,
+        'actor': 'user@example.com', 'method': 'enroll',
+        'summary': 'Enrolled.'})
+    decoded = task_payloads.decode_bigquery_row(payload)
+    self.assertEqual(decoded['ndb_key'], self.shelf.key)
+    self.assertEqual(decoded['model_type'], 'Shelf')
+    self.assertEqual(decoded['entity'], self.shelf.to_json_dict())
+    self.assertEqual(decoded['method'], 'enroll')
+
+  def test_action(self):
+    device = device_model.Device(serial_number='123456', enrolled=True)
+    payload = task_payloads.encode_action(
+        {'device': device, 'shelf': None, 'async_actions': ['action']})
+
+    decoded = task_payloads.decode_action(payload)
+    self.assertEqual(decoded['async_actions'], ['action'])
+    self.assertNotIn('shelf', decoded)
+    # Unsaved changes travel with the payload.
+    self.assertEqual(decoded['device'].serial_number, '123456')
+    self.assertTrue(decoded['device'].enrolled)
+
+  def test_action_legacy(self):
+    payload = pickle.dumps({'shelf': self.shelf, 'async_actions': ['action']})
+    decoded = task_payloads.decode_action(payload)
+    self.assertEqual(decoded['shelf'].key, self.shelf.key)
+    self.assertEqual(decoded['async_actions'], ['action'])
+
+  def test_unknown_version(self):
+    with self.assertRaises(task_payloads.UnknownVersionError):
+      task_payloads.decode_action(json.dumps({'v': 2, 'async_actions': []}))
+
+
+if __name__ == '__main__':
+  loanertest.main()
@@ -19,10 +19,24 @@ from __future__ import division
 from __future__ import print_function
 
 import calendar
+import collections
+import copy
+import os
+import threading
+import time
+
 import yaml
 
 from loaner.web_app import constants
 
+try:
+  from collections import abc as collections_abc  # pylint: disable=g-import-not-at-top
+except ImportError:
+  collections_abc = collections
+
+# The C loader is much faster but is only present when libyaml is installed.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def datetime_to_unix(timestamp, milliseconds=False):
   """Converts a datetime object to a unix timestamp.
@@ -53,11 +67,139 @@ def is_weekend_or_monday(date):
 
 
 def load_config_from_yaml():
-  """Opens the config_defaults yaml file.
+  """Loads the config_defaults yaml file.
+
+  The parsed file is cached for the life of the process and only parsed again
+  when the file's modification time changes.
 
   Returns:
-    A dictionary of the default data from the yaml file.
+    A read-only mapping of the default data from the yaml file.
   """
   yaml_path = constants.CONFIG_DEFAULTS_PATH
-  with open(yaml_path) as data:
-    return yaml.safe_load(data)
+  mtime = os.path.getmtime(yaml_path)
+  with _config_defaults.lock:
+    if _config_defaults.values is None or _config_defaults.mtime != mtime:
+      with open(yaml_path) as data:
+        _config_defaults.values = ReadOnlyDict(
+            yaml.load(data, Loader=_YAML_LOADER))
+      _config_defaults.mtime = mtime
+    return _config_defaults.values
+
+
+class _ConfigDefaultsCache(object):
+  """The parsed config_defaults yaml file and the mtime it was parsed at."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.values = None
+    self.mtime = None
+
+
+_config_defaults = _ConfigDefaultsCache()
+
+
+class ReadOnlyDict(collections_abc.Mapping):
+  """A read-only mapping that hands out copies of mutable values.
+
+  Values that are lists or dictionaries are copied on every read, so a caller
+  changing the value it was given cannot change what later callers see.
+  """
+
+  def __init__(self, values):
+    """Initializes the mapping.
+
+    Args:
+      values: dict, the values to hold; the dictionary itself is copied.
+    """
+    self._values = dict(values)
+
+  def __getitem__(self, key):
+    value = self._values[key]
+    if isinstance(value, (list, dict)):
+      return copy.deepcopy(value)
+    return value
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self._values)
+
+
+class LRUCache(object):
+  """A small thread-safe, in-process least recently used cache.
+
+  Instances live for the life of an App Engine instance, so anything stored in
+  one may be stale and must be verified or tolerated by the caller, or stored
+  with a ttl to bound how stale it can be.
+  """
+
+  def __init__(self, max_size):
+    """Initializes the cache.
+
+    Args:
+      max_size: int, the maximum number of entries to hold.
+    """
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    """Returns the value for key, marking it as recently used.
+
+    Args:
+      key: hashable, the key to look up.
+      default: the value to return when the key is not cached.
+
+    Returns:
+      The cached value, or default.
+    """
+    with self._lock:
+      try:
+        value, expires = self._entries.pop(key)
+      except KeyError:
+        return default
+      if expires is not None and time.time() >= expires:
+        return default
+      self._entries[key] = (value, expires)
+      return value
+
+  def set(self, key, value, ttl=None):
+    """Stores a value, evicting the least recently used entry when full.
+
+    Args:
+      key: hashable, the key to store.
+      value: the value to store.
+      ttl: int, the number of seconds the value may be served for, or None
+          to keep it until it is evicted.
+    """
+    expires = time.time() + ttl if ttl is not None else None
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, expires)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    """Removes a key from the cache if present.
+
+    Args:
+      key: hashable, the key to remove.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    """Removes all entries from the cache."""
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
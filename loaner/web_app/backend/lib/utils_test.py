@@ -19,6 +19,9 @@ from __future__ import division
 from __future__ import print_function
 
 import datetime
+
+import mock
+
 from loaner.web_app.backend.lib import utils
 from loaner.web_app.backend.testing import loanertest
 
@@ -52,6 +55,57 @@ class UtilsTest(loanertest.TestCase):
     date = datetime.datetime(2017, 10, 18)  # Wednesday.
     self.assertFalse(utils.is_weekend_or_monday(date))
 
+  def test_lru_cache(self):
+    cache = utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    # 'b' is now the least recently used entry and is evicted.
+    cache.set('c', 3)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('c'), 3)
+    self.assertEqual(len(cache), 2)
+
+    cache.delete('a')
+    self.assertEqual(cache.get('a', 'missing'), 'missing')
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+
+  def test_lru_cache_ttl(self):
+    cache = utils.LRUCache(2)
+    with mock.patch.object(utils.time, 'time', return_value=100):
+      cache.set('a', 1, ttl=10)
+      cache.set('b', 2)
+    with mock.patch.object(utils.time, 'time', return_value=109):
+      self.assertEqual(cache.get('a'), 1)
+    with mock.patch.object(utils.time, 'time', return_value=110):
+      self.assertIsNone(cache.get('a'))
+      self.assertEqual(cache.get('b'), 2)
+
+  def test_load_config_from_yaml(self):
+    utils._config_defaults.clear()
+    config_defaults = utils.load_config_from_yaml()
+    self.assertIn('return_grace_period', config_defaults)
+    with mock.patch.object(utils.yaml, 'load') as mock_load:
+      self.assertIs(utils.load_config_from_yaml(), config_defaults)
+      self.assertFalse(mock_load.called)
+
+  def test_load_config_from_yaml_reloads_on_mtime_change(self):
+    utils._config_defaults.clear()
+    with mock.patch.object(utils.os.path, 'getmtime', return_value=1):
+      config_defaults = utils.load_config_from_yaml()
+    with mock.patch.object(utils.os.path, 'getmtime', return_value=2):
+      self.assertIsNot(utils.load_config_from_yaml(), config_defaults)
+
+  def test_read_only_dict(self):
+    read_only = utils.ReadOnlyDict({'list': ['a'], 'int': 1})
+    read_only['list'].append('b')
+    self.assertEqual(read_only['list'], ['a'])
+    self.assertEqual(dict(read_only), {'list': ['a'], 'int': 1})
+    with self.assertRaises(TypeError):
+      read_only['int'] = 2  # pylint: disable=unsupported-assignment-operation
+
 
 if __name__ == '__main__':
   loanertest.main()
@@ -20,24 +20,56 @@ from __future__ import division
 from __future__ import print_function
 
 import datetime
-import inspect
+import hashlib
 import logging
 import numbers
-import pickle
 import string
+import sys
+import time
+import uuid
 
 from protorpc import messages
 import six
 
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.api import taskqueue
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
+from loaner.web_app import constants
+from loaner.web_app.backend.lib import task_collector
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.lib import utils
 
 _PUT_DOC_ERR_MSG = 'Error putting a document (%s) into the index (%s).'
 _REMOVE_DOC_ERR_MSG = 'Error removing document with id: %s'
 _CREATE_DOC_ERR_MSG = 'Unable to create document for %s.'
+_INDEX_THROUGHPUT_MSG = (
+    'Indexed %d document(s) into %s with %d put RPC(s) in %.2fs (%.1f docs/s).')
+# The number of times documents that failed with a transient error are retried.
+_TRANSIENT_PUT_RETRIES = 2
+# The default number of shards a sharded reindex splits a kind into.
+_REINDEX_SHARDS = 8
+# The number of __scatter__ keys sampled per shard to pick split points.
+_SCATTER_OVERSAMPLING = 32
+# The number of pages a shard task indexes before continuing in a new task.
+_REINDEX_PAGES_PER_TASK = 10
+_REINDEX_START_MSG = 'Reindexing %s in %d shard(s) with run ID %s.'
+_REINDEX_SHARD_DONE_MSG = 'Shard %s finished indexing %d document(s).'
+# The pull queue holding keys of entities waiting for a write-behind index.
+_INDEX_QUEUE = 'search-index'
+_INDEX_PENDING_NAMESPACE = 'search_index_pending'
+_INDEX_LEASE_SECONDS = 60
+_INDEX_LEASE_MAX_TASKS = 1000
+# Fingerprints of the last document put for each entity, used to skip puts of
+# unchanged documents. They are keyed by the index's current generation, which
+# changes whenever the index is cleared or rebuilt, so documents removed from
+# the index are put again by the next put of their entity.
+_INDEX_FINGERPRINT_NAMESPACE = 'search_index_fingerprint'
+_INDEX_FINGERPRINT_TTL = 24 * 60 * 60  # 1 day in seconds.
+_INDEX_GENERATION_NAMESPACE = 'search_index_generation'
 
 
 class Error(Exception):
@@ -52,35 +84,68 @@ class SearchQueryError(Error):
   """Raised when attempting to search the index fails."""
 
 
+class SearchReindexCheckpoint(ndb.Model):
+  """Datastore model recording the progress of one search reindex shard.
+
+  Attributes:
+    run_id: str, the ID of the reindex run the shard belongs to.
+    start_key: ndb.Key, the inclusive lower bound of the shard's key range.
+    end_key: ndb.Key, the exclusive upper bound of the shard's key range.
+    cursor: str, the websafe cursor of the next page to index.
+    indexed_count: int, the number of documents the shard has indexed.
+    completed: bool, whether the shard has indexed its whole key range.
+    modified: datetime, when the checkpoint was last updated.
+  """
+  run_id = ndb.StringProperty(required=True)
+  start_key = ndb.KeyProperty()
+  end_key = ndb.KeyProperty()
+  cursor = ndb.StringProperty(indexed=False)
+  indexed_count = ndb.IntegerProperty(default=0)
+  completed = ndb.BooleanProperty(default=False)
+  modified = ndb.DateTimeProperty(auto_now=True)
+
+
 class BaseModel(ndb.Model):
   """Base model class for the loaner project."""
 
   _INDEX_NAME = None
   _SEARCH_PARAMETERS = None
   _SEARCH_ASCII = frozenset(set(string.printable) - set(string.whitespace))
-
-  def stream_to_bq(self, user, summary, timestamp=None):
-    """Creates a task to stream an update to BigQuery.
+  # Whether puts update the search index synchronously or enqueue the entity
+  # for the batched write-behind indexer.
+  _INDEX_WRITE_BEHIND = False
+  # Seconds within which repeated write-behind puts of an entity coalesce.
+  _INDEX_WRITE_BEHIND_WINDOW = 10
+  # Names of date fields that change often, such as heartbeats. The document
+  # fingerprint only hashes them rounded down to _VOLATILE_INDEX_REFRESH
+  # seconds, so puts that only move them within that window skip the search
+  # index, and their indexed values are at most that old.
+  _VOLATILE_INDEX_FIELDS = frozenset()
+  _VOLATILE_INDEX_REFRESH = 10 * 60  # 10 minutes in seconds.
+  # Cleared on an instance while put_multi_and_index indexes it in a batch.
+  _index_on_put = True
+
+  def stream_to_bq(self, user, summary, timestamp=None, method=None):
+    """Queues an update to be streamed to BigQuery by the next flush.
 
     Args:
       user: string user email of the acting user.
       summary: string summary of the action being performed.
       timestamp: datetime, if not provided current time will be used.
+      method: string name of the method performing the action, if not provided
+          the name of the calling function will be used.
     """
     if not timestamp:
       timestamp = datetime.datetime.utcnow()
-    calling_function = inspect.stack()[1][3]
-    task_params = {
-        'model_instance': self,
-        'timestamp': timestamp,
-        'actor': user,
-        'method': calling_function,
-        'summary': summary,
-    }
-    taskqueue.add(
-        queue_name='stream-bq',
-        payload=pickle.dumps(task_params),
-        target='default')
+    if not method:
+      # Only the caller's code object is needed, so avoid inspect.stack(),
+      # which builds a record and reads source lines for every frame.
+      method = sys._getframe(1).f_code.co_name  # pylint: disable=protected-access
+    task_collector.add(
+        queue_name=constants.BIGQUERY_ROW_QUEUE,
+        payload=task_payloads.encode_bigquery_row(
+            self, timestamp, user, method, summary),
+        method='PULL')
 
   def to_json_dict(self):
     """Converts entity to a JSON-friendly dict.
@@ -93,7 +158,11 @@ class BaseModel(ndb.Model):
   @classmethod
   def index_entities_for_search(cls):
     """Indexes all entities of a model for search."""
+    cls._reset_index_generation()
     page_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    start_time = time.time()
+    doc_count = 0
+    rpc_count = 0
     entities, next_cursor, additional_results = (
         cls.query().fetch_page(page_size=page_size, start_cursor=None))
     while True:
@@ -103,13 +172,310 @@ class BaseModel(ndb.Model):
           search_documents.append(entity.to_document())
         except DocumentCreationError:
           logging.error(_CREATE_DOC_ERR_MSG, entity.key)
-      cls.add_docs_to_index(search_documents)
+      rpc_count += cls.add_docs_to_index(search_documents)
+      doc_count += len(search_documents)
       if additional_results:
         entities, next_cursor, additional_results = (
             cls.query().fetch_page(
                 page_size=page_size, start_cursor=next_cursor))
       else:
         break
+    _log_index_throughput(cls._INDEX_NAME, doc_count, rpc_count, start_time)
+
+  @classmethod
+  def reindex_in_shards(cls, num_shards=_REINDEX_SHARDS):
+    """Indexes all entities of a model for search using parallel shards.
+
+    The key space is split into ranges using keys sampled from the __scatter__
+    property, and each range is indexed by its own deferred task. Progress is
+    recorded in a SearchReindexCheckpoint per shard so a failed shard task
+    resumes from its last indexed page instead of starting over.
+
+    Args:
+      num_shards: int, the maximum number of shards to split the kind into.
+
+    Returns:
+      The run ID of the reindex.
+    """
+    run_id = uuid.uuid4().hex
+    cls._reset_index_generation()
+    boundaries = [None] + cls._get_split_keys(num_shards) + [None]
+    checkpoints = []
+    for shard_number in range(len(boundaries) - 1):
+      checkpoints.append(SearchReindexCheckpoint(
+          id='%s-%d' % (cls._get_kind(), shard_number),
+          run_id=run_id,
+          start_key=boundaries[shard_number],
+          end_key=boundaries[shard_number + 1]))
+    ndb.put_multi(checkpoints)
+    logging.info(_REINDEX_START_MSG, cls._get_kind(), len(checkpoints), run_id)
+    for checkpoint in checkpoints:
+      deferred.defer(cls.index_shard_for_search, checkpoint.key, run_id)
+    return run_id
+
+  @classmethod
+  def _get_split_keys(cls, num_shards):
+    """Picks keys that split the kind into roughly equal key ranges.
+
+    Args:
+      num_shards: int, the maximum number of shards to split the kind into.
+
+    Returns:
+      A sorted list of at most num_shards - 1 distinct ndb.Keys.
+    """
+    scatter_keys = cls.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            num_shards * _SCATTER_OVERSAMPLING, keys_only=True)
+    scatter_keys.sort()
+    split_keys = []
+    for shard_number in range(1, num_shards):
+      index = len(scatter_keys) * shard_number // num_shards
+      if index < len(scatter_keys) and (
+          not split_keys or split_keys[-1] != scatter_keys[index]):
+        split_keys.append(scatter_keys[index])
+    return split_keys
+
+  @classmethod
+  def index_shard_for_search(cls, checkpoint_key, run_id):
+    """Indexes the entities in one shard's key range, resuming if needed.
+
+    Args:
+      checkpoint_key: ndb.Key, the key of the shard's SearchReindexCheckpoint.
+      run_id: str, the ID of the reindex run the task was created for. Tasks
+          from a superseded run stop without indexing.
+    """
+    checkpoint = checkpoint_key.get()
+    if not checkpoint or checkpoint.run_id != run_id or checkpoint.completed:
+      return
+    query = cls.query()
+    if checkpoint.start_key:
+      query = query.filter(cls._key >= checkpoint.start_key)
+    if checkpoint.end_key:
+      query = query.filter(cls._key < checkpoint.end_key)
+    query = query.order(cls._key)
+    cursor = None
+    if checkpoint.cursor:
+      cursor = datastore_query.Cursor(urlsafe=checkpoint.cursor)
+
+    page_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    for _ in range(_REINDEX_PAGES_PER_TASK):
+      entities, cursor, additional_results = query.fetch_page(
+          page_size=page_size, start_cursor=cursor)
+      search_documents = []
+      for entity in entities:
+        try:
+          search_documents.append(entity.to_document())
+        except DocumentCreationError:
+          logging.error(_CREATE_DOC_ERR_MSG, entity.key)
+      cls.add_docs_to_index(search_documents)
+      checkpoint.indexed_count += len(search_documents)
+      checkpoint.cursor = cursor.urlsafe() if cursor else None
+      checkpoint.completed = not additional_results
+      checkpoint.put()
+      if checkpoint.completed:
+        logging.info(
+            _REINDEX_SHARD_DONE_MSG, checkpoint_key.id(),
+            checkpoint.indexed_count)
+        return
+    deferred.defer(cls.index_shard_for_search, checkpoint_key, run_id)
+
+  def update_search_index(self):
+    """Updates the entity's search document after a put.
+
+    Models with _INDEX_WRITE_BEHIND set only enqueue the entity's key, and the
+    document is rebuilt and put in bulk by index_pending_entities.
+    """
+    if not self._index_on_put:
+      return
+    if self._INDEX_WRITE_BEHIND:
+      self._enqueue_for_index()
+      return
+    documents, fingerprints = self._get_changed_documents([self.to_document()])
+    if documents:
+      self.get_index().put(documents)
+      memcache.set_multi(
+          fingerprints, time=_INDEX_FINGERPRINT_TTL,
+          namespace=_INDEX_FINGERPRINT_NAMESPACE)
+
+  @classmethod
+  def put_multi_and_index(cls, entities):
+    """Puts entities and updates their search documents as one batch.
+
+    The search index update each put would make on its own is suppressed, and
+    the changed documents are put together with add_docs_to_index instead.
+
+    Args:
+      entities: List[BaseModel], the entities of this model to put.
+
+    Returns:
+      The list of keys of the entities put.
+    """
+    for entity in entities:
+      entity._index_on_put = False  # pylint: disable=protected-access
+    try:
+      keys = ndb.put_multi(entities)
+    finally:
+      for entity in entities:
+        del entity._index_on_put  # pylint: disable=protected-access
+    if cls._INDEX_WRITE_BEHIND:
+      for entity in entities:
+        entity._enqueue_for_index()  # pylint: disable=protected-access
+    else:
+      search_documents = []
+      for entity in entities:
+        try:
+          search_documents.append(entity.to_document())
+        except DocumentCreationError:
+          logging.error(_CREATE_DOC_ERR_MSG, entity.key)
+      cls._put_changed_documents(search_documents)
+    return keys
+
+  def _enqueue_for_index(self):
+    """Enqueues the entity's key for the write-behind indexer.
+
+    Repeated puts of the same entity within the write-behind window only
+    enqueue the key once, and every key enqueued before a window boundary is
+    picked up by the single indexer task named for that boundary.
+    """
+    window = self._INDEX_WRITE_BEHIND_WINDOW
+    urlsafe_key = six.ensure_str(self.key.urlsafe())
+    if not memcache.add(
+        urlsafe_key, True, time=window, namespace=_INDEX_PENDING_NAMESPACE):
+      return
+    kind = self._get_kind()
+    taskqueue.Queue(_INDEX_QUEUE).add(
+        taskqueue.Task(payload=urlsafe_key, method='PULL', tag=kind))
+    boundary = (int(time.time()) // window + 1) * window
+    try:
+      deferred.defer(
+          type(self).index_pending_entities,
+          _name='index-%s-%d' % (kind, boundary),
+          _eta=datetime.datetime.utcfromtimestamp(boundary))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # The indexer for this window boundary is already scheduled.
+      pass
+
+  @classmethod
+  def index_pending_entities(cls):
+    """Rebuilds and puts the search documents of write-behind entities."""
+    queue = taskqueue.Queue(_INDEX_QUEUE)
+    while True:
+      tasks = queue.lease_tasks_by_tag(
+          _INDEX_LEASE_SECONDS, _INDEX_LEASE_MAX_TASKS, tag=cls._get_kind())
+      if not tasks:
+        return
+      urlsafe_keys = sorted(set(six.ensure_str(task.payload) for task in tasks))
+      # Clear the pending markers first so puts made while this batch is being
+      # indexed are enqueued again rather than coalesced into this batch.
+      memcache.delete_multi(urlsafe_keys, namespace=_INDEX_PENDING_NAMESPACE)
+      entities = ndb.get_multi(
+          [ndb.Key(urlsafe=urlsafe_key) for urlsafe_key in urlsafe_keys])
+      search_documents = []
+      for entity in entities:
+        if entity is None:
+          continue
+        try:
+          search_documents.append(entity.to_document())
+        except DocumentCreationError:
+          logging.error(_CREATE_DOC_ERR_MSG, entity.key)
+      cls._put_changed_documents(search_documents)
+      queue.delete_tasks(tasks)
+      if len(tasks) < _INDEX_LEASE_MAX_TASKS:
+        return
+
+  @classmethod
+  def _put_changed_documents(cls, documents):
+    """Puts the documents that changed since they were last put, in batches.
+
+    Args:
+      documents: List[search.Document], the documents to put.
+    """
+    documents, fingerprints = cls._get_changed_documents(documents)
+    cls.add_docs_to_index(documents)
+    memcache.set_multi(
+        fingerprints, time=_INDEX_FINGERPRINT_TTL,
+        namespace=_INDEX_FINGERPRINT_NAMESPACE)
+
+  @classmethod
+  def _get_changed_documents(cls, documents):
+    """Filters out documents identical to the ones last put for the entity.
+
+    Args:
+      documents: List[search.Document], the documents about to be put.
+
+    Returns:
+      A tuple of the documents whose fingerprint changed and a dictionary of
+      their new fingerprints keyed by _get_fingerprint_key.
+    """
+    generation = cls._get_index_generation()
+    fingerprints = {
+        cls._get_fingerprint_key(generation, document.doc_id):
+        cls._get_document_fingerprint(document)
+        for document in documents}
+    last_fingerprints = memcache.get_multi(
+        list(fingerprints), namespace=_INDEX_FINGERPRINT_NAMESPACE)
+    changed_fingerprints = {
+        key: fingerprint for key, fingerprint in six.iteritems(fingerprints)
+        if last_fingerprints.get(key) != fingerprint}
+    changed_documents = [
+        document for document in documents
+        if cls._get_fingerprint_key(generation, document.doc_id)
+        in changed_fingerprints]
+    return changed_documents, changed_fingerprints
+
+  @staticmethod
+  def _get_fingerprint_key(generation, doc_id):
+    """Gets the memcache key of a document's fingerprint in a generation."""
+    return '%s:%s' % (generation, doc_id)
+
+  @classmethod
+  def _get_index_generation(cls):
+    """Gets the current generation of the model's index.
+
+    A generation evicted from memcache is replaced by a new one, which only
+    costs unchanged documents one more put.
+
+    Returns:
+      The generation as a str.
+    """
+    generation = memcache.get(
+        cls._INDEX_NAME, namespace=_INDEX_GENERATION_NAMESPACE)
+    if generation is None:
+      memcache.add(
+          cls._INDEX_NAME, uuid.uuid4().hex,
+          namespace=_INDEX_GENERATION_NAMESPACE)
+      generation = memcache.get(
+          cls._INDEX_NAME, namespace=_INDEX_GENERATION_NAMESPACE)
+    return generation
+
+  @classmethod
+  def _reset_index_generation(cls):
+    """Starts a new generation of the index, forgetting all fingerprints."""
+    memcache.set(
+        cls._INDEX_NAME, uuid.uuid4().hex,
+        namespace=_INDEX_GENERATION_NAMESPACE)
+
+  @classmethod
+  def _get_document_fingerprint(cls, document):
+    """Hashes the fields of a search document, coarsening volatile dates.
+
+    Args:
+      document: search.Document, the document to fingerprint.
+
+    Returns:
+      A hex digest string of the document's fields.
+    """
+    fields = []
+    for field in document.fields:
+      value = field.value
+      if isinstance(value, search.GeoPoint):
+        value = (value.latitude, value.longitude)
+      elif (field.name in cls._VOLATILE_INDEX_FIELDS and
+            isinstance(value, datetime.datetime)):
+        value = utils.datetime_to_unix(value) // cls._VOLATILE_INDEX_REFRESH
+      fields.append((field.name, type(field).__name__, six.text_type(value)))
+    return hashlib.sha1(
+        six.ensure_binary(repr(sorted(fields)))).hexdigest()
 
   @classmethod
   def get_index(cls):
@@ -120,19 +486,45 @@ class BaseModel(ndb.Model):
   def add_docs_to_index(cls, documents):
     """Adds a list of documents to a particular index.
 
+    Documents are put in batches of search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST,
+    one RPC per batch. When a batch fails, only the documents whose results
+    were a TRANSIENT_ERROR are retried.
+
     Args:
       documents: a list of search.Documents to add to the class' index.
+
+    Returns:
+      The number of put RPCs made to the Search API.
     """
     index = cls.get_index()
-    for doc in documents:
-      try:
-        index.put(doc)
-      except search.PutError as err:
-        result = err.results[0]
-        if result.code == search.OperationResult.TRANSIENT_ERROR:
-          index.put(doc)
-      except (search.Error, apiproxy_errors.OverQuotaError):
-        logging.error(_PUT_DOC_ERR_MSG, doc, index)
+    batch_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    rpc_count = 0
+    for start in range(0, len(documents), batch_size):
+      batch = documents[start:start + batch_size]
+      retries = 0
+      while batch:
+        rpc_count += 1
+        try:
+          index.put(batch)
+        except search.PutError as err:
+          transient_docs = []
+          for doc, result in zip(batch, err.results):
+            if result.code == search.OperationResult.TRANSIENT_ERROR:
+              transient_docs.append(doc)
+            elif result.code != search.OperationResult.OK:
+              logging.error(_PUT_DOC_ERR_MSG, doc, index)
+          if retries >= _TRANSIENT_PUT_RETRIES:
+            for doc in transient_docs:
+              logging.error(_PUT_DOC_ERR_MSG, doc, index)
+            break
+          retries += 1
+          batch = transient_docs
+        except (search.Error, apiproxy_errors.OverQuotaError):
+          logging.error(_PUT_DOC_ERR_MSG, batch, index)
+          break
+        else:
+          break
+    return rpc_count
 
   @classmethod
   def get_doc_by_id(cls, doc_id):
@@ -153,6 +545,9 @@ class BaseModel(ndb.Model):
     Args:
       doc_id: str, the document id to be removed.
     """
+    memcache.delete(
+        cls._get_fingerprint_key(cls._get_index_generation(), doc_id),
+        namespace=_INDEX_FINGERPRINT_NAMESPACE)
     try:
       cls.get_index().delete(doc_id)
     except search.DeleteError:
@@ -161,6 +556,7 @@ class BaseModel(ndb.Model):
   @classmethod
   def clear_index(cls):
     """Clears the index of all documents."""
+    cls._reset_index_generation()
     index = cls.get_index()
     try:
       while True:
@@ -315,6 +711,22 @@ class BaseModel(ndb.Model):
     return ':'.join((expected_parameter, query_value))
 
 
+def _log_index_throughput(index_name, doc_count, rpc_count, start_time):
+  """Logs the throughput of a bulk index operation.
+
+  Args:
+    index_name: str, the name of the index the documents were put into.
+    doc_count: int, the number of documents put.
+    rpc_count: int, the number of put RPCs made to the Search API.
+    start_time: float, the time.time() at which the operation started.
+  """
+  elapsed = time.time() - start_time
+  docs_per_second = doc_count / elapsed if elapsed else float(doc_count)
+  logging.info(
+      _INDEX_THROUGHPUT_MSG, doc_count, index_name, rpc_count, elapsed,
+      docs_per_second)
+
+
 def _sanitize_dict(entity_dict):
   """Sanitizes select values of an entity-derived dictionary."""
   for key, value in six.iteritems(entity_dict):
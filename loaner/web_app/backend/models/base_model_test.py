@@ -27,6 +27,7 @@ import six
 from google.appengine.api import search
 from google.appengine.ext import ndb
 
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import base_model
 from loaner.web_app.backend.models import shelf_model
 from loaner.web_app.backend.testing import loanertest
@@ -71,6 +72,25 @@ class BaseModelTest(loanertest.TestCase, parameterized.TestCase):
         'test@{}'.format(loanertest.USER_DOMAIN), 'Test stream')
 
     self.assertTrue(mock_taskqueue.add.called)
+    task_params = task_payloads.decode_bigquery_row(
+        mock_taskqueue.add.call_args[1]['payload'])
+    self.assertEqual(task_params['method'], 'test_stream_to_bq')
+    self.assertEqual(task_params['ndb_key'], test_shelf.key)
+    self.assertEqual(task_params['model_type'], 'Shelf')
+    self.assertEqual(task_params['entity'], test_shelf.to_json_dict())
+
+  @mock.patch.object(base_model, 'taskqueue')
+  def test_stream_to_bq_explicit_method(self, mock_taskqueue):
+    test_shelf = shelf_model.Shelf(location='Here', capacity=16)
+    test_shelf.put()
+
+    test_shelf.stream_to_bq(
+        'test@{}'.format(loanertest.USER_DOMAIN), 'Test stream',
+        method='enroll')
+
+    task_params = task_payloads.decode_bigquery_row(
+        mock_taskqueue.add.call_args[1]['payload'])
+    self.assertEqual(task_params['method'], 'enroll')
 
   def test_to_json_dict(self):
     entity = TestEntity(test_string='Hello', test_geopt=ndb.GeoPt(50, 100))
@@ -112,6 +132,182 @@ class BaseModelTest(loanertest.TestCase, parameterized.TestCase):
     mock_logging.error.assert_called_once_with(
         base_model._CREATE_DOC_ERR_MSG, entity)
 
+  @mock.patch.object(base_model, 'deferred', autospec=True)
+  @mock.patch.object(Test, '_get_split_keys', autospec=True)
+  def test_reindex_in_shards(self, mock_get_split_keys, mock_deferred):
+    split_key = ndb.Key('Test', 5)
+    mock_get_split_keys.return_value = [split_key]
+    run_id = Test.reindex_in_shards(num_shards=2)
+
+    checkpoints = base_model.SearchReindexCheckpoint.query().fetch()
+    self.assertLen(checkpoints, 2)
+    first, second = sorted(checkpoints, key=lambda c: c.key.id())
+    self.assertEqual(first.run_id, run_id)
+    self.assertIsNone(first.start_key)
+    self.assertEqual(first.end_key, split_key)
+    self.assertEqual(second.start_key, split_key)
+    self.assertIsNone(second.end_key)
+    mock_deferred.defer.assert_has_calls([
+        mock.call(Test.index_shard_for_search, first.key, run_id),
+        mock.call(Test.index_shard_for_search, second.key, run_id)],
+                                         any_order=True)
+
+  @mock.patch.object(base_model, 'deferred', autospec=True)
+  @mock.patch.object(Test, 'add_docs_to_index', return_value=1)
+  def test_index_shard_for_search(self, mock_add_docs, mock_deferred):
+    keys = [Test(id=i, text_field='item_%d' % i).put() for i in range(1, 5)]
+    checkpoint_key = base_model.SearchReindexCheckpoint(
+        id='Test-0', run_id='run', start_key=keys[1], end_key=keys[3]).put()
+
+    Test.index_shard_for_search(checkpoint_key, 'run')
+
+    indexed_ids = [doc.doc_id for doc in mock_add_docs.call_args[0][0]]
+    self.assertCountEqual(
+        indexed_ids, [keys[1].urlsafe(), keys[2].urlsafe()])
+    checkpoint = checkpoint_key.get()
+    self.assertTrue(checkpoint.completed)
+    self.assertEqual(checkpoint.indexed_count, 2)
+    self.assertFalse(mock_deferred.defer.called)
+
+  @mock.patch.object(base_model, '_REINDEX_PAGES_PER_TASK', 1)
+  @mock.patch.object(search, 'MAXIMUM_DOCUMENTS_PER_PUT_REQUEST', 1)
+  @mock.patch.object(base_model, 'deferred', autospec=True)
+  @mock.patch.object(Test, 'add_docs_to_index', return_value=1)
+  def test_index_shard_for_search_resumes(self, mock_add_docs, mock_deferred):
+    keys = [Test(id=i, text_field='item_%d' % i).put() for i in range(1, 3)]
+    checkpoint_key = base_model.SearchReindexCheckpoint(
+        id='Test-0', run_id='run').put()
+
+    Test.index_shard_for_search(checkpoint_key, 'run')
+    mock_deferred.defer.assert_called_once_with(
+        Test.index_shard_for_search, checkpoint_key, 'run')
+    checkpoint = checkpoint_key.get()
+    self.assertFalse(checkpoint.completed)
+    self.assertTrue(checkpoint.cursor)
+
+    # The continuation picks up after the last indexed page.
+    Test.index_shard_for_search(checkpoint_key, 'run')
+    self.assertEqual(
+        mock_add_docs.call_args[0][0][0].doc_id, keys[1].urlsafe())
+
+  @mock.patch.object(Test, 'add_docs_to_index')
+  def test_index_shard_for_search_superseded_run(self, mock_add_docs):
+    Test(text_field='item_1').put()
+    checkpoint_key = base_model.SearchReindexCheckpoint(
+        id='Test-0', run_id='new_run').put()
+    Test.index_shard_for_search(checkpoint_key, 'old_run')
+    self.assertFalse(mock_add_docs.called)
+
+  def test_update_search_index(self):
+    entity = Test(id='sync', text_field='item_1')
+    entity.put()
+    entity.update_search_index()
+    self.assertIsNotNone(Test.get_doc_by_id(entity.key.urlsafe()))
+
+  @mock.patch.object(search.Index, 'put', autospec=True)
+  def test_update_search_index_skips_unchanged(self, mock_put):
+    entity = Test(id='fingerprint', text_field='item_1')
+    entity.put()
+    entity.update_search_index()
+    entity.update_search_index()
+    self.assertEqual(mock_put.call_count, 1)
+
+    entity.text_field = 'item_2'
+    entity.update_search_index()
+    self.assertEqual(mock_put.call_count, 2)
+
+  def test_update_search_index_after_clear_index(self):
+    entity = Test(id='cleared', text_field='item_1')
+    entity.put()
+    entity.update_search_index()
+    Test.clear_index()
+    self.assertIsNone(Test.get_doc_by_id(entity.key.urlsafe()))
+
+    # The unchanged document is put again once the index was cleared.
+    entity.update_search_index()
+    self.assertIsNotNone(Test.get_doc_by_id(entity.key.urlsafe()))
+
+  def test_update_search_index_after_remove_doc(self):
+    entity = Test(id='removed', text_field='item_1')
+    entity.put()
+    entity.update_search_index()
+    Test.remove_doc_by_id(entity.key.urlsafe())
+
+    entity.update_search_index()
+    self.assertIsNotNone(Test.get_doc_by_id(entity.key.urlsafe()))
+
+  @mock.patch.object(Test, 'add_docs_to_index')
+  @mock.patch.object(search.Index, 'put', autospec=True)
+  def test_put_multi_and_index(self, mock_put, mock_add_docs):
+    entities = [Test(text_field='item_1'), Test(text_field='item_2')]
+    with mock.patch.object(
+        Test, '_post_put_hook', autospec=True,
+        side_effect=lambda entity, future: entity.update_search_index()):
+      keys = Test.put_multi_and_index(entities)
+    self.assertEqual(keys, [entity.key for entity in entities])
+    # The per-entity index puts were suppressed in favour of one batch.
+    self.assertFalse(mock_put.called)
+    mock_add_docs.assert_called_once_with(mock.ANY)
+    self.assertCountEqual(
+        [document.doc_id for document in mock_add_docs.call_args[0][0]],
+        [entity.key.urlsafe() for entity in entities])
+    for entity in entities:
+      self.assertTrue(entity._index_on_put)
+
+  @mock.patch.object(search.Index, 'put', autospec=True)
+  def test_update_search_index_volatile_fields(self, mock_put):
+    entity = TestEntity(
+        id='volatile', test_datetime=datetime.datetime(2018, 1, 1, 10, 0))
+    entity.put()
+    with mock.patch.multiple(
+        TestEntity, _INDEX_NAME='TestEntityIndex',
+        _VOLATILE_INDEX_FIELDS=frozenset(['test_datetime'])):
+      entity.update_search_index()
+      # Within the refresh window, the document is not put again.
+      entity.test_datetime = datetime.datetime(2018, 1, 1, 10, 9)
+      entity.update_search_index()
+      self.assertEqual(mock_put.call_count, 1)
+      # Past it, the document is put with the new value.
+      entity.test_datetime = datetime.datetime(2018, 1, 1, 10, 10)
+      entity.update_search_index()
+      self.assertEqual(mock_put.call_count, 2)
+
+  @mock.patch.object(base_model, 'deferred', autospec=True)
+  @mock.patch.object(base_model.taskqueue, 'Queue', autospec=True)
+  def test_update_search_index_write_behind(self, mock_queue, mock_deferred):
+    entity = Test(id='write_behind', text_field='item_1')
+    entity.put()
+    with mock.patch.object(Test, '_INDEX_WRITE_BEHIND', True):
+      entity.update_search_index()
+      entity.update_search_index()
+
+    # Repeated puts within the window coalesce into one pending key.
+    mock_queue.return_value.add.assert_called_once_with(mock.ANY)
+    task = mock_queue.return_value.add.call_args[0][0]
+    self.assertEqual(task.payload, six.ensure_binary(entity.key.urlsafe()))
+    self.assertEqual(mock_deferred.defer.call_count, 1)
+    self.assertIsNone(Test.get_doc_by_id(entity.key.urlsafe()))
+
+  @mock.patch.object(base_model.taskqueue, 'Queue', autospec=True)
+  def test_index_pending_entities(self, mock_queue):
+    entity_1 = Test(id='pending_1', text_field='item_1')
+    entity_1.put()
+    entity_2 = Test(id='pending_2', text_field='item_2')
+    entity_2.put()
+    tasks = [
+        base_model.taskqueue.Task(payload=entity_1.key.urlsafe()),
+        base_model.taskqueue.Task(payload=entity_2.key.urlsafe()),
+        base_model.taskqueue.Task(payload=entity_1.key.urlsafe())]
+    mock_queue.return_value.lease_tasks_by_tag.side_effect = [tasks, []]
+
+    with mock.patch.object(Test, 'add_docs_to_index') as mock_add_docs:
+      Test.index_pending_entities()
+
+    indexed_ids = [doc.doc_id for doc in mock_add_docs.call_args[0][0]]
+    self.assertCountEqual(
+        indexed_ids, [entity_1.key.urlsafe(), entity_2.key.urlsafe()])
+    mock_queue.return_value.delete_tasks.assert_called_once_with(tasks)
+
   def test_get_index(self):
     base_model.BaseModel._INDEX_NAME = None
     with self.assertRaises(ValueError):
@@ -139,6 +335,50 @@ class BaseModelTest(loanertest.TestCase, parameterized.TestCase):
             search.TextField(name='field_one', value='value_one')])])
     self.assertEqual(mock_put.call_count, 2)
 
+  @mock.patch.object(search, 'MAXIMUM_DOCUMENTS_PER_PUT_REQUEST', 2)
+  @mock.patch.object(search.Index, 'put')
+  def test_add_docs_to_index_batches(self, mock_put):
+    documents = [
+        search.Document(doc_id='test_id_%d' % i, fields=[
+            search.TextField(name='field_one', value='value_one')])
+        for i in range(5)]
+    rpc_count = base_model.BaseModel.add_docs_to_index(documents)
+    self.assertEqual(rpc_count, 3)
+    mock_put.assert_has_calls([
+        mock.call(documents[0:2]),
+        mock.call(documents[2:4]),
+        mock.call(documents[4:5])])
+
+  @mock.patch.object(base_model, 'logging', autospec=True)
+  @mock.patch.object(search.Index, 'put')
+  def test_add_docs_to_index_retries_only_transient(
+      self, mock_put, mock_logging):
+    documents = [
+        search.Document(doc_id='test_id_%d' % i, fields=[
+            search.TextField(name='field_one', value='value_one')])
+        for i in range(3)]
+    mock_put.side_effect = [
+        search.PutError(message='Fail!', results=[
+            search.PutResult(code=search.OperationResult.OK),
+            search.PutResult(code=search.OperationResult.TRANSIENT_ERROR),
+            search.PutResult(code=search.OperationResult.INVALID_REQUEST)]),
+        None]
+    rpc_count = base_model.BaseModel.add_docs_to_index(documents)
+    self.assertEqual(rpc_count, 2)
+    mock_put.assert_called_with([documents[1]])
+    mock_logging.error.assert_called_once_with(
+        base_model._PUT_DOC_ERR_MSG, documents[2], mock.ANY)
+
+  @mock.patch.object(search.Index, 'put')
+  def test_add_docs_to_index_transient_retry_limit(self, mock_put):
+    mock_put.side_effect = search.PutError(message='Fail!', results=[
+        search.PutResult(code=search.OperationResult.TRANSIENT_ERROR)])
+    base_model.BaseModel.add_docs_to_index([search.Document(
+        doc_id='test_id', fields=[
+            search.TextField(name='field_one', value='value_one')])])
+    self.assertEqual(
+        mock_put.call_count, base_model._TRANSIENT_PUT_RETRIES + 1)
+
   @parameterized.parameters(
       (search.Error(),),
       (base_model.apiproxy_errors.OverQuotaError,))
@@ -19,19 +19,50 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import datetime
+import hashlib
 import logging
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from loaner.web_app import constants
 from loaner.web_app.backend.clients import bigquery
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import base_model
 
+# How long a flush holds the rows it leased before another may retry them.
+_LEASE_SECONDS = 300
+
+# The ID of the _StreamWatermark entity.
+_WATERMARK_ID = 'bigquery_rows'
+
+_BAD_PAYLOAD_MSG = 'Dropping unreadable BigQuery row task %s: %s'
+_STREAMED_MSG = 'Streamed %d rows to BigQuery.'
+_ALREADY_STREAMED_MSG = 'Skipping %d rows already streamed to BigQuery.'
+
+# Set once this instance finds no rows left in datastore from before rows were
+# queued, so later flushes skip the query.
+_stored_rows_drained = False
+
+
+class _StreamWatermark(ndb.Model):
+  """The insert IDs of the last batch of rows streamed to BigQuery.
+
+  A flush that fails after streaming a batch, but before removing its rows,
+  retries the same rows. Those already recorded here are not streamed again.
+
+  Attributes:
+    insert_ids: List[str], the insert IDs of the rows in the batch.
+  """
+  insert_ids = ndb.StringProperty(repeated=True, indexed=False)
+
 
 class BigQueryRow(base_model.BaseModel):
   """Datastore model representing a single row in BigQuery.
 
+  Rows queued by stream_to_bq are built in memory when they are streamed; rows
+  are only stored in datastore by code from before rows were queued.
+
   Attributes:
     ndb_key: ndb.key, The key of the ndb entity being streamed to BigQuery.
     model_type: str, the model type being streamed to BigQuery.
@@ -83,52 +114,58 @@ class BigQueryRow(base_model.BaseModel):
         limit=constants.BIGQUERY_ROW_MAX_BATCH_SIZE)
 
   @classmethod
-  def _get_last_unstreamed_row(cls):
-    """Retrieves the last row that was not streamed."""
-    return cls.query(cls.streamed == False).order(  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
-        cls.streamed, cls.timestamp).get()
+  def stream_rows(cls):
+    """Streams the rows queued by stream_to_bq to BigQuery.
 
-  @classmethod
-  def _time_threshold_reached(cls):
-    """Checks if the time threshold for a BigQuery stream was met."""
-    threshold = datetime.datetime.utcnow() - datetime.timedelta(
-        minutes=constants.BIGQUERY_ROW_TIME_THRESHOLD)
-    last_unstreamed_row = cls._get_last_unstreamed_row()
-    if last_unstreamed_row:
-      return last_unstreamed_row.timestamp <= threshold
-    return False
+    Leases up to BIGQUERY_ROW_MAX_BATCH_SIZE queued rows at a time and streams
+    them with one insert per table, sent concurrently. Rows are only removed
+    from the queue once every table in their batch was streamed; otherwise
+    their lease expires and the next flush retries them.
 
-  @classmethod
-  def _row_threshold_reached(cls):
-    """Checks if the unstreamed row threshold for a BigQuery stream was met."""
-    return (cls.query(cls.streamed == False).count(  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
-        limit=constants.BIGQUERY_ROW_MAX_BATCH_SIZE) >=
-            constants.BIGQUERY_ROW_SIZE_THRESHOLD)
+    Each row is streamed with an insert ID derived from its payload, so a
+    retried row is deduplicated by BigQuery, and a batch recorded by the
+    watermark is not streamed again at all.
+    """
+    logging.info('Streaming rows to BigQuery.')
+    bq_client = bigquery.BigQueryClient()
+    queue = taskqueue.Queue(constants.BIGQUERY_ROW_QUEUE)
+    while True:
+      tasks = queue.lease_tasks(
+          _LEASE_SECONDS, constants.BIGQUERY_ROW_MAX_BATCH_SIZE)
+      if not tasks:
+        break
+      rows = {}
+      for task in tasks:
+        try:
+          rows[hashlib.sha1(task.payload).hexdigest()] = cls(
+              **task_payloads.decode_bigquery_row(task.payload))
+        except (task_payloads.Error, KeyError, ValueError) as err:
+          # A payload that cannot be read never will be, so drop it.
+          logging.error(_BAD_PAYLOAD_MSG, task.name, err)
+      if not _stream_batch(bq_client, rows):
+        return
+      queue.delete_tasks(tasks)
+      logging.info(_STREAMED_MSG, len(rows))
+      if len(tasks) < constants.BIGQUERY_ROW_MAX_BATCH_SIZE:
+        break
+    cls._stream_stored_rows(bq_client)
 
   @classmethod
-  def threshold_reached(cls):
-    """Determines whether or not entities should be streamed to BigQuery."""
-    return cls._time_threshold_reached() or cls._row_threshold_reached()
+  def _stream_stored_rows(cls, bq_client):
+    """Streams rows stored in datastore before rows were queued instead.
 
-  @classmethod
-  def stream_rows(cls):
-    """Streams all unstreamed rows if a threshold has been reached."""
-    logging.info('Streaming rows to BigQuery.')
-    if not cls.threshold_reached():
-      logging.info('Not streaming rows, thresholds not met.')
+    Args:
+      bq_client: bigquery.BigQueryClient, the client to stream with.
+    """
+    global _stored_rows_drained  # pylint: disable=global-statement
+    if _stored_rows_drained:
       return
-    bq_client = bigquery.BigQueryClient()
     rows = cls._fetch_unstreamed_rows()
-    tables = _format_for_bq(rows)
-    try:
-      for table_name in tables:
-        bq_client.stream_table(table_name, tables[table_name])
-    except bigquery.InsertError:
-      logging.error('Unable to stream rows.')
+    if not rows:
+      _stored_rows_drained = True
       return
-    _set_streamed(rows)
-    for row in rows:
-      row.delete()
+    if _stream_batch(bq_client, {row.key.urlsafe(): row for row in rows}):
+      ndb.delete_multi([row.key for row in rows])
 
   def delete(self):
     """Deletes streamed row from datastore."""
@@ -136,27 +173,49 @@ class BigQueryRow(base_model.BaseModel):
       self.key.delete()
 
 
-def _set_streamed(rows):
-  """Sets the rows as streamed to BigQuery."""
-  for row in rows:
-    row.streamed = True
-  ndb.put_multi(rows)
+def _stream_batch(bq_client, rows):
+  """Streams a batch of rows to their tables, unless it was already streamed.
+
+  Args:
+    bq_client: bigquery.BigQueryClient, the client to stream with.
+    rows: dict, insert IDs mapped to the BigQueryRow to stream with each.
+
+  Returns:
+    True if every row is in BigQuery, False if an insert failed.
+  """
+  if not rows:
+    return True
+  watermark = _StreamWatermark.get_by_id(_WATERMARK_ID)
+  if watermark and set(rows) <= set(watermark.insert_ids):
+    logging.info(_ALREADY_STREAMED_MSG, len(rows))
+    return True
+  tables, row_ids = _format_for_bq(rows)
+  try:
+    bq_client.stream_tables(tables, row_ids)
+  except bigquery.InsertError:
+    logging.error('Unable to stream rows.')
+    return False
+  _StreamWatermark(id=_WATERMARK_ID, insert_ids=sorted(rows)).put()
+  return True
 
 
 def _format_for_bq(rows):
   """Formats BigQueryRow entities and metadata for the BigQuery API.
 
   Args:
-    rows: List[BigQueryRow], a list of rows to format for the BigQuery API.
+    rows: dict, insert IDs mapped to the BigQueryRow to format with each.
 
   Returns:
-    A Dictionary keyed by model type with rows for a given table.
+    A tuple of two dictionaries keyed by model type, with the rows for a given
+    table and their insert IDs.
   """
   tables = collections.defaultdict(list)
-  for row in rows:
+  row_ids = collections.defaultdict(list)
+  for insert_id, row in sorted(rows.items()):
     entity_dict = row.to_json_dict()
     tables[row.model_type].append(
         (entity_dict['ndb_key'], entity_dict['timestamp'],
          entity_dict['actor'], entity_dict['method'], entity_dict['summary'],
          entity_dict['entity']))
-  return tables
+    row_ids[row.model_type].append(insert_id)
+  return tables, row_ids
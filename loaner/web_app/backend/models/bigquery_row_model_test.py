@@ -19,22 +19,23 @@ from __future__ import division
 from __future__ import print_function
 
 import datetime
+import hashlib
 
-from absl.testing import parameterized
-import freezegun
 import mock
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from loaner.web_app import constants
 from loaner.web_app.backend.clients import bigquery
+from loaner.web_app.backend.lib import task_payloads
 from loaner.web_app.backend.models import bigquery_row_model
 from loaner.web_app.backend.models import device_model
 from loaner.web_app.backend.models import shelf_model
 from loaner.web_app.backend.testing import loanertest
 
 
-class BigQueryRowModelTest(loanertest.TestCase, parameterized.TestCase):
+class BigQueryRowModelTest(loanertest.TestCase):
   """Tests for BigQueryModel class."""
 
   def setUp(self):
@@ -61,12 +62,33 @@ class BigQueryRowModelTest(loanertest.TestCase, parameterized.TestCase):
         'test@{}'.format(loanertest.USER_DOMAIN),
         'test', 'This is a test')
 
-    mock_bigquery = mock.patch.object(
-        bigquery_row_model, 'bigquery', autospec=True)
-    self.addCleanup(mock_bigquery.stop)
-    self.mock_bigquery = mock_bigquery.start()
-    self.mock_bigquery_client = mock.Mock()
-    self.mock_bigquery.BigQueryClient.return_value = self.mock_bigquery_client
+    mock_client_class = mock.patch.object(
+        bigquery_row_model.bigquery, 'BigQueryClient', autospec=True)
+    self.addCleanup(mock_client_class.stop)
+    self.mock_bigquery_client = mock_client_class.start().return_value
+
+    mock_queue_class = mock.patch.object(
+        bigquery_row_model.taskqueue, 'Queue', autospec=True)
+    self.addCleanup(mock_queue_class.stop)
+    self.mock_queue = mock_queue_class.start().return_value
+    self.mock_queue.lease_tasks.return_value = []
+
+    drained_patcher = mock.patch.object(
+        bigquery_row_model, '_stored_rows_drained', False)
+    self.addCleanup(drained_patcher.stop)
+    drained_patcher.start()
+
+  def _bq_row(self, row):
+    row_dict = row.to_json_dict()
+    return (row_dict['ndb_key'], row_dict['timestamp'], row_dict['actor'],
+            row_dict['method'], row_dict['summary'], row_dict['entity'])
+
+  def _queued_task(self, model_instance, timestamp):
+    task = mock.Mock()
+    task.payload = task_payloads.encode_bigquery_row(
+        model_instance, timestamp, 'test@{}'.format(loanertest.USER_DOMAIN),
+        'test', 'This is a test')
+    return task
 
   def test_add(self):
     retrieved_row = self.test_row_1.key.get()
@@ -78,88 +100,93 @@ class BigQueryRowModelTest(loanertest.TestCase, parameterized.TestCase):
     self.test_row_1.put()
     self.assertLen(bigquery_row_model.BigQueryRow._fetch_unstreamed_rows(), 1)
 
-  @freezegun.freeze_time('1956-01-31')
-  def test_time_threshold_reached(self):
-    threshold = datetime.datetime.utcnow() - datetime.timedelta(
-        minutes=constants.BIGQUERY_ROW_TIME_THRESHOLD)
-    self.test_row_1.timestamp = threshold
-    self.test_row_1.streamed = False
-    self.test_row_1.put()
-    self.assertTrue(bigquery_row_model.BigQueryRow._time_threshold_reached())
+  def test_stream_rows_queued(self):
+    self.test_row_1.key.delete()
+    self.test_row_2.key.delete()
+    timestamp = datetime.datetime(2018, 1, 2, 3, 4, 5)
+    tasks = [
+        self._queued_task(self.test_shelf, timestamp),
+        self._queued_task(self.test_device, timestamp),
+        self._queued_task(self.test_device, timestamp)]
+    self.mock_queue.lease_tasks.return_value = tasks
+
+    bigquery_row_model.BigQueryRow.stream_rows()
+
+    self.mock_queue.lease_tasks.assert_called_once_with(
+        bigquery_row_model._LEASE_SECONDS,
+        constants.BIGQUERY_ROW_MAX_BATCH_SIZE)
+    # One insert per table, with rows identical to stored rows. The duplicate
+    # device row shares an insert ID and is only sent once.
+    expected_shelf_row = self._bq_row(bigquery_row_model.BigQueryRow(
+        **task_payloads.decode_bigquery_row(tasks[0].payload)))
+    expected_device_row = self._bq_row(bigquery_row_model.BigQueryRow(
+        **task_payloads.decode_bigquery_row(tasks[1].payload)))
+    self.mock_bigquery_client.stream_tables.assert_called_once_with(
+        {'Shelf': [expected_shelf_row], 'Device': [expected_device_row]},
+        {'Shelf': [hashlib.sha1(tasks[0].payload).hexdigest()],
+         'Device': [hashlib.sha1(tasks[1].payload).hexdigest()]})
+    self.mock_queue.delete_tasks.assert_called_once_with(tasks)
+
+  def test_stream_rows_queued_retry(self):
+    self.test_row_1.key.delete()
+    self.test_row_2.key.delete()
+    tasks = [self._queued_task(self.test_shelf, datetime.datetime.utcnow())]
+    self.mock_queue.lease_tasks.return_value = tasks
+    self.mock_queue.delete_tasks.side_effect = taskqueue.TransientError
+    with self.assertRaises(taskqueue.TransientError):
+      bigquery_row_model.BigQueryRow.stream_rows()
+    self.mock_queue.delete_tasks.side_effect = None
 
-  @freezegun.freeze_time('1956-01-31')
-  def test_time_threshold_reached_fail_no_unstreamed_rows(self):
-    self.test_row_1.streamed = True
-    self.test_row_1.put()
-    self.test_row_2.streamed = True
-    self.test_row_2.put()
-    self.assertFalse(bigquery_row_model.BigQueryRow._time_threshold_reached())
-
-  @freezegun.freeze_time('1956-01-31')
-  def test_time_threshold_reached_fail(self):
-    threshold = datetime.datetime.utcnow() - datetime.timedelta(
-        minutes=constants.BIGQUERY_ROW_TIME_THRESHOLD - 1)
-    self.test_row_1.timestamp = threshold
-    self.test_row_1.streamed = False
-    self.test_row_1.put()
-    self.assertFalse(bigquery_row_model.BigQueryRow._time_threshold_reached())
-
-  def test_row_threshold_reached(self):
-    for insert in range(constants.BIGQUERY_ROW_SIZE_THRESHOLD):
-      row = bigquery_row_model.BigQueryRow.add(
-          self.test_shelf, datetime.datetime.utcnow(),
-          'test@{}'.format(loanertest.USER_DOMAIN),
-          'test', 'This is a test ' + str(insert))
-      row.streamed = False
-      row.put()
-    self.assertTrue(bigquery_row_model.BigQueryRow._row_threshold_reached())
-
-  def test_row_threshold_reached_fail(self):
-    self.test_row_1.streamed = False
-    self.test_row_1.put()
-    self.assertFalse(bigquery_row_model.BigQueryRow._row_threshold_reached())
-
-  @parameterized.named_parameters(
-      ('time', '_time_threshold_reached'),
-      ('rows', '_row_threshold_reached'))
-  @mock.patch.object(ndb, 'put_multi', autospec=True)
-  @mock.patch.object(bigquery_row_model.BigQueryRow, 'delete')
-  def test_stream_rows(self, threshold_function, mock_delete, mock_put_multi):
-    test_row_dict_1 = self.test_row_1.to_json_dict()
-    test_row_dict_2 = self.test_row_2.to_json_dict()
-    test_row_1 = (test_row_dict_1['ndb_key'], test_row_dict_1['timestamp'],
-                  test_row_dict_1['actor'], test_row_dict_1['method'],
-                  test_row_dict_1['summary'], test_row_dict_1['entity'])
-    test_row_2 = (test_row_dict_2['ndb_key'], test_row_dict_2['timestamp'],
-                  test_row_dict_2['actor'], test_row_dict_2['method'],
-                  test_row_dict_2['summary'], test_row_dict_2['entity'])
-    expected_tables = {
-        self.test_row_1.model_type: [test_row_1],
-        self.test_row_2.model_type: [test_row_2]
-    }
+    bigquery_row_model.BigQueryRow.stream_rows()
 
-    with mock.patch.object(
-        bigquery_row_model.BigQueryRow,
-        threshold_function, return_value=True):
-      bigquery_row_model.BigQueryRow.stream_rows()
+    # The watermark shows the retried batch was streamed, so it is only
+    # removed from the queue.
+    self.assertEqual(self.mock_bigquery_client.stream_tables.call_count, 1)
+    self.mock_queue.delete_tasks.assert_called_with(tasks)
+
+  def test_stream_rows_queued_insert_error(self):
+    self.mock_queue.lease_tasks.return_value = [
+        self._queued_task(self.test_shelf, datetime.datetime.utcnow())]
+    self.mock_bigquery_client.stream_tables.side_effect = bigquery.InsertError
+
+    bigquery_row_model.BigQueryRow.stream_rows()
+
+    # The leased rows are left for the next flush to retry.
+    self.assertFalse(self.mock_queue.delete_tasks.called)
+    self.assertLen(bigquery_row_model.BigQueryRow._fetch_unstreamed_rows(), 2)
+
+  def test_stream_rows_queued_bad_payload(self):
+    bad_task = mock.Mock(payload='{"v": 99}')
+    self.mock_queue.lease_tasks.return_value = [bad_task]
 
-    self.mock_bigquery_client.stream_table.assert_any_call(
-        self.test_row_1.model_type, expected_tables[self.test_row_1.model_type])
-    self.mock_bigquery_client.stream_table.assert_any_call(
-        self.test_row_2.model_type, expected_tables[self.test_row_2.model_type])
-    self.assertEqual(self.mock_bigquery_client.stream_table.call_count, 2)
-    self.assertTrue(self.test_row_1.streamed)
-    self.assertTrue(self.test_row_2.streamed)
-    self.assertEqual(mock_put_multi.call_count, 1)
-    self.assertEqual(mock_delete.call_count, 2)
-
-  def test_stream_rows_insert_error(self):
-    self.mock_bigquery_client.stream_table.side_effect = bigquery.InsertError
+    bigquery_row_model.BigQueryRow.stream_rows()
+
+    self.mock_queue.delete_tasks.assert_called_once_with([bad_task])
+
+  @mock.patch.object(ndb, 'delete_multi', wraps=ndb.delete_multi)
+  def test_stream_rows_stored(self, mock_delete_multi):
+    bigquery_row_model.BigQueryRow.stream_rows()
+
+    self.mock_bigquery_client.stream_tables.assert_called_once_with(
+        {self.test_row_1.model_type: [self._bq_row(self.test_row_1)],
+         self.test_row_2.model_type: [self._bq_row(self.test_row_2)]},
+        {self.test_row_1.model_type: [self.test_row_1.key.urlsafe()],
+         self.test_row_2.model_type: [self.test_row_2.key.urlsafe()]})
+    self.assertEqual(mock_delete_multi.call_count, 1)
+    self.assertLen(bigquery_row_model.BigQueryRow._fetch_unstreamed_rows(), 0)
+
+  def test_stream_rows_stored_drained(self):
+    bigquery_row_model.BigQueryRow.stream_rows()
+    self.assertLen(bigquery_row_model.BigQueryRow._fetch_unstreamed_rows(), 0)
+    bigquery_row_model.BigQueryRow.stream_rows()
+    self.assertTrue(bigquery_row_model._stored_rows_drained)
+
+    # Once drained, flushes no longer query for stored rows.
     with mock.patch.object(
         bigquery_row_model.BigQueryRow,
-        'threshold_reached', return_value=True):
-      with self.assertRaises(bigquery.InsertError):
-        bigquery_row_model.BigQueryRow.stream_rows()
+        '_fetch_unstreamed_rows') as mock_fetch:
+      bigquery_row_model.BigQueryRow.stream_rows()
+    self.assertFalse(mock_fetch.called)
 
   def test_delete(self):
     self.test_row_1.streamed = True
@@ -17,6 +17,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+import time
+
 import six
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -26,6 +29,31 @@ from loaner.web_app.backend.lib import utils
 
 _CONFIG_NOT_FOUND_MSG = 'No such name "%s" exists in default configurations.'
 
+# Seconds an instance trusts its snapshot before checking the version stamp.
+_SNAPSHOT_TTL = 30
+_VERSION_KEY = 'config_snapshot_version'
+_VERSION_NAMESPACE = 'config'
+
+
+class _Snapshot(object):
+  """An in-process snapshot of every config value.
+
+  Attributes:
+    values: dict, the config values keyed by name, or None if not loaded.
+    version: int, the version stamp the values were loaded at.
+    checked: float, the time the version stamp was last checked.
+    lock: threading.Lock, guards the attributes above.
+  """
+
+  def __init__(self):
+    self.values = None
+    self.version = None
+    self.checked = 0
+    self.lock = threading.Lock()
+
+
+_snapshot = _Snapshot()
+
 
 class Config(ndb.Model):
   """Datastore model representing a config name.
@@ -34,6 +62,10 @@ class Config(ndb.Model):
   has an option to store a value of type string, integer, boolean, or list as
   its value. The same config name can not have a value of multiple types.
 
+  All values are read together into a snapshot cached by each instance for
+  _SNAPSHOT_TTL seconds. Any put of a config bumps a version stamp in memcache,
+  so once the TTL has passed an instance only reloads if a value has changed.
+
   Attributes:
     string_value: str, value for a given config name.
     integer_value: int, value for a given config name.
@@ -45,54 +77,120 @@ class Config(ndb.Model):
   bool_value = ndb.BooleanProperty()
   list_value = ndb.StringProperty(repeated=True)
 
+  def _post_put_hook(self, future):
+    """Overrides the _post_put_hook method."""
+    del future  # Unused.
+    self.invalidate_cache()
+
+  @property
+  def value(self):
+    """The stored value of the config, or None if it has no value."""
+    if self.string_value is not None:
+      return self.string_value
+    if self.integer_value is not None:
+      return self.integer_value
+    if self.bool_value is not None:
+      return self.bool_value
+    if self.list_value:
+      return self.list_value
+    return None
+
   @classmethod
   def get(cls, name):
-    """Checks memcache for name, if not available, check datastore.
+    """Gets a config value from the snapshot, or datastore if not a default.
 
     Args:
       name: str, name of config name.
 
     Returns:
-      The config value from memcache, datastore, or config file.
+      The config value from datastore, or the config file if none is stored.
 
     Raises:
       KeyError: An error occurred when name does not exist.
     """
-    memcache_config = memcache.get(name)
-    cached_config = None
-    if memcache_config:
-      return memcache_config
-
-    stored_config = cls.get_by_id(name, use_memcache=False)
-    if stored_config:
-      if stored_config.string_value:
-        cached_config = stored_config.string_value
-      elif stored_config.integer_value:
-        cached_config = stored_config.integer_value
-      elif stored_config.bool_value is not None:
-        cached_config = stored_config.bool_value
-      elif stored_config.list_value:
-        cached_config = stored_config.list_value
+    values = cls._get_snapshot()
+    if name in values:
+      value = values[name]
+    else:
+      # Only names set without validation are stored but not in the defaults.
+      stored_config = cls.get_by_id(name, use_memcache=False)
+      value = stored_config.value if stored_config else None
+      if value is None:
+        raise KeyError(_CONFIG_NOT_FOUND_MSG, name)
+    if isinstance(value, list):
+      return list(value)
+    return value
+
+  @classmethod
+  def get_all(cls):
+    """Gets every config value named in the config file.
+
+    Returns:
+      A dictionary of config values keyed by name.
+    """
+    return {
+        name: list(value) if isinstance(value, list) else value
+        for name, value in six.iteritems(cls._get_snapshot())}
+
+  @classmethod
+  def _get_snapshot(cls):
+    """Returns the config snapshot, reloading it if a value has changed."""
+    now = time.time()
+    with _snapshot.lock:
+      if (_snapshot.values is not None and
+          now - _snapshot.checked < _SNAPSHOT_TTL):
+        return _snapshot.values
+    version = memcache.get(_VERSION_KEY, namespace=_VERSION_NAMESPACE)
+    if version is None:
+      memcache.add(
+          _VERSION_KEY, int(now * 1000), namespace=_VERSION_NAMESPACE)
+      version = memcache.get(_VERSION_KEY, namespace=_VERSION_NAMESPACE)
+    with _snapshot.lock:
+      if _snapshot.values is not None and _snapshot.version == version:
+        _snapshot.checked = now
+        return _snapshot.values
+    values = cls._load_values()
+    with _snapshot.lock:
+      _snapshot.values = values
+      _snapshot.version = version
+      _snapshot.checked = now
+    return values
+
+  @classmethod
+  def _load_values(cls):
+    """Reads every config value with a single get_multi.
+
+    Returns:
+      A dictionary of config values keyed by name, using the value in the
+      config file for any name without a stored value.
+    """
+    values = dict(utils.load_config_from_yaml())
+    names = list(values)
+    stored_configs = ndb.get_multi(
+        [ndb.Key(cls, name) for name in names], use_memcache=False)
+    stored_names = set()
+    for name, stored_config in zip(names, stored_configs):
+      if stored_config and stored_config.value is not None:
+        values[name] = stored_config.value
+        stored_names.add(name)
     # Conversion from use_asset_tags to device_identifier_mode.
-    if name == 'device_identifier_mode' and not cached_config:
-      if cls.get('use_asset_tags'):
-        cached_config = DeviceIdentifierMode.BOTH_REQUIRED
-        cls.set(name, cached_config)
-        memcache.set(name, cached_config)
-    if cached_config is not None:
-      memcache.set(name, cached_config)
-      return cached_config
-    config_defaults = utils.load_config_from_yaml()
-    if name in config_defaults:
-      value = config_defaults[name]
-      cls.set(name, value)
-      return value
-
-    raise KeyError(_CONFIG_NOT_FOUND_MSG, name)
+    if ('device_identifier_mode' in values and
+        'device_identifier_mode' not in stored_names and
+        values.get('use_asset_tags')):
+      values['device_identifier_mode'] = DeviceIdentifierMode.BOTH_REQUIRED
+      cls.set('device_identifier_mode', DeviceIdentifierMode.BOTH_REQUIRED)
+    return values
+
+  @classmethod
+  def invalidate_cache(cls):
+    """Drops this instance's snapshot and bumps the version for all others."""
+    with _snapshot.lock:
+      _snapshot.values = None
+    memcache.incr(_VERSION_KEY, initial_value=0, namespace=_VERSION_NAMESPACE)
 
   @classmethod
   def set(cls, name, value, validate=True):
-    """Stores values for a config name in memcache and datastore.
+    """Stores values for a config name in datastore.
 
     Args:
       name: str, name of the config setting.
@@ -123,8 +221,6 @@ class Config(ndb.Model):
       stored_config.list_value = value
       stored_config.put()
 
-    memcache.set(name, value)
-
 
 class DeviceIdentifierMode(object):
   """Constants defining supported means of identifying devices."""
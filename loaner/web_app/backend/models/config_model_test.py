@@ -32,6 +32,7 @@ from google.appengine.ext import ndb
 
 from absl.testing import absltest
 from loaner.web_app import constants
+from loaner.web_app.backend.lib import utils
 from loaner.web_app.backend.models import config_model
 from loaner.web_app.backend.testing import loanertest
 
@@ -81,6 +82,8 @@ class ConfigurationTest(parameterized.TestCase, loanertest.TestCase):
 
     config_file = constants.CONFIG_DEFAULTS_PATH
     self.fs.CreateFile(config_file, contents=_config_defaults_yaml)
+    # Drop defaults parsed from the real file by earlier tests.
+    utils._config_defaults.clear()
 
     config_model.Config(id='string_config', string_value='config value 1').put()
     config_model.Config(id='integer_config', integer_value=1).put()
@@ -92,32 +95,71 @@ class ConfigurationTest(parameterized.TestCase, loanertest.TestCase):
     self.stubs.UnsetAll()
     __builtin__.open = self.real_open
     __builtin__.file = self.real_file
+    utils._config_defaults.clear()
 
   @parameterized.parameters(_create_config_parameters())
   def test_get_from_datastore(self, test_config):
     config = config_model.Config.get(test_config[0])
     self.assertEqual(config, test_config[1])
 
-  def test_get_from_memcache(self):
-    config = 'string_config'
-    config_value = 'this should be read.'
-    memcache.set(config, config_value)
-    reference_datastore_config = config_model.Config.get_by_id(config)
-    config_memcache = config_model.Config.get(config)
-
-    self.assertEqual(config_memcache, config_value)
-    self.assertEqual(reference_datastore_config.string_value, 'config value 1')
-
-  @mock.patch.object(config_model.Config, 'set')
-  @mock.patch.object(memcache, 'get', return_value=None)
-  @mock.patch.object(ndb.Model, 'get_by_id', return_value=None)
-  def test_get_from_default(
-      self, mock_get_by_id, mock_memcache_get, mock_config_model_set):
+  def test_get_from_snapshot(self):
+    self.assertEqual(config_model.Config.get('string_config'), 'config value 1')
+    with mock.patch.object(ndb, 'get_multi') as mock_get_multi:
+      self.assertEqual(config_model.Config.get('integer_config'), 1)
+      self.assertEqual(config_model.Config.get('bool_config'), True)
+      self.assertFalse(mock_get_multi.called)
+
+  def test_get_snapshot_reloaded_after_put(self):
+    self.assertEqual(config_model.Config.get('string_config'), 'config value 1')
+    config_model.Config(id='string_config', string_value='new value').put()
+    self.assertEqual(config_model.Config.get('string_config'), 'new value')
+
+  def test_get_snapshot_version_checked_after_ttl(self):
+    now = 1000.0
+    with mock.patch.object(config_model.time, 'time', return_value=now):
+      config_model.Config.get('string_config')
+    # Another instance changes the value and bumps the version stamp.
+    with mock.patch.object(config_model.Config, '_post_put_hook'):
+      config_model.Config(id='string_config', string_value='new value').put()
+    memcache.incr(
+        config_model._VERSION_KEY, namespace=config_model._VERSION_NAMESPACE)
+
+    with mock.patch.object(config_model.time, 'time', return_value=now + 1):
+      self.assertEqual(
+          config_model.Config.get('string_config'), 'config value 1')
+    with mock.patch.object(
+        config_model.time, 'time',
+        return_value=now + config_model._SNAPSHOT_TTL + 1):
+      self.assertEqual(config_model.Config.get('string_config'), 'new value')
+
+  @parameterized.parameters(
+      ('string_config', ''), ('integer_config', 0), ('bool_config', False),)
+  def test_get_falsy_value(self, name, value):
+    config_model.Config.set(name, value)
+    with mock.patch.object(utils, 'load_config_from_yaml') as mock_load:
+      mock_load.return_value = {name: 'default'}
+      config_model.Config.invalidate_cache()
+      self.assertEqual(config_model.Config.get(name), value)
+      self.assertEqual(config_model.Config.get(name), value)
+      self.assertEqual(mock_load.call_count, 1)
+
+  def test_get_list_is_copied(self):
+    config_model.Config.get('list_config').append('email3')
+    self.assertEqual(
+        config_model.Config.get('list_config'), ['email1', 'email2'])
+
+  def test_get_all(self):
+    configs = config_model.Config.get_all()
+    self.assertEqual(configs['string_config'], 'config value 1')
+    self.assertEqual(configs['test_config'], 'test_value')
+    self.assertEqual(configs['list_config'], ['email1', 'email2'])
+
+  def test_get_from_default(self):
     config = 'test_config'
     expected_value = 'test_value'
     config_datastore = config_model.Config.get(config)
-    mock_config_model_set.assert_called_once_with(config, expected_value)
     self.assertEqual(config_datastore, expected_value)
+    self.assertIsNone(config_model.Config.get_by_id(config))
 
   def test_get_identifier_with_use_asset(self):
     config_model.Config.set('use_asset_tags', True)
@@ -136,10 +178,8 @@ class ConfigurationTest(parameterized.TestCase, loanertest.TestCase):
   @parameterized.parameters(_create_config_parameters())
   def test_set(self, test_config):
     config_model.Config.set(test_config[0], test_config[1])
-    memcache_config = memcache.get(test_config[0])
     config = config_model.Config.get(test_config[0])
 
-    self.assertEqual(memcache_config, test_config[1])
     self.assertEqual(config, test_config[1])
 
   def test_set_nonexistent(self):
@@ -24,6 +24,8 @@ import datetime
 from absl import logging
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
@@ -32,8 +34,10 @@ from loaner.web_app.backend.api import permissions
 from loaner.web_app.backend.clients import directory
 from loaner.web_app.backend.lib import events
 from loaner.web_app.backend.lib import user as user_lib
+from loaner.web_app.backend.lib import utils
 from loaner.web_app.backend.models import base_model
 from loaner.web_app.backend.models import config_model
+from loaner.web_app.backend.models import directory_device_model
 from loaner.web_app.backend.models import tag_model
 from loaner.web_app.backend.models import user_model
 
@@ -65,6 +69,32 @@ _ASSIGNMENT_MISMATCH_MSG = (
 _EVENT_ACTION_ERROR_MSG = (
     'The following error occurred while trying to perform the action (%s): %s')
 _DEVICE_ID_NOT_FOUND = 'Device ID %s not found in org.'
+_HEARTBEAT_FLUSH_MSG = 'Flushed %d buffered heartbeats to datastore.'
+_HEARTBEAT_ENQUEUE_FAILED_MSG = (
+    'Failed to enqueue device %s for a heartbeat flush, the next heartbeat '
+    'will retry: %s')
+_AUDIT_SHELF_DISABLED_MSG = 'Unable to audit shelf %s because it is not active.'
+_AUDIT_SHELF_CHANGES_MSG = (
+    'Audit of shelf %s checked in devices: [%s] and removed devices: [%s].')
+
+_HEARTBEAT_NAMESPACE = 'device_heartbeat'
+# Buffered heartbeats outlive several flush intervals so a delayed cron run
+# does not drop them; a device that has gone quiet falls out on its own.
+_HEARTBEAT_BUFFER_TTL = 3600
+_HEARTBEAT_FLUSH_BATCH_SIZE = 500
+# The pull queue holding the keys of devices with a buffered heartbeat, and
+# the markers of the devices already in it.
+_HEARTBEAT_QUEUE = 'device-heartbeat'
+_HEARTBEAT_PENDING_NAMESPACE = 'device_heartbeat_pending'
+_HEARTBEAT_LEASE_SECONDS = 60
+
+# The fields that uniquely identify a device and are kept in DeviceLookup.
+_IDENTIFIER_FIELDS = ('asset_tag', 'chrome_device_id', 'serial_number')
+_IDENTIFIER_NAMESPACE = 'device_identifier'
+_IDENTIFIER_CACHE_SIZE = 10000
+
+# Identifier to device key mappings, shared by requests on this instance.
+_identifier_cache = utils.LRUCache(_IDENTIFIER_CACHE_SIZE)
 
 
 class Error(Exception):
@@ -132,6 +162,34 @@ class DeviceAuditEventError(Error):
 
 
 ReturnDates = collections.namedtuple('ReturnDates', ['max', 'default'])
+ShelfAuditResult = collections.namedtuple(
+    'ShelfAuditResult', ['already_on_shelf', 'checked_in', 'removed'])
+
+
+def _normalize_identifier(field, value):
+  """Normalizes an identifier the way it is stored on a device."""
+  if field == 'chrome_device_id':
+    return value.strip()
+  return value.upper().strip()
+
+
+def _lookup_id(field, value):
+  """Returns the DeviceLookup ID for a normalized identifier."""
+  return '%s:%s' % (field, value)
+
+
+class DeviceLookup(ndb.Model):
+  """Datastore model mapping a device identifier to a device.
+
+  Entities are keyed by '<field>:<value>', e.g. 'serial_number:123ABC', so a
+  device can be resolved with a strongly consistent get by key rather than an
+  eventually consistent property query. Entries can outlive a change to the
+  device's identifier, so a lookup is always verified against the device.
+
+  Attributes:
+    device: ndb.Key, the key of the device with this identifier.
+  """
+  device = ndb.KeyProperty(kind='Device', indexed=False)
 
 
 class Reminder(base_model.BaseModel):
@@ -237,6 +295,9 @@ class Device(base_model.BaseModel):
       'u': 'assigned_user',
       'au': 'assigned_user'
   }
+  # Heartbeats only change these, so they only trigger a search index put
+  # once per _VOLATILE_INDEX_REFRESH.
+  _VOLATILE_INDEX_FIELDS = frozenset(['last_heartbeat', 'last_known_healthy'])
 
   @property
   def is_assigned(self):
@@ -267,8 +328,35 @@ class Device(base_model.BaseModel):
   def _post_put_hook(self, future):
     """Overrides the _post_put_hook method."""
     del future  # Unused.
-    index = Device.get_index()
-    index.put(self.to_document())
+    self._update_identifier_lookups()
+    self.update_search_index()
+
+  def _update_identifier_lookups(self):
+    """Writes DeviceLookup entities for identifiers not already mapped.
+
+    Memcache is consulted first so that a put that does not change any
+    identifier does not write to datastore. The local cache is not trusted
+    here: another instance may have deleted a stale lookup from memcache and
+    datastore without this instance knowing.
+    """
+    lookup_ids = [
+        _lookup_id(field, getattr(self, field))
+        for field in _IDENTIFIER_FIELDS if getattr(self, field)]
+    if not lookup_ids:
+      return
+    cached = memcache.get_multi(lookup_ids, namespace=_IDENTIFIER_NAMESPACE)
+    missing = [
+        lookup_id for lookup_id in lookup_ids
+        if cached.get(lookup_id) != self.key]
+    if missing:
+      ndb.put_multi([
+          DeviceLookup(id=lookup_id, device=self.key)
+          for lookup_id in missing])
+      memcache.set_multi(
+          {lookup_id: self.key for lookup_id in missing},
+          namespace=_IDENTIFIER_NAMESPACE)
+    for lookup_id in lookup_ids:
+      _identifier_cache.set(lookup_id, self.key)
 
   @classmethod
   def list_by_user(cls, user):
@@ -352,8 +440,9 @@ class Device(base_model.BaseModel):
     try:
       # Get a Chrome OS Device object as per
       # https://developers.google.com/admin-sdk/directory/v1/reference/chromeosdevices
-      directory_device_object = directory_client.get_chrome_device_by_serial(
-          serial_number)
+      directory_device_object = (
+          directory_device_model.get_chrome_device_by_serial(
+              directory_client, serial_number))
     except directory.DeviceDoesNotExistError as err:
       raise DeviceCreationError(str(err))
     try:
@@ -443,7 +532,8 @@ class Device(base_model.BaseModel):
         org or the info retrieved from the Directory API is incomplete.
     """
     directory_client = directory.DirectoryApiClient(user_email)
-    directory_info = directory_client.get_chrome_device(device_id)
+    directory_info = directory_device_model.get_chrome_device(
+        directory_client, device_id)
     if not directory_info:
       raise DeviceCreationError(_DEVICE_ID_NOT_FOUND % device_id)
     try:
@@ -480,18 +570,122 @@ class Device(base_model.BaseModel):
           invalid URL-safe key is supplied.
     """
     if asset_tag:
-      return cls.query(cls.asset_tag == asset_tag.upper().strip()).get()
+      return cls._get_by_field('asset_tag', asset_tag)
     elif chrome_device_id:
-      return cls.query(cls.chrome_device_id == chrome_device_id.strip()).get()
+      return cls._get_by_field('chrome_device_id', chrome_device_id)
     elif serial_number:
-      return cls.query(cls.serial_number == serial_number.upper().strip()).get()
+      return cls._get_by_field('serial_number', serial_number)
     elif identifier:
-      return (
-          cls.query(cls.serial_number == identifier.upper().strip()).get() or
-          cls.query(cls.asset_tag == identifier.upper().strip()).get())
+      return cls.get_multi_by_identifiers([identifier])[identifier]
     else:
       raise DeviceIdentifierError('No identifier supplied to get device.')
 
+  @classmethod
+  def _get_by_field(cls, field, value):
+    """Retrieves a device by a single identifier field."""
+    return cls.get_multi_by_identifiers([value], field=field)[value]
+
+  @classmethod
+  def get_multi_by_identifiers(cls, identifiers, field=None):
+    """Retrieves devices for many identifiers in as few round trips as possible.
+
+    Identifiers are resolved through the DeviceLookup index and its caches, and
+    the devices are then fetched with a single get_multi. Identifiers missing
+    from the index fall back to a query and are added to the index.
+
+    Args:
+      identifiers: List[str], the identifiers of the devices to retrieve.
+      field: str, one of 'asset_tag', 'chrome_device_id' or 'serial_number' to
+          match identifiers against that field only. By default each identifier
+          is tried as a serial number and then as an asset tag.
+
+    Returns:
+      A dictionary mapping each supplied identifier to its device model, or to
+      None if one cannot be found.
+    """
+    fields = (field,) if field else ('serial_number', 'asset_tag')
+    candidates = {
+        identifier: [
+            (name, _normalize_identifier(name, identifier)) for name in fields]
+        for identifier in identifiers}
+    resolved = cls._resolve_identifiers(
+        set(pair for pairs in candidates.values() for pair in pairs))
+
+    results = {}
+    for identifier, pairs in candidates.items():
+      device = None
+      for pair in pairs:
+        device = resolved.get(pair)
+        if device:
+          break
+      else:
+        for name, value in pairs:
+          device = cls.query(getattr(cls, name) == value).get()
+          if device:
+            device._update_identifier_lookups()  # pylint: disable=protected-access
+            break
+      results[identifier] = device
+    return results
+
+  @classmethod
+  def _resolve_identifiers(cls, pairs):
+    """Resolves (field, value) pairs through the DeviceLookup index.
+
+    Args:
+      pairs: Set[Tuple[str, str]], normalized (field, value) identifier pairs.
+
+    Returns:
+      A dictionary mapping each pair that could be resolved to its device.
+    """
+    keys = {}
+    misses = []
+    for pair in pairs:
+      lookup_id = _lookup_id(*pair)
+      key = _identifier_cache.get(lookup_id)
+      if key:
+        keys[lookup_id] = key
+      else:
+        misses.append(lookup_id)
+
+    if misses:
+      found = memcache.get_multi(misses, namespace=_IDENTIFIER_NAMESPACE)
+      misses = [lookup_id for lookup_id in misses if lookup_id not in found]
+      if misses:
+        fetched = {
+            lookup.key.id(): lookup.device for lookup in ndb.get_multi(
+                [ndb.Key(DeviceLookup, lookup_id) for lookup_id in misses])
+            if lookup}
+        if fetched:
+          memcache.set_multi(fetched, namespace=_IDENTIFIER_NAMESPACE)
+        found.update(fetched)
+      for lookup_id, key in found.items():
+        _identifier_cache.set(lookup_id, key)
+      keys.update(found)
+
+    if not keys:
+      return {}
+    unique_keys = list(set(keys.values()))
+    devices = dict(zip(unique_keys, ndb.get_multi(unique_keys)))
+
+    resolved = {}
+    stale = []
+    for pair in pairs:
+      lookup_id = _lookup_id(*pair)
+      if lookup_id not in keys:
+        continue
+      device = devices[keys[lookup_id]]
+      if device and getattr(device, pair[0]) == pair[1]:
+        resolved[pair] = device
+      else:
+        stale.append(lookup_id)
+    if stale:
+      for lookup_id in stale:
+        _identifier_cache.delete(lookup_id)
+      memcache.delete_multi(stale, namespace=_IDENTIFIER_NAMESPACE)
+      ndb.delete_multi([
+          ndb.Key(DeviceLookup, lookup_id) for lookup_id in stale])
+    return resolved
+
   def lock(self, user_email):
     """Disables a device via the Directory API.
 
@@ -592,6 +786,9 @@ class Device(base_model.BaseModel):
 
     Args:
       user_email: str, email address of the user initiating the return.
+
+    Returns:
+      True if the loan was resumed, otherwise False.
     """
     if self.mark_pending_return_date:
       time_since = datetime.datetime.utcnow() - self.mark_pending_return_date
@@ -601,6 +798,8 @@ class Device(base_model.BaseModel):
             user_email,
             message='Resuming loan for device %s, since use continued.' %
             self.identifier)
+        return True
+    return False
 
   @validate_assignee_or_admin
   def loan_extend(self, user_email, extend_date_time):
@@ -672,6 +871,91 @@ class Device(base_model.BaseModel):
     self.last_known_healthy = now
     self.put()
 
+  def buffer_heartbeat(self):
+    """Records a heartbeat in memcache to be written by flush_heartbeats.
+
+    The first heartbeat buffered since the device was last flushed also adds
+    its key to the heartbeat pull queue, so a flush only reads the devices
+    that have something to write. If that fails, the error is logged and the
+    next heartbeat adds it instead.
+    """
+    urlsafe_key = self.key.urlsafe()
+    memcache.set(
+        urlsafe_key, datetime.datetime.utcnow(),
+        time=_HEARTBEAT_BUFFER_TTL, namespace=_HEARTBEAT_NAMESPACE)
+    if not memcache.add(
+        urlsafe_key, True, time=_HEARTBEAT_BUFFER_TTL,
+        namespace=_HEARTBEAT_PENDING_NAMESPACE):
+      return
+    try:
+      taskqueue.Queue(_HEARTBEAT_QUEUE).add(
+          taskqueue.Task(payload=urlsafe_key, method='PULL'))
+    except taskqueue.Error as err:
+      # Let the next heartbeat try again.
+      memcache.delete(urlsafe_key, namespace=_HEARTBEAT_PENDING_NAMESPACE)
+      logging.warning(_HEARTBEAT_ENQUEUE_FAILED_MSG, self.identifier, err)
+
+  @classmethod
+  def flush_heartbeats(cls, batch_size=_HEARTBEAT_FLUSH_BATCH_SIZE):
+    """Writes heartbeats buffered in memcache to datastore in batches.
+
+    The devices to write are leased from the heartbeat pull queue. Buffered
+    entries are left in memcache to expire on their own; a device is only
+    written when its buffered heartbeat is newer than the stored one, so an
+    entry is never written twice and a heartbeat recorded during the flush is
+    not lost. A batch that fails is left in the queue for the next flush.
+
+    Args:
+      batch_size: int, the number of devices to read and write per batch.
+
+    Returns:
+      The number of devices updated.
+    """
+    queue = taskqueue.Queue(_HEARTBEAT_QUEUE)
+    flushed = 0
+    while True:
+      tasks = queue.lease_tasks(_HEARTBEAT_LEASE_SECONDS, batch_size)
+      if not tasks:
+        break
+      urlsafe_keys = sorted(set(task.payload for task in tasks))
+      # Clear the pending markers first so heartbeats buffered while this
+      # batch is written are enqueued again rather than missed.
+      memcache.delete_multi(
+          urlsafe_keys, namespace=_HEARTBEAT_PENDING_NAMESPACE)
+      flushed += cls._flush_heartbeat_batch(
+          [ndb.Key(urlsafe=urlsafe_key) for urlsafe_key in urlsafe_keys])
+      queue.delete_tasks(tasks)
+      if len(tasks) < batch_size:
+        break
+    logging.info(_HEARTBEAT_FLUSH_MSG, flushed)
+    return flushed
+
+  @classmethod
+  def _flush_heartbeat_batch(cls, keys):
+    """Writes buffered heartbeats for one batch of device keys.
+
+    Each device is updated in its own transaction, run concurrently, so a
+    change to the device committed since the flush read it is never
+    overwritten.
+
+    Args:
+      keys: List[ndb.Key], the device keys to flush.
+
+    Returns:
+      The number of devices updated.
+
+    Raises:
+      datastore_errors.TransactionFailedError: if a device could not be
+          updated. The other devices are still updated.
+    """
+    heartbeats = memcache.get_multi(
+        [key.urlsafe() for key in keys], namespace=_HEARTBEAT_NAMESPACE)
+    futures = [
+        _apply_heartbeat(ndb.Key(urlsafe=urlsafe_key), heartbeat)
+        for urlsafe_key, heartbeat in heartbeats.items()]
+    ndb.Future.wait_all(futures)
+    return sum(1 for future in futures if future.get_result())
+
   @validate_assignee_or_admin
   def mark_pending_return(self, user_email):
     """Marks a device as returned, as reported by the user.
@@ -705,7 +989,7 @@ class Device(base_model.BaseModel):
         level=reminder_level, time=datetime.datetime.utcnow(), count=count + 1)
     self.put()
 
-  def set_next_reminder(self, reminder_level, delay_delta):
+  def set_next_reminder(self, reminder_level, delay_delta, put=True):
     """Sets the next_reminder for a loaned device, overwriting existing one.
 
     Args:
@@ -713,10 +997,13 @@ class Device(base_model.BaseModel):
           rule's reminder_level.
       delay_delta: datetime.timedelta, noting time to wait until the reminder
           should happen, which this method will record as a UTC datetime.
+      put: bool, whether to put the device, or leave it to the caller to put
+          it with others.
     """
     reminder_time = datetime.datetime.utcnow() + delay_delta
     self.next_reminder = Reminder(level=reminder_level, time=reminder_time)
-    self.put()
+    if put:
+      self.put()
 
   @validate_assignee_or_admin
   def mark_damaged(self, user_email, damaged_reason=None):
@@ -914,6 +1201,72 @@ class Device(base_model.BaseModel):
             user_email, 'Removing device: %s from shelf: %s' % (
                 self.identifier, shelf.location))
 
+  @classmethod
+  def audit_shelf(cls, shelf, devices, user_email):
+    """Reconciles the devices recorded on a shelf with an audit of the shelf.
+
+    Scanned devices not yet on the shelf are checked into it, and devices
+    recorded on the shelf that were not scanned are removed from it. The
+    changes are written with a single put_multi and one search index batch,
+    and one BigQuery row records them all. Devices still on loan go through
+    move_to_shelf so the loan is returned as usual.
+
+    Args:
+      shelf: shelf_model.Shelf, the shelf being audited.
+      devices: List[Device], the devices scanned on the shelf.
+      user_email: str, the email of the user taking the action.
+
+    Returns:
+      A ShelfAuditResult of the lists of devices already on the shelf, checked
+      into it, and removed from it.
+
+    Raises:
+      UnableToMoveToShelfError: if the shelf is not enabled.
+    """
+    if not shelf.enabled:
+      raise UnableToMoveToShelfError(
+          _AUDIT_SHELF_DISABLED_MSG % shelf.location)
+    now = datetime.datetime.utcnow()
+    scanned_keys = set()
+    already_on_shelf = []
+    checked_in = []
+    changed = []
+    for device in devices:
+      if device.key in scanned_keys:
+        continue
+      scanned_keys.add(device.key)
+      if device.shelf == shelf.key:
+        already_on_shelf.append(device)
+        continue
+      if device.assigned_user:
+        device.move_to_shelf(shelf=shelf, user_email=user_email)
+      else:
+        device.shelf = shelf.key
+        device.last_known_healthy = now
+        changed.append(device)
+      checked_in.append(device)
+
+    leaving_keys = [
+        key for key in cls.query(cls.shelf == shelf.key).iter(keys_only=True)
+        if key not in scanned_keys]
+    removed = [
+        device for device in ndb.get_multi(leaving_keys)
+        if device and device.shelf == shelf.key]
+    for device in removed:
+      device.shelf = None
+      changed.append(device)
+
+    if changed:
+      cls.put_multi_and_index(changed)
+    if checked_in or removed:
+      summary = _AUDIT_SHELF_CHANGES_MSG % (
+          shelf.location,
+          ', '.join(device.identifier for device in checked_in),
+          ', '.join(device.identifier for device in removed))
+      logging.info(summary)
+      shelf.stream_to_bq(user_email, summary)
+    return ShelfAuditResult(already_on_shelf, checked_in, removed)
+
   def associate_tag(self, user_email, tag_name, more_info=None):
     """Associates a tag with a device.
 
@@ -966,6 +1319,28 @@ class Device(base_model.BaseModel):
         tag_name, self.identifier)
 
 
+# Cross-group, as the device's put hook may write its DeviceLookup entities.
+@ndb.transactional_tasklet(xg=True)
+def _apply_heartbeat(key, heartbeat):
+  """Writes a buffered heartbeat to a device if it is newer than the stored one.
+
+  Args:
+    key: ndb.Key, the key of the device.
+    heartbeat: datetime, the buffered heartbeat.
+
+  Returns:
+    A future for whether the device was updated.
+  """
+  device = yield key.get_async()
+  if not device or (
+      device.last_heartbeat and device.last_heartbeat >= heartbeat):
+    raise ndb.Return(False)
+  device.last_heartbeat = heartbeat
+  device.last_known_healthy = heartbeat
+  yield device.put_async()
+  raise ndb.Return(True)
+
+
 def _update_existing_device(device, user_email, asset_tag=None):
   """Updates an existing device entity during a re-enrollment.
 
@@ -26,6 +26,7 @@ import freezegun
 import mock
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.ext import deferred
 
@@ -570,6 +571,101 @@ class DeviceModelTest(parameterized.TestCase, loanertest.TestCase):
         device_model.Device.get(identifier=' 123456 '),
         whitespace_test_device)
 
+  def test_put_writes_identifier_lookups(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456', asset_tag='ABCDE',
+        chrome_device_id='unique_id').put().get()
+    for lookup_id in (
+        'serial_number:123456', 'asset_tag:ABCDE', 'chrome_device_id:unique_id'):
+      self.assertEqual(
+          device_model.DeviceLookup.get_by_id(lookup_id).device, device.key)
+
+  def test_put_skips_mapped_identifier_lookups(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456').put().get()
+    with mock.patch.object(device_model.ndb, 'put_multi') as mock_put_multi:
+      device._update_identifier_lookups()
+      self.assertFalse(mock_put_multi.called)
+
+  def test_put_rewrites_identifier_lookups_deleted_elsewhere(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456').put().get()
+    # Another instance cleaned up the lookup; this instance still caches it.
+    memcache.delete('serial_number:123456', namespace='device_identifier')
+    device_model.DeviceLookup.get_by_id('serial_number:123456').key.delete()
+
+    device.put()
+    self.assertEqual(
+        device_model.DeviceLookup.get_by_id('serial_number:123456').device,
+        device.key)
+
+  def test_get_uses_identifier_lookups(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456', asset_tag='ABCDE',
+        chrome_device_id='unique_id').put().get()
+    device_model._identifier_cache.clear()
+    memcache.flush_all()
+
+    with mock.patch.object(device_model.Device, 'query') as mock_query:
+      self.assertEqual(
+          device_model.Device.get(chrome_device_id='unique_id'), device)
+      self.assertEqual(device_model.Device.get(identifier='abcde'), device)
+      self.assertFalse(mock_query.called)
+
+  def test_get_stale_identifier_lookup(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456',
+        chrome_device_id='unique_id').put().get()
+    other = device_model.Device(
+        enrolled=False, serial_number='654321',
+        chrome_device_id='other_id').put()
+    device_model._identifier_cache.clear()
+    memcache.flush_all()
+    device_model.DeviceLookup(id='chrome_device_id:unique_id', device=other).put()
+
+    self.assertEqual(
+        device_model.Device.get(chrome_device_id='unique_id'), device)
+    self.assertEqual(
+        device_model.DeviceLookup.get_by_id(
+            'chrome_device_id:unique_id').device, device.key)
+
+  def test_get_backfills_missing_identifier_lookup(self):
+    device = device_model.Device(
+        enrolled=False, serial_number='123456').put().get()
+    device.key.delete()
+    device_model.DeviceLookup.get_by_id('serial_number:123456').key.delete()
+    device_model._identifier_cache.clear()
+    memcache.flush_all()
+    # Store the device without running the put hook, as legacy data would be.
+    with mock.patch.object(device_model.Device, '_post_put_hook'):
+      device.put()
+
+    self.assertEqual(device_model.Device.get(serial_number='123456'), device)
+    self.assertEqual(
+        device_model.DeviceLookup.get_by_id('serial_number:123456').device,
+        device.key)
+
+  def test_get_multi_by_identifiers(self):
+    device1 = device_model.Device(
+        enrolled=False, serial_number='123456', asset_tag='ABCDE').put().get()
+    device2 = device_model.Device(
+        enrolled=False, serial_number='654321', asset_tag='EDCBA').put().get()
+
+    with mock.patch.object(
+        device_model.ndb, 'get_multi',
+        wraps=device_model.ndb.get_multi) as mock_get_multi:
+      results = device_model.Device.get_multi_by_identifiers(
+          ['123456', 'edcba', 'unknown'])
+      # One batch for the uncached lookups and one for the devices.
+      self.assertEqual(mock_get_multi.call_count, 2)
+    self.assertEqual(
+        results, {'123456': device1, 'edcba': device2, 'unknown': None})
+
+    self.assertEqual(
+        device_model.Device.get_multi_by_identifiers(
+            ['ABCDE'], field='serial_number'),
+        {'ABCDE': None})
+
   def test_is_overdue(self):
     now = datetime.datetime(year=2017, month=1, day=1)
     with freezegun.freeze_time(now):
@@ -653,12 +749,14 @@ class DeviceModelTest(parameterized.TestCase, loanertest.TestCase):
 
     # Heartbeat arrives a minute before end of grace period, s'allright.
     with freezegun.freeze_time(resume_time + within_grace_period):
-      self.test_device.loan_resumes_if_late(loanertest.USER_EMAIL)
+      self.assertFalse(
+          self.test_device.loan_resumes_if_late(loanertest.USER_EMAIL))
       self.assertEqual(mock_resume_loan.call_count, 0)
 
     # Heartbeat arrives a minute later, no dice.
     with freezegun.freeze_time(resume_time + beyond_grace_period):
-      self.test_device.loan_resumes_if_late(loanertest.USER_EMAIL)
+      self.assertTrue(
+          self.test_device.loan_resumes_if_late(loanertest.USER_EMAIL))
       self.assertEqual(mock_resume_loan.call_count, 1)
 
   def test_loan_assign_unenrolled(self):
@@ -786,6 +884,97 @@ class DeviceModelTest(parameterized.TestCase, loanertest.TestCase):
       self.assertEqual(now, self.test_device.last_heartbeat)
       self.assertEqual(now, self.test_device.last_known_healthy)
 
+  @mock.patch.object(device_model.taskqueue, 'Queue', autospec=True)
+  def test_buffer_and_flush_heartbeats(self, mock_queue):
+    self.enroll_test_device(loanertest.TEST_DIR_DEVICE_DEFAULT)
+    self.assertIsNone(self.test_device.last_heartbeat)
+    now = datetime.datetime(year=2017, month=1, day=1)
+    with freezegun.freeze_time(now):
+      self.test_device.buffer_heartbeat()
+      self.test_device.buffer_heartbeat()
+    self.assertIsNone(self.test_device.key.get().last_heartbeat)
+    # The device is only enqueued once until it is flushed.
+    mock_queue.assert_called_with(device_model._HEARTBEAT_QUEUE)
+    mock_queue.return_value.add.assert_called_once_with(mock.ANY)
+    task = mock_queue.return_value.add.call_args[0][0]
+    self.assertEqual(task.payload, self.test_device.key.urlsafe())
+
+    mock_queue.return_value.lease_tasks.side_effect = [[task], []]
+    self.assertEqual(device_model.Device.flush_heartbeats(), 1)
+    mock_queue.return_value.delete_tasks.assert_called_once_with([task])
+    device = self.test_device.key.get()
+    self.assertEqual(device.last_heartbeat, now)
+    self.assertEqual(device.last_known_healthy, now)
+
+    # A second flush with nothing newer buffered writes nothing.
+    self.assertEqual(device_model.Device.flush_heartbeats(), 0)
+
+  @mock.patch.object(device_model.logging, 'warning')
+  @mock.patch.object(device_model.taskqueue, 'Queue', autospec=True)
+  def test_buffer_heartbeat_enqueue_error(self, mock_queue, mock_warning):
+    self.enroll_test_device(loanertest.TEST_DIR_DEVICE_DEFAULT)
+    mock_queue.return_value.add.side_effect = [
+        device_model.taskqueue.TransientError, None]
+
+    # The heartbeat is buffered and the error logged, not raised.
+    self.test_device.buffer_heartbeat()
+    mock_warning.assert_called_once_with(
+        device_model._HEARTBEAT_ENQUEUE_FAILED_MSG,
+        self.test_device.identifier, mock.ANY)
+    self.assertIsNotNone(memcache.get(
+        self.test_device.key.urlsafe(),
+        namespace=device_model._HEARTBEAT_NAMESPACE))
+
+    # The next heartbeat enqueues the device again.
+    self.test_device.buffer_heartbeat()
+    self.assertEqual(mock_queue.return_value.add.call_count, 2)
+
+  @mock.patch.object(device_model.taskqueue, 'Queue', autospec=True)
+  def test_flush_heartbeats_keeps_newer_stored_heartbeat(self, mock_queue):
+    self.enroll_test_device(loanertest.TEST_DIR_DEVICE_DEFAULT)
+    with freezegun.freeze_time(datetime.datetime(year=2017, month=1, day=1)):
+      self.test_device.buffer_heartbeat()
+    newer = datetime.datetime(year=2017, month=1, day=2)
+    with freezegun.freeze_time(newer):
+      self.test_device.record_heartbeat()
+
+    mock_queue.return_value.lease_tasks.return_value = [
+        mock_queue.return_value.add.call_args[0][0]]
+    self.assertEqual(device_model.Device.flush_heartbeats(), 0)
+    self.assertEqual(self.test_device.key.get().last_heartbeat, newer)
+
+  @mock.patch.object(device_model.taskqueue, 'Queue', autospec=True)
+  def test_flush_heartbeats_keeps_concurrent_changes(self, mock_queue):
+    self.enroll_test_device(loanertest.TEST_DIR_DEVICE_DEFAULT)
+    self.test_device.buffer_heartbeat()
+    # The device is assigned after the heartbeat was buffered.
+    device = self.test_device.key.get()
+    device.assigned_user = loanertest.USER_EMAIL
+    device.put()
+
+    mock_queue.return_value.lease_tasks.return_value = [
+        mock_queue.return_value.add.call_args[0][0]]
+    self.assertEqual(device_model.Device.flush_heartbeats(), 1)
+    device = self.test_device.key.get()
+    self.assertIsNotNone(device.last_heartbeat)
+    self.assertEqual(device.assigned_user, loanertest.USER_EMAIL)
+
+  @mock.patch.object(device_model.taskqueue, 'Queue', autospec=True)
+  @mock.patch.object(device_model.Device, '_flush_heartbeat_batch')
+  def test_flush_heartbeats_batches(self, mock_flush_batch, mock_queue):
+    mock_flush_batch.return_value = 0
+    tasks = []
+    for serial in ('1', '2', '3'):
+      key = device_model.Device(serial_number=serial, enrolled=False).put()
+      tasks.append(device_model.taskqueue.Task(
+          payload=key.urlsafe(), method='PULL'))
+    mock_queue.return_value.lease_tasks.side_effect = [tasks[:2], tasks[2:]]
+
+    device_model.Device.flush_heartbeats(batch_size=2)
+    self.assertEqual(
+        [len(call[0][0]) for call in mock_flush_batch.call_args_list], [2, 1])
+    self.assertEqual(mock_queue.return_value.delete_tasks.call_count, 2)
+
   def test_mark_pending_return(self):
     self.enroll_test_device(loanertest.TEST_DIR_DEVICE_DEFAULT)
     self.test_device.assigned_user = loanertest.USER_EMAIL
@@ -1001,6 +1190,45 @@ class DeviceModelTest(parameterized.TestCase, loanertest.TestCase):
         shelf=self.shelf, user_email=loanertest.USER_EMAIL)
     self.assertIsNone(self.test_device.shelf)
 
+  @mock.patch.object(device_model.Device, 'move_to_shelf', autospec=True)
+  @mock.patch.object(shelf_model.Shelf, 'stream_to_bq')
+  def test_audit_shelf(self, mock_stream, mock_move_to_shelf):
+    on_shelf = device_model.Device(
+        serial_number='ON_SHELF', shelf=self.shelf.key).put().get()
+    arriving = device_model.Device(serial_number='ARRIVING').put().get()
+    on_loan = device_model.Device(
+        serial_number='ON_LOAN', assigned_user=loanertest.USER_EMAIL
+    ).put().get()
+    leaving = device_model.Device(
+        serial_number='LEAVING', shelf=self.shelf.key).put().get()
+
+    with mock.patch.object(
+        device_model.Device, 'put_multi_and_index',
+        wraps=device_model.Device.put_multi_and_index) as mock_put_multi:
+      result = device_model.Device.audit_shelf(
+          self.shelf, [on_shelf, arriving, on_loan, arriving],
+          loanertest.USER_EMAIL)
+      mock_put_multi.assert_called_once_with(mock.ANY)
+      self.assertCountEqual(
+          [device.key for device in mock_put_multi.call_args[0][0]],
+          [arriving.key, leaving.key])
+
+    self.assertEqual(result.already_on_shelf, [on_shelf])
+    self.assertEqual(result.checked_in, [arriving, on_loan])
+    self.assertEqual([device.key for device in result.removed], [leaving.key])
+    self.assertEqual(arriving.key.get().shelf, self.shelf.key)
+    self.assertIsNone(leaving.key.get().shelf)
+    mock_move_to_shelf.assert_called_once_with(
+        on_loan, shelf=self.shelf, user_email=loanertest.USER_EMAIL)
+    mock_stream.assert_called_once_with(loanertest.USER_EMAIL, mock.ANY)
+
+  def test_audit_shelf_disabled(self):
+    self.shelf.enabled = False
+    with self.assertRaisesWithLiteralMatch(
+        device_model.UnableToMoveToShelfError,
+        device_model._AUDIT_SHELF_DISABLED_MSG % self.shelf.location):
+      device_model.Device.audit_shelf(self.shelf, [], loanertest.USER_EMAIL)
+
   def test_associate_tag(self):
     self.device1.associate_tag(
         user_email=loanertest.USER_EMAIL,
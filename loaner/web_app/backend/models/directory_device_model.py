@@ -0,0 +1,330 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local mirror of the Chrome OS devices in the Directory API."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import uuid
+
+from absl import logging
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from loaner.web_app import constants
+from loaner.web_app.backend.clients import directory
+
+_SYNC_STATE_ID = 'directory_devices'
+# Pages of devices one sync task handles before deferring the rest.
+_SYNC_PAGES_PER_TASK = 20
+_LAST_SYNC = u'lastSync'
+_SYNC_QUERY = 'sync:%s..'
+_SYNC_PAGE_MSG = 'Mirrored %d Chrome devices from the directory.'
+_SYNC_DONE_MSG = 'Directory device sync complete, watermark is now %s.'
+_SYNC_LEASED_MSG = 'Directory device sync already running, skipping.'
+_SYNC_LEASE_LOST_MSG = 'Directory device sync lease was taken over, stopping.'
+_SYNC_DELETED_MSG = 'Deleted %d mirrored devices no longer in the directory.'
+# How long a sync task holds the sync before another may take it over. Each
+# page renews it, so only a task that stopped without finishing loses it.
+_SYNC_LEASE = datetime.timedelta(minutes=15)
+# A sync of every device, which also drops the mirrored devices it did not
+# see, runs at least this often; the others only fetch recently synced ones.
+_FULL_SYNC_INTERVAL = datetime.timedelta(days=1)
+_DELETE_BATCH_SIZE = 500
+
+
+def _parse_last_sync(value):
+  """Parses a lastSync value from the Directory API.
+
+  Args:
+    value: str or datetime, an RFC 3339 timestamp, e.g.
+        '2018-01-01T12:00:00.000Z', or an already parsed datetime.
+
+  Returns:
+    A datetime, or None if the device has never synced.
+  """
+  if not value or isinstance(value, datetime.datetime):
+    return value or None
+  return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+class DirectoryDevice(ndb.Model):
+  """Datastore model mirroring a Chrome OS device in the Directory API.
+
+  Entities are keyed by the device's upper case serial number.
+
+  Attributes:
+    device_id: str, the unique Chrome device ID.
+    model: str, the model name of the device.
+    org_unit_path: str, the organizational unit the device was last seen in.
+    last_sync: datetime, the last time the device synced its policy.
+    mirrored: datetime, the last time the device was fetched from the
+        directory.
+  """
+  device_id = ndb.StringProperty()
+  model = ndb.StringProperty(indexed=False)
+  org_unit_path = ndb.StringProperty(indexed=False)
+  last_sync = ndb.DateTimeProperty(indexed=False)
+  mirrored = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def from_directory(cls, directory_device):
+    """Builds an entity from a Directory API device.
+
+    Args:
+      directory_device: dict, a JSON object of kind
+          admin#directory#chromeosdevice.
+
+    Returns:
+      A DirectoryDevice, or None if the device has no serial number.
+    """
+    serial_number = directory_device.get(directory.SERIAL_NUMBER)
+    if not serial_number:
+      return None
+    return cls(
+        id=serial_number.upper(),
+        device_id=directory_device.get(directory.DEVICE_ID),
+        model=directory_device.get(directory.MODEL),
+        org_unit_path=directory_device.get(directory.ORG_UNIT_PATH),
+        last_sync=_parse_last_sync(directory_device.get(_LAST_SYNC)))
+
+  def to_directory(self):
+    """Returns the device in the shape the Directory API returns it."""
+    return {
+        directory.DEVICE_ID: self.device_id,
+        directory.SERIAL_NUMBER: self.key.id(),
+        directory.MODEL: self.model,
+        directory.ORG_UNIT_PATH: self.org_unit_path,
+    }
+
+
+class DirectorySyncState(ndb.Model):
+  """Datastore model recording the progress of the directory device sync.
+
+  Attributes:
+    watermark: datetime, the newest lastSync mirrored by a completed sync.
+    query: str, the search query of the sync in progress.
+    page_token: str, the next page of the sync in progress.
+    newest_sync: datetime, the newest lastSync seen by the sync in progress.
+    full_sync: datetime, when the last completed sync of every device began.
+    sync_started: datetime, when the sync in progress began.
+    lease_id: str, the ID of the sync task holding the sync.
+    lease_expires: datetime, when the holder's lease runs out.
+    modified: datetime, the last time the state was written.
+  """
+  watermark = ndb.DateTimeProperty(indexed=False)
+  query = ndb.StringProperty(indexed=False)
+  page_token = ndb.StringProperty(indexed=False)
+  newest_sync = ndb.DateTimeProperty(indexed=False)
+  full_sync = ndb.DateTimeProperty(indexed=False)
+  sync_started = ndb.DateTimeProperty(indexed=False)
+  lease_id = ndb.StringProperty(indexed=False)
+  lease_expires = ndb.DateTimeProperty(indexed=False)
+  modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  @property
+  def full(self):
+    """Whether the sync in progress fetches every device."""
+    return self.sync_started is not None and self.query is None
+
+
+def get_chrome_device_by_serial(directory_client, serial_number):
+  """Gets a device's directory info by serial number, from the mirror first.
+
+  Args:
+    directory_client: directory.DirectoryApiClient, the client to fall back to
+        when the device has not been mirrored yet.
+    serial_number: str, the serial number of the device.
+
+  Returns:
+    A dictionary based on a JSON object of kind admin#directory#chromeosdevice.
+
+  Raises:
+    directory.DeviceDoesNotExistError: if the device is not in the directory.
+    directory.DirectoryRPCError: if the fallback call to the directory fails.
+  """
+  mirrored = DirectoryDevice.get_by_id(serial_number.upper())
+  if mirrored and mirrored.device_id:
+    return mirrored.to_directory()
+  directory_device = directory_client.get_chrome_device_by_serial(
+      serial_number)
+  _mirror(directory_device)
+  return directory_device
+
+
+def get_chrome_device(directory_client, device_id):
+  """Gets a device's directory info by Chrome device ID, from the mirror first.
+
+  Args:
+    directory_client: directory.DirectoryApiClient, the client to fall back to
+        when the device has not been mirrored yet.
+    device_id: str, the unique Chrome device ID.
+
+  Returns:
+    A dictionary based on a JSON object of kind admin#directory#chromeosdevice,
+    or None if the device is not in the directory.
+
+  Raises:
+    directory.DirectoryRPCError: if the fallback call to the directory fails.
+  """
+  mirrored = DirectoryDevice.query(
+      DirectoryDevice.device_id == device_id).get()
+  if mirrored:
+    return mirrored.to_directory()
+  directory_device = directory_client.get_chrome_device(device_id)
+  if directory_device:
+    _mirror(directory_device)
+  return directory_device
+
+
+def _mirror(directory_device):
+  """Stores a device fetched by a live call in the mirror."""
+  mirrored = DirectoryDevice.from_directory(directory_device)
+  if mirrored:
+    mirrored.put()
+
+
+def sync_directory_devices(lease_id=None):
+  """Mirrors the devices that synced since the last completed sync.
+
+  Pages through the organization's Chrome devices in lastSync order, starting
+  from the day of the watermark, writing each page with a single put_multi.
+  Progress is saved after every page, and after _SYNC_PAGES_PER_TASK pages the
+  rest of the sync is deferred, so a sync of the whole fleet resumes where it
+  stopped rather than starting over.
+
+  The sync is leased to one task at a time, which passes the lease on to the
+  task it defers, so the cron and a continuation never advance it together.
+  Once every _FULL_SYNC_INTERVAL the sync fetches every device instead, and
+  deletes the mirrored devices it did not see, which were removed from the
+  directory.
+
+  Args:
+    lease_id: str, the lease passed on by the task that deferred this one.
+  """
+  lease_id, state = _take_sync_lease(lease_id)
+  if not state:
+    logging.info(_SYNC_LEASED_MSG)
+    return
+  if not state.page_token:
+    state.sync_started = datetime.datetime.utcnow()
+    full = not (
+        state.watermark and state.full_sync and
+        state.sync_started - state.full_sync < _FULL_SYNC_INTERVAL)
+    state.query = (
+        None if full else
+        _SYNC_QUERY % state.watermark.strftime('%Y-%m-%d'))
+    state.newest_sync = state.watermark
+  client = directory.DirectoryApiClient(constants.ADMIN_EMAIL)
+
+  for _ in range(_SYNC_PAGES_PER_TASK):
+    response = client.list_chrome_devices(
+        query=state.query, page_token=state.page_token)
+    mirrored = [
+        device for device in (
+            DirectoryDevice.from_directory(directory_device)
+            for directory_device in response.get('chromeosdevices', []))
+        if device]
+    ndb.put_multi(mirrored)
+    logging.info(_SYNC_PAGE_MSG, len(mirrored))
+    for device in mirrored:
+      if device.last_sync and (
+          not state.newest_sync or device.last_sync > state.newest_sync):
+        state.newest_sync = device.last_sync
+    state.page_token = response.get('nextPageToken')
+    if not state.page_token:
+      if state.full:
+        _delete_unseen(state.sync_started)
+        state.full_sync = state.sync_started
+      state.watermark = state.newest_sync
+      state.query = None
+      state.sync_started = None
+      state.lease_id = None
+      if _save_sync_state(state, lease_id):
+        logging.info(_SYNC_DONE_MSG, state.watermark)
+      return
+    if not _save_sync_state(state, lease_id):
+      return
+  deferred.defer(sync_directory_devices, lease_id)
+
+
+@ndb.transactional
+def _take_sync_lease(lease_id):
+  """Takes the sync for a task, unless another task holds it.
+
+  Args:
+    lease_id: str, the lease passed on by the task that deferred this one, or
+        None for a new task.
+
+  Returns:
+    A tuple of the task's lease ID and the DirectorySyncState, or of None and
+    None if another task holds the sync.
+  """
+  state = DirectorySyncState.get_by_id(_SYNC_STATE_ID)
+  if not state:
+    state = DirectorySyncState(id=_SYNC_STATE_ID)
+  now = datetime.datetime.utcnow()
+  if (state.lease_id and state.lease_id != lease_id and
+      state.lease_expires and state.lease_expires > now):
+    return None, None
+  state.lease_id = lease_id or uuid.uuid4().hex
+  state.lease_expires = now + _SYNC_LEASE
+  state.put()
+  return state.lease_id, state
+
+
+@ndb.transactional
+def _save_sync_state(state, lease_id):
+  """Saves the sync's progress and renews its lease, if it still holds it.
+
+  Args:
+    state: DirectorySyncState, the progress to save.
+    lease_id: str, the task's lease ID.
+
+  Returns:
+    True if the state was saved, or False if another task took the sync over.
+  """
+  stored = DirectorySyncState.get_by_id(_SYNC_STATE_ID)
+  if stored and stored.lease_id != lease_id:
+    logging.warning(_SYNC_LEASE_LOST_MSG)
+    return False
+  if state.lease_id:
+    state.lease_expires = datetime.datetime.utcnow() + _SYNC_LEASE
+  state.put()
+  return True
+
+
+def _delete_unseen(sync_started):
+  """Deletes mirrored devices not fetched since a full sync began.
+
+  Args:
+    sync_started: datetime, when the full sync began.
+  """
+  deleted = 0
+  keys = []
+  for key in DirectoryDevice.query(
+      DirectoryDevice.mirrored < sync_started).iter(keys_only=True):
+    keys.append(key)
+    if len(keys) >= _DELETE_BATCH_SIZE:
+      ndb.delete_multi(keys)
+      deleted += len(keys)
+      keys = []
+  if keys:
+    ndb.delete_multi(keys)
+    deleted += len(keys)
+  logging.info(_SYNC_DELETED_MSG, deleted)
@@ -0,0 +1,187 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for backend.models.directory_device_model."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+
+import freezegun
+import mock
+
+from loaner.web_app.backend.clients import directory
+from loaner.web_app.backend.models import directory_device_model
+from loaner.web_app.backend.testing import loanertest
+
+
+def _directory_device(serial_number, last_sync):
+  return {
+      'deviceId': 'id_%s' % serial_number,
+      'serialNumber': serial_number,
+      'model': 'HP Chromebook 13 G1',
+      'orgUnitPath': '/',
+      'lastSync': last_sync,
+  }
+
+
+class DirectoryDeviceModelTest(loanertest.TestCase):
+  """Tests for the directory device mirror."""
+
+  def setUp(self):
+    super(DirectoryDeviceModelTest, self).setUp()
+    patcher = mock.patch.object(
+        directory_device_model.directory, 'DirectoryApiClient', autospec=True)
+    self.mock_client_class = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.mock_client = self.mock_client_class.return_value
+
+  def test_from_directory(self):
+    mirrored = directory_device_model.DirectoryDevice.from_directory(
+        _directory_device('abc123', '2018-01-02T03:04:05.678Z'))
+    self.assertEqual(mirrored.key.id(), 'ABC123')
+    self.assertEqual(mirrored.device_id, 'id_abc123')
+    self.assertEqual(
+        mirrored.last_sync, datetime.datetime(2018, 1, 2, 3, 4, 5))
+    self.assertIsNone(
+        directory_device_model.DirectoryDevice.from_directory({}))
+
+  def test_get_chrome_device_by_serial_mirrored(self):
+    directory_device_model.DirectoryDevice.from_directory(
+        loanertest.TEST_DIR_DEVICE1).put()
+    directory_info = directory_device_model.get_chrome_device_by_serial(
+        self.mock_client, '123456')
+    self.assertEqual(directory_info[directory.DEVICE_ID], 'unique_id')
+    self.assertEqual(directory_info[directory.ORG_UNIT_PATH], '/')
+    self.assertFalse(self.mock_client.get_chrome_device_by_serial.called)
+
+  def test_get_chrome_device_by_serial_fallback(self):
+    self.mock_client.get_chrome_device_by_serial.return_value = (
+        loanertest.TEST_DIR_DEVICE1)
+    self.assertEqual(
+        directory_device_model.get_chrome_device_by_serial(
+            self.mock_client, '123456'),
+        loanertest.TEST_DIR_DEVICE1)
+    self.mock_client.get_chrome_device_by_serial.assert_called_once_with(
+        '123456')
+    self.assertIsNotNone(
+        directory_device_model.DirectoryDevice.get_by_id('123456'))
+
+  def test_get_chrome_device_mirrored(self):
+    directory_device_model.DirectoryDevice.from_directory(
+        loanertest.TEST_DIR_DEVICE1).put()
+    directory_info = directory_device_model.get_chrome_device(
+        self.mock_client, 'unique_id')
+    self.assertEqual(directory_info[directory.SERIAL_NUMBER], '123456')
+    self.assertFalse(self.mock_client.get_chrome_device.called)
+
+  def test_get_chrome_device_not_in_directory(self):
+    self.mock_client.get_chrome_device.return_value = None
+    self.assertIsNone(directory_device_model.get_chrome_device(
+        self.mock_client, 'unknown_id'))
+    self.assertEqual(
+        directory_device_model.DirectoryDevice.query().count(), 0)
+
+  def test_sync_directory_devices(self):
+    self.mock_client.list_chrome_devices.side_effect = [
+        {'chromeosdevices': [
+            _directory_device('serial_1', '2018-01-01T00:00:00.000Z')],
+         'nextPageToken': 'page_2'},
+        {'chromeosdevices': [
+            _directory_device('serial_2', '2018-01-03T00:00:00.000Z')]},
+    ]
+    directory_device_model.sync_directory_devices()
+
+    self.mock_client.list_chrome_devices.assert_has_calls([
+        mock.call(query=None, page_token=None),
+        mock.call(query=None, page_token='page_2')])
+    self.assertEqual(
+        directory_device_model.DirectoryDevice.query().count(), 2)
+    state = directory_device_model.DirectorySyncState.get_by_id(
+        directory_device_model._SYNC_STATE_ID)
+    self.assertEqual(state.watermark, datetime.datetime(2018, 1, 3))
+    self.assertIsNone(state.page_token)
+
+    # The next sync only asks for devices synced since the watermark.
+    self.mock_client.list_chrome_devices.side_effect = [{}]
+    directory_device_model.sync_directory_devices()
+    self.mock_client.list_chrome_devices.assert_called_with(
+        query='sync:2018-01-03..', page_token=None)
+
+  @mock.patch.object(directory_device_model, '_SYNC_PAGES_PER_TASK', 1)
+  @mock.patch.object(directory_device_model.deferred, 'defer', autospec=True)
+  def test_sync_directory_devices_resumes(self, mock_defer):
+    self.mock_client.list_chrome_devices.return_value = {
+        'chromeosdevices': [
+            _directory_device('serial_1', '2018-01-01T00:00:00.000Z')],
+        'nextPageToken': 'page_2'}
+    directory_device_model.sync_directory_devices()
+    mock_defer.assert_called_once_with(
+        directory_device_model.sync_directory_devices, mock.ANY)
+    lease_id = mock_defer.call_args[0][1]
+    state = directory_device_model.DirectorySyncState.get_by_id(
+        directory_device_model._SYNC_STATE_ID)
+    self.assertEqual(state.page_token, 'page_2')
+    self.assertEqual(state.lease_id, lease_id)
+    self.assertIsNone(state.watermark)
+
+    # The cron does not run the sync while the deferred task holds it.
+    directory_device_model.sync_directory_devices()
+    self.assertEqual(self.mock_client.list_chrome_devices.call_count, 1)
+
+    # The deferred task picks up from the saved page.
+    self.mock_client.list_chrome_devices.return_value = {}
+    directory_device_model.sync_directory_devices(lease_id)
+    self.mock_client.list_chrome_devices.assert_called_with(
+        query=None, page_token='page_2')
+    state = directory_device_model.DirectorySyncState.get_by_id(
+        directory_device_model._SYNC_STATE_ID)
+    self.assertEqual(state.watermark, datetime.datetime(2018, 1, 1))
+    self.assertIsNone(state.lease_id)
+
+  @mock.patch.object(directory_device_model.deferred, 'defer', autospec=True)
+  def test_sync_directory_devices_takes_expired_lease(self, mock_defer):
+    directory_device_model.DirectorySyncState(
+        id=directory_device_model._SYNC_STATE_ID, lease_id='stopped',
+        lease_expires=datetime.datetime.utcnow() - datetime.timedelta(
+            minutes=1)).put()
+    self.mock_client.list_chrome_devices.return_value = {}
+    directory_device_model.sync_directory_devices()
+    self.mock_client.list_chrome_devices.assert_called_once_with(
+        query=None, page_token=None)
+    self.assertFalse(mock_defer.called)
+
+  def test_sync_directory_devices_deletes_unseen(self):
+    with freezegun.freeze_time(datetime.datetime(2018, 1, 1)):
+      directory_device_model.DirectoryDevice(
+          id='SERIAL_GONE', device_id='id_gone').put()
+    self.mock_client.list_chrome_devices.return_value = {
+        'chromeosdevices': [
+            _directory_device('serial_1', '2018-01-02T00:00:00.000Z')]}
+    directory_device_model.sync_directory_devices()
+
+    # The first sync fetches every device and drops the one it did not see.
+    self.assertEqual(
+        [key.id() for key in directory_device_model.DirectoryDevice.query(
+            ).fetch(keys_only=True)],
+        ['SERIAL_1'])
+    state = directory_device_model.DirectorySyncState.get_by_id(
+        directory_device_model._SYNC_STATE_ID)
+    self.assertIsNotNone(state.full_sync)
+
+
+if __name__ == '__main__':
+  loanertest.main()
@@ -18,7 +18,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import datetime
+import operator
 
 from absl import logging
 
@@ -32,6 +34,23 @@ _TIME_UNIT_IN_SECONDS = {
     'd': 86400,
     'w': 604800,
 }
+_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+_INEQUALITY_OPSYMBOLS = frozenset(['<', '<=', '!=', '>', '>='])
+_ORDERING_OPSYMBOLS = frozenset(['<', '<=', '>', '>='])
+_LESS_THAN_OPSYMBOLS = frozenset(['<', '<='])
+# The number of entities fetched at a time when matching a custom event.
+_MATCH_BATCH_SIZE = 500
+
+# Compiled custom event rules, keyed by event key, as (version, rule) pairs.
+_compiled_rules = {}
 
 
 class Error(Exception):
@@ -53,10 +72,15 @@ class CoreEvent(ndb.Model):
     description: A description for an Event.
     actions: Contains the friendly names of Actions.
     enabled: A boolean indicating whether the event is enabled.
+    parallel_async_actions: A boolean indicating whether the event's async
+        Actions are independent of each other and run in parallel, rather than
+        one after another, in order. Only set it for Actions that do not write
+        the same entity, as each one writes its own copy.
   """
   description = ndb.TextProperty()
   actions = ndb.StringProperty(repeated=True)
   enabled = ndb.BooleanProperty(default=True)
+  parallel_async_actions = ndb.BooleanProperty(default=False)
 
   @classmethod
   def create(cls, name, description=None):
@@ -154,22 +178,124 @@ class CustomEventCondition(ndb.Model):
     Returns:
        True if the entity matches, else False.
     """
-    entity_value = getattr(entity, self.name)
-    condition_value = _apply_timedelta(self.value)
-    if self.opsymbol in ['<', '<=', '>', '>='] and entity_value is None:
-      # Unset properties are set to None, and so are treated as 0 in
-      # comparisons; we prefer to filter.
-      return False
-    elif (
-        (self.opsymbol == '<' and entity_value < condition_value) or
-        (self.opsymbol == '<=' and entity_value <= condition_value) or
-        (self.opsymbol == '==' and entity_value == condition_value) or
-        (self.opsymbol == '!=' and entity_value != condition_value) or
-        (self.opsymbol == '>' and entity_value > condition_value) or
-        (self.opsymbol == '>=' and entity_value >= condition_value)):
+    return _match_value(
+        getattr(entity, self.name), self.opsymbol,
+        _apply_timedelta(self.value))
+
+
+class _CompiledRule(object):
+  """A custom event's conditions, split into a query and a predicate.
+
+  Conditions with timedelta values are relative to the time they are checked,
+  so the query and predicate are built from the compiled rule on each run. A
+  run split across tasks passes the same time to each of them, so that every
+  task builds the same query.
+
+  Attributes:
+    kind: str, the kind of entity the event matches.
+    query_filters: List[tuple], the (name, opsymbol, value) of each condition
+        the query can apply. This will be limited by Datastore's limitation to
+        having no more than one inequality filter.
+    less_than_properties: List[str], the names of properties in the event's
+        conditions using the < or <= operators. This allows a cron job to
+        filter entities that do not have these properties set, which
+        unfortunately matches < for queries.
+    extra_inequality_conditions: List[CustomEventCondition], the inequality
+        conditions that could not be used because of the aforementioned
+        Datastore limitation.
+  """
+
+  def __init__(self, kind, conditions):
+    self.kind = kind
+    self.query_filters = []
+    self.less_than_properties = []
+    self.extra_inequality_conditions = []
+    inequality_filter_seen = False
+    for condition in conditions:
+      if condition.opsymbol in _LESS_THAN_OPSYMBOLS:
+        self.less_than_properties.append(condition.name)
+      if condition.opsymbol in _INEQUALITY_OPSYMBOLS:
+        if inequality_filter_seen:
+          self.extra_inequality_conditions.append(condition)
+          continue
+        inequality_filter_seen = True
+      self.query_filters.append(
+          (condition.name, condition.opsymbol, condition.value))
+
+  def query(self, now=None):
+    """Builds the query for the entities that may match the event.
+
+    Args:
+      now: datetime, the time timedelta values are relative to, or None for
+          the current time.
+
+    Returns:
+      An ndb.Query for the event's kind.
+    """
+    return _build_query(self.kind, self.query_filters, now=now)
+
+  @property
+  def in_memory(self):
+    """Whether every condition can be checked in memory as well as queried."""
+    return all(opsymbol in _OPERATORS
+               for _, opsymbol, _ in self.query_filters)
+
+  def predicate(self, include_query_filters=False, now=None):
+    """Builds a function checking the conditions the query could not apply.
+
+    Args:
+      include_query_filters: bool, whether to check the conditions the query
+          applies too, for entities that were queried some other way.
+      now: datetime, the time timedelta values are relative to, or None for
+          the current time.
+
+    Returns:
+      A function taking a queried entity and returning True if it matches.
+    """
+    null_checks = [
+        operator.attrgetter(name) for name in self.less_than_properties]
+    conditions = [
+        (condition.name, condition.opsymbol, condition.value)
+        for condition in self.extra_inequality_conditions]
+    if include_query_filters:
+      conditions = self.query_filters + conditions
+    checks = [
+        (operator.attrgetter(name), opsymbol, _apply_timedelta(value, now))
+        for name, opsymbol, value in conditions]
+
+    def match(entity):
+      # Drop entities the query fetched because None is less than the value.
+      for get_value in null_checks:
+        if get_value(entity) is None:
+          return False
+      # Drop entities that don't match a condition left out of the query.
+      for get_value, opsymbol, value in checks:
+        if not _match_value(get_value(entity), opsymbol, value):
+          return False
       return True
-    else:
-      return False
+
+    return match
+
+  @staticmethod
+  def merge_queries(kind, rules, now=None):
+    """Builds one query for the entities that may match any of many rules.
+
+    Args:
+      kind: str, the kind of entity the rules match.
+      rules: List[_CompiledRule], the rules, all for the kind.
+      now: datetime, the time timedelta values are relative to, or None for
+          the current time.
+
+    Returns:
+      An ndb.Query using only the filters every rule has in common, other than
+      != filters, which would make it several queries that cannot be resumed
+      from a cursor.
+    """
+    query_filters = [
+        query_filter for query_filter in rules[0].query_filters
+        if query_filter[1] != '!=' and
+        all(query_filter in rule.query_filters for rule in rules[1:])]
+    return _build_query(kind, query_filters, now=now)
 
 
 class CustomEvent(CoreEvent):
@@ -191,78 +317,99 @@ class CustomEvent(CoreEvent):
     """Retrieves all enabled entities of this class."""
     return cls.query(cls.enabled == True).fetch()  # pylint: disable=g-explicit-bool-comparison,singleton-comparison
 
-  def _build_query_components(self):
-    """Builds a dict containing a query and other useful objects.
+  @property
+  def rule_version(self):
+    """A picklable tuple of the event's model and conditions.
+
+    This changes whenever the event's conditions are edited, so a run over
+    the event's matches can tell whether its query is still the same.
+    """
+    return (self.model, tuple(
+        (condition.name, condition.opsymbol, condition.value)
+        for condition in self.conditions))
+
+  def _compile(self):
+    """Compiles the event's conditions, reusing the last compiled version.
 
     Returns:
-      A dict containing the following keys:
-        query: an NDB query with as many filters as can be made from the event's
-            conditions. This will be limited by Datastore's limitation to having
-            no more than one inequality filter.
-        less_than_properties: a list of strings containing the names of
-            properties in the event's conditions using the < or <= operators.
-            This allows a cron job to filter entities that do not have these
-            properties set, which unfortunately matches < for queries).
-        extra_inequality_conditions: a list of inequality CustomEventConditions
-            that could not be used because of the aforementioned Datastore
-            limitation.
+      The _CompiledRule for the event's model and conditions.
     """
-    less_than_properties = []
-    query_filters = []
-    extra_inequality_conditions = []
-    inequality_filter_seen = False
+    version = self.rule_version
+    cached = _compiled_rules.get(self.key) if self.key else None
+    if cached and cached[0] == version:
+      return cached[1]
+    rule = _CompiledRule(self.model, self.conditions)
+    if self.key:
+      _compiled_rules[self.key] = (version, rule)
+    return rule
 
-    for condition in self.conditions:
-      if condition.opsymbol in ['<', '<=']:
-        less_than_properties.append(condition.name)
+  @classmethod
+  def build_matchers(cls, custom_events, now=None):
+    """Groups events into the queries that find the entities they match.
 
-      inequality_filter = condition.opsymbol in ['<', '<=', '!=', '>', '>=']
+    The events for each model share one query, using the filters they have in
+    common, so each entity is read once however many events there are. Every
+    event's conditions are then checked in memory against each entity, so the
+    query can leave out != filters and be paged with cursors. Events with
+    conditions that can only be queried get a query of their own.
 
-      if inequality_filter:
-        if inequality_filter_seen:
-          extra_inequality_conditions.append(condition)
-          continue
-        else:
-          inequality_filter_seen = True
+    Args:
+      custom_events: List[CustomEvent], the events to match.
+      now: datetime, the time timedelta values are relative to, or None for
+          the current time.
+
+    Returns:
+      A list of (ndb.Query, matchers) tuples, where matchers is a list of
+      (CustomEvent, function) tuples and each function takes an entity from
+      the query and returns True if it matches the event.
+    """
+    groups = []
+    events_by_model = collections.OrderedDict()
+    for custom_event in custom_events:
+      if custom_event._compile().in_memory:
+        events_by_model.setdefault(custom_event.model, []).append(
+            custom_event)
+      else:
+        groups.append(custom_event.build_matcher(now))
+
+    for model, model_events in events_by_model.items():
+      rules = [custom_event._compile() for custom_event in model_events]
+      groups.append((
+          _CompiledRule.merge_queries(model, rules, now=now),
+          [(custom_event, rule.predicate(include_query_filters=True, now=now))
+           for custom_event, rule in zip(model_events, rules)]))
+    return groups
+
+  def build_matcher(self, now=None):
+    """Builds the query and check for the entities matching the event.
 
-      query_filters.append(condition.get_filter())
+    Args:
+      now: datetime, the time timedelta values are relative to, or None for
+          the current time.
 
-    return {
-        'query': ndb.Query(
-            kind=self.model, filters=ndb.query.ConjunctionNode(*query_filters)),
-        'less_than_properties': less_than_properties,
-        'extra_inequality_conditions': extra_inequality_conditions}
+    Returns:
+      A (query, matchers) tuple as from build_matchers, with the event as the
+      only matcher.
+    """
+    rule = self._compile()
+    return rule.query(now=now), [(self, rule.predicate(now=now))]
 
   def get_matching_entities(self):
     """Yields entities that match the event's conditions.
 
+    Entities are streamed from the query in batches, so memory use does not
+    grow with the number of matching entities.
+
     Yields:
       Entities from a datastore query based on the custom event's conditions
       (some filtered post-query in cases where a query would otherwise have of
       multiple inequality filters).
     """
-    query_components = self._build_query_components()
+    query, [(_, match)] = self.build_matcher()
     try:
-      for entity in query_components['query'].fetch():
-
-        # Drop entities the query fetched because None is less than the value.
-        has_null_less = False
-        for less_than_condition in query_components['less_than_properties']:
-          if getattr(entity, less_than_condition) is None:
-            has_null_less = True
-        if has_null_less:
-          continue
-
-        # Drop entities that don't match an extra inequality filter (i.e., a
-        # condition discarded for the query due to a Datastore limitation).
-        has_unmatched_condition = False
-        for condition in query_components['extra_inequality_conditions']:
-          if not condition.match(entity):
-            has_unmatched_condition = True
-        if has_unmatched_condition:
-          continue
-
-        yield entity
+      for entity in query.iter(batch_size=_MATCH_BATCH_SIZE):
+        if match(entity):
+          yield entity
 
     except datastore_errors.BadArgumentError as e:
       logging.error(
@@ -341,18 +488,64 @@ class ReminderEvent(CustomEvent):
     return 'reminder_level_%s' % str(level)
 
 
-def _apply_timedelta(value):
+def _build_query(kind, query_filters, now=None):
+  """Builds a query from (name, opsymbol, value) filters.
+
+  Args:
+    kind: str, the kind of entity to query.
+    query_filters: List[tuple], the (name, opsymbol, value) of each filter.
+    now: datetime, the time timedelta values are relative to, or None for the
+        current time.
+
+  Returns:
+    An ndb.Query for the kind, with any timedelta values applied.
+  """
+  filters = [
+      ndb.query.FilterNode(name, opsymbol, _apply_timedelta(value, now))
+      for name, opsymbol, value in query_filters]
+  if not filters:
+    return ndb.Query(kind=kind)
+  return ndb.Query(kind=kind, filters=ndb.query.ConjunctionNode(*filters))
+
+
+def _match_value(entity_value, opsymbol, condition_value):
+  """Compares an entity's property value with a condition's value.
+
+  Args:
+    entity_value: any type, the value of the entity's property.
+    opsymbol: str, the comparison operator of the condition.
+    condition_value: any type, the condition's value, with any timedelta
+        already applied.
+
+  Returns:
+    True if the value matches the condition, else False.
+  """
+  if isinstance(entity_value, list):
+    # A repeated property matches if any of its values does, as in a query.
+    return any(_match_value(value, opsymbol, condition_value)
+               for value in entity_value)
+  if opsymbol in _ORDERING_OPSYMBOLS and entity_value is None:
+    # Unset properties are set to None, and so are treated as 0 in
+    # comparisons; we prefer to filter.
+    return False
+  compare = _OPERATORS.get(opsymbol)
+  return bool(compare and compare(entity_value, condition_value))
+
+
+def _apply_timedelta(value, now=None):
   """Applies timedelta value to the current UTC time.
 
   Args:
     value: any type, taken from pickled CustomEventCondition value.
+    now: datetime, the time to apply the timedelta to, or None for the
+        current UTC time.
 
   Returns:
     The original value, or in the case of a timedelta, a datetime based on now
     with the timedelta applied.
   """
   if isinstance(value, datetime.timedelta):
-    return datetime.datetime.utcnow() + value
+    return (now or datetime.datetime.utcnow()) + value
   return value
 
 
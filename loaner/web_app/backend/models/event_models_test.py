@@ -155,15 +155,16 @@ class CustomEventTest(loanertest.TestCase):
         event_models.create_timedelta(4, 'w'),
         datetime.timedelta(seconds=4*604800))
 
-  def test_build_query_components(self):
-    """Tests building a simple query and one with two inequality filters."""
+  def test_compile(self):
+    """Tests compiling a simple query and one with two inequality filters."""
     self.setup_events()
 
-    query_components1 = self.device_event._build_query_components()
-    self.assertEqual(query_components1['less_than_properties'], ['due_date'])
-    self.assertEqual(query_components1['extra_inequality_conditions'], [])
-    self.assertLen(
-        query_components1['query'].filters._ConjunctionNode__nodes, 3)
+    rule1 = self.device_event._compile()
+    self.assertEqual(rule1.less_than_properties, ['due_date'])
+    self.assertEqual(rule1.extra_inequality_conditions, [])
+    self.assertLen(rule1.query().filters._ConjunctionNode__nodes, 3)
+    # The rule is reused until the event's conditions change.
+    self.assertIs(self.device_event._compile(), rule1)
 
     # Add another inequality filter that uses <. Propery name hould be added to
     # less_than_properties, condition should be added to
@@ -172,15 +173,13 @@ class CustomEventTest(loanertest.TestCase):
         event_models.CustomEventCondition(
             name='last_heartbeat', opsymbol='<',
             value=event_models.create_timedelta(-5, 'd')))
-    query_components2 = self.device_event._build_query_components()
+    rule2 = self.device_event._compile()
+    self.assertIsNot(rule2, rule1)
     self.assertListEqual(
-        query_components2['less_than_properties'],
-        ['due_date', 'last_heartbeat'])
+        rule2.less_than_properties, ['due_date', 'last_heartbeat'])
     self.assertEqual(
-        query_components2['extra_inequality_conditions'],
-        [self.device_event.conditions[3]])
-    self.assertLen(
-        query_components2['query'].filters._ConjunctionNode__nodes, 3)
+        rule2.extra_inequality_conditions, [self.device_event.conditions[3]])
+    self.assertLen(rule2.query().filters._ConjunctionNode__nodes, 3)
 
   @mock.patch.object(ndb, 'Query', autospec=True)
   @mock.patch.object(logging, 'error', autospec=True)
@@ -188,7 +187,7 @@ class CustomEventTest(loanertest.TestCase):
       self, mock_logerror, mock_queryclass):
     """Tests with a bad query."""
     mock_query = mock_queryclass.return_value
-    mock_query.fetch.side_effect = datastore_errors.BadArgumentError
+    mock_query.iter.side_effect = datastore_errors.BadArgumentError
     self.setup_events()
 
     self.assertListEqual(list(self.device_event.get_matching_entities()), [])
@@ -225,6 +224,46 @@ class CustomEventTest(loanertest.TestCase):
     self.assertListEqual(
         list(self.shelf_event1.get_matching_entities()), [self.shelf1])
 
+  def test_build_matchers_now(self):
+    """Tests that timedelta values are relative to the time given."""
+    self.setup_events()
+    now = _NOW - datetime.timedelta(days=30)
+
+    groups = event_models.CustomEvent.build_matchers(
+        [self.shelf_event1, self.shelf_event2], now)
+    self.assertLen(groups, 1)
+    query, matchers = groups[0]
+    self.assertEqual(
+        query.filters,
+        ndb.query.ConjunctionNode(
+            ndb.query.FilterNode(
+                'last_audit_time', '<', now + _THREE_DAYS_AGO_DELTA),
+            ndb.query.FilterNode('enabled', '=', True)))
+    self.assertEqual(
+        [custom_event for custom_event, _ in matchers],
+        [self.shelf_event1, self.shelf_event2])
+
+  def test_build_matchers_not_equal(self):
+    """Tests that != conditions are checked in memory, not queried."""
+    self.setup_events()
+    self.shelf_event1.conditions = [
+        event_models.CustomEventCondition(
+            name='enabled', opsymbol='=', value=True),
+        event_models.CustomEventCondition(
+            name='location', opsymbol='!=', value='Lobby')]
+
+    [(query, [(_, match)])] = event_models.CustomEvent.build_matchers(
+        [self.shelf_event1])
+    self.assertFalse(query._needs_multi_query())
+    self.assertEqual(query.filters, ndb.query.FilterNode('enabled', '=', True))
+    self.assertFalse(match(shelf_model.Shelf(enabled=True, location='Lobby')))
+    self.assertTrue(match(shelf_model.Shelf(enabled=True, location='Kitchen')))
+
+  def test_match_value_repeated(self):
+    """Tests that a repeated property matches if any of its values do."""
+    self.assertTrue(event_models._match_value(['a', 'b'], '=', 'b'))
+    self.assertFalse(event_models._match_value(['a', 'b'], '=', 'c'))
+
 
 class ShelfAuditEventTest(loanertest.TestCase):
   """Tests for ShelfAuditEvent class."""
@@ -141,8 +141,7 @@ class Shelf(base_model.BaseModel):
   def _post_put_hook(self, future):
     """Overrides the _post_put_hook method."""
     del future  # Unused.
-    index = Shelf.get_index()
-    index.put(self.to_document())
+    self.update_search_index()
 
   @classmethod
   def enroll(
@@ -18,9 +18,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import uuid
+
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from loaner.web_app.backend.api import permissions
+from loaner.web_app.backend.lib import utils
 
 _SUPERADMIN_RESERVED_ERROR = (
     'Cannot create a role named "superadmin", that name is reserved.')
@@ -28,6 +32,13 @@ _UPDATE_ROLE_NAME_ERROR = "Cannot update a role's name, generate a new role."
 _ROLE_NOT_FOUND = 'Role with name %s was not found.'
 _ROLE_ALREADY_EXISTS = 'Role with name %s already exists'
 
+_PERMISSIONS_NAMESPACE = 'user_permissions'
+# Changed whenever any role changes, retiring every cached permission set.
+_ROLES_VERSION_KEY = 'roles_version'
+_PERMISSIONS_TTL = 60 * 60
+
+_local_permissions = utils.LRUCache(1000)
+
 
 class Error(Exception):
   """Base error class for the module."""
@@ -86,6 +97,7 @@ class Role(ndb.Model):
         permissions=role_permissions or [],
         associated_group=associated_group)
     new_role.put()
+    _invalidate_all_permissions()
     return new_role
 
   @classmethod
@@ -115,10 +127,12 @@ class Role(ndb.Model):
       raise UpdateRoleError(_UPDATE_ROLE_NAME_ERROR)
     self.populate(**kwargs)
     self.put()
+    _invalidate_all_permissions()
 
   def destroy(self):
     """Destroys a role."""
     self.key.delete()
+    _invalidate_all_permissions()
 
 
 class User(ndb.Model):
@@ -141,13 +155,24 @@ class User(ndb.Model):
   def get_user(cls, email):
     """Retrieves the user model, creating a new entity if necessary.
 
+    Existing users are read with a plain get, so only a user's first request
+    runs the get_or_insert transaction.
+
     Args:
       email: str, the user's email.
 
     Returns:
       The user model for the current user.
     """
-    return cls.get_or_insert(email)
+    return cls.get_by_id(email) or cls.get_or_insert(email)
+
+  def _post_put_hook(self, future):
+    """Drops the cached permissions of a user whose roles may have changed."""
+    del future  # Unused.
+    email = self.key.id()
+    cache_key = _permissions_cache_key(_get_roles_version(), email)
+    _local_permissions.delete(cache_key)
+    memcache.delete(cache_key, namespace=_PERMISSIONS_NAMESPACE)
 
   def update(self, roles=None, superadmin=None):
     """Updates a user's attributes.
@@ -160,12 +185,11 @@ class User(ndb.Model):
       RoleNotFoundError: If a non-existent role is added.
     """
     if roles:
-      self.roles = []
-      for role_name in roles:
-        role = Role.get_by_name(role_name)
+      role_keys = [ndb.Key(Role, role_name) for role_name in roles]
+      for role_name, role in zip(roles, ndb.get_multi(role_keys)):
         if not role:
           raise RoleNotFoundError(_ROLE_NOT_FOUND, role_name)
-        self.roles.append(role.key)
+      self.roles = role_keys
     elif roles == []:  # pylint: disable=g-explicit-bool-comparison
       self.roles = []
     if superadmin is not None:
@@ -175,13 +199,58 @@ class User(ndb.Model):
   def get_permissions(self):
     """Get permisisons for user.
 
+    The resolved permissions are cached in memcache and in this instance, keyed
+    by the user's email and the current roles version. A cached set is only
+    used if it was resolved from the roles the user holds now.
+
     Returns:
       Iterable of string Permissions.
     """
     if self.superadmin:
       return permissions.Permissions.ALL
-    user_permissions = []
-    for role in self.roles:
-      for permission in role.get().permissions:
-        user_permissions.append(permission)
-    return list(set(user_permissions))
+    role_names = tuple(sorted(self.role_names))
+    version = _get_roles_version()
+    cache_key = _permissions_cache_key(version, self.key.id())
+    if version is not None:
+      cached = _local_permissions.get(cache_key)
+      if cached is None:
+        cached = memcache.get(cache_key, namespace=_PERMISSIONS_NAMESPACE)
+      if cached is not None and cached[0] == role_names:
+        _local_permissions.set(cache_key, cached)
+        return list(cached[1])
+
+    user_permissions = set()
+    for role in ndb.get_multi(self.roles):
+      if role:
+        user_permissions.update(role.permissions)
+    if version is not None:
+      cached = (role_names, tuple(user_permissions))
+      _local_permissions.set(cache_key, cached)
+      memcache.set(
+          cache_key, cached, time=_PERMISSIONS_TTL,
+          namespace=_PERMISSIONS_NAMESPACE)
+    return list(user_permissions)
+
+
+def _get_roles_version():
+  """Returns the current roles version, or None if memcache is unavailable."""
+  version = memcache.get(_ROLES_VERSION_KEY, namespace=_PERMISSIONS_NAMESPACE)
+  if version is None:
+    # A fresh random version, rather than a counter, so a version evicted from
+    # memcache is never reused for permission sets cached before the eviction.
+    memcache.add(
+        _ROLES_VERSION_KEY, uuid.uuid4().hex, namespace=_PERMISSIONS_NAMESPACE)
+    version = memcache.get(
+        _ROLES_VERSION_KEY, namespace=_PERMISSIONS_NAMESPACE)
+  return version
+
+
+def _permissions_cache_key(version, email):
+  """Returns the cache key of a user's permissions under a roles version."""
+  return '%s:%s' % (version, email)
+
+
+def _invalidate_all_permissions():
+  """Retires every cached permission set after a role changes."""
+  memcache.set(
+      _ROLES_VERSION_KEY, uuid.uuid4().hex, namespace=_PERMISSIONS_NAMESPACE)
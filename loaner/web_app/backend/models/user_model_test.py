@@ -18,6 +18,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import mock
+
+from google.appengine.ext import ndb
+
 from loaner.web_app.backend.api import permissions
 from loaner.web_app.backend.models import user_model
 from loaner.web_app.backend.testing import loanertest
@@ -206,6 +210,58 @@ class UserModelTest(loanertest.TestCase):
 
     self.assertCountEqual(user.get_permissions(), permissions.Permissions.ALL)
 
+  def test_get_user__existing_user_not_transactional(self):
+    user_model.User(id=loanertest.USER_EMAIL).put()
+    with mock.patch.object(
+        user_model.User, 'get_or_insert') as mock_get_or_insert:
+      user = user_model.User.get_user(loanertest.USER_EMAIL)
+    self.assertEqual(user.key.id(), loanertest.USER_EMAIL)
+    self.assertFalse(mock_get_or_insert.called)
+
+  def test_get_permissions__cached(self):
+    user = user_model.User(id=loanertest.USER_EMAIL)
+    user.update(roles=['technician', 'operations'])
+    expected_permissions = user.get_permissions()
+
+    with mock.patch.object(
+        user_model.ndb, 'get_multi', wraps=ndb.get_multi) as mock_get_multi:
+      self.assertCountEqual(user.get_permissions(), expected_permissions)
+      # The memcache copy is used once this instance's cache is gone.
+      user_model._local_permissions.clear()
+      self.assertCountEqual(user.get_permissions(), expected_permissions)
+    self.assertFalse(mock_get_multi.called)
+
+  def test_get_permissions__role_update_invalidates(self):
+    user = user_model.User(id=loanertest.USER_EMAIL)
+    user.update(roles=['technician'])
+    user.get_permissions()
+
+    self.technician_role.update(
+        permissions=[permissions.Permissions.READ_DEVICES])
+
+    self.assertCountEqual(
+        user.get_permissions(), [permissions.Permissions.READ_DEVICES])
+
+  def test_get_permissions__role_destroy_invalidates(self):
+    user = user_model.User(id=loanertest.USER_EMAIL)
+    user.update(roles=['technician'])
+    user.get_permissions()
+
+    self.technician_role.destroy()
+
+    self.assertEqual(user.get_permissions(), [])
+
+  def test_get_permissions__user_update_invalidates(self):
+    user = user_model.User(id=loanertest.USER_EMAIL)
+    user.update(roles=['technician'])
+    user.get_permissions()
+
+    user.update(roles=['operations'])
+
+    self.assertCountEqual(
+        user_model.User.get_user(loanertest.USER_EMAIL).get_permissions(),
+        self.operations_role.permissions)
+
 
 if __name__ == '__main__':
   loanertest.main()
@@ -18,12 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import datetime
 
 import mock
 
 from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.ext import deferred
 from google.appengine.ext import testbed
 
 from absl.testing import absltest
@@ -32,6 +34,10 @@ import endpoints
 from loaner.web_app import constants
 from loaner.web_app.backend.lib import action_loader
 from loaner.web_app.backend.lib import events
+from loaner.web_app.backend.lib import given_names
+from loaner.web_app.backend.lib import task_collector
+from loaner.web_app.backend.models import config_model
+from loaner.web_app.backend.models import device_model
 from loaner.web_app.backend.models import user_model
 
 USER_DOMAIN = constants.APP_DOMAINS[0]
@@ -81,6 +87,33 @@ TEST_DIR_DEVICE2 = {
 }
 
 
+@contextlib.contextmanager
+def _add_tasks_immediately():
+  """Stands in for task_collector.collect, leaving tasks to taskqueue.add."""
+  yield task_collector.RequestStats()
+
+
+def _run_deferred(func, *args, **kwargs):
+  """Stands in for deferred.defer, running the function and dropping options."""
+  func(*args, **{
+      name: value for name, value in kwargs.items()
+      if not name.startswith('_')})
+
+
+def run_deferred_immediately():
+  """Returns a patcher running deferred functions as soon as they are deferred.
+
+  The task options, such as _target and _name, are dropped. The started mock
+  records the deferred calls, and setting its side_effect to None stops it
+  running them.
+
+  Returns:
+    A mock patcher for deferred.defer.
+  """
+  return mock.patch.object(
+      deferred, 'defer', autospec=True, side_effect=_run_deferred)
+
+
 class TestCase(absltest.TestCase):
   """Base test case."""
 
@@ -95,10 +128,23 @@ class TestCase(absltest.TestCase):
     self.testbed.init_search_stub()
     self.testbed.init_taskqueue_stub()
     self.login_user()
+    # The config snapshot, given names and device identifiers are cached per
+    # instance, so they outlive the testbed.
+    config_model.Config.invalidate_cache()
+    given_names.clear_local_cache()
+    device_model._identifier_cache.clear()  # pylint: disable=protected-access
 
     taskqueue_patcher = mock.patch.object(taskqueue, 'add')
     self.addCleanup(taskqueue_patcher.stop)
     self.taskqueue_add = taskqueue_patcher.start()
+    # Requests collect their tasks and add them in batches when they end. In
+    # tests, tasks are added one at a time so they reach the mock above. When
+    # you want to test task_collector.collect specifically, first run stop() on
+    # this patcher; be sure to run start() again before end of test.
+    self.testbed.collect_patcher = mock.patch.object(
+        task_collector, 'collect', _add_tasks_immediately)
+    self.addCleanup(self.testbed.collect_patcher.stop)
+    self.testbed.collect_patcher.start()
     self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
 
     # The events.raise_event method raises an exception if there are no events
@@ -22,5 +22,7 @@ import endpoints
 
 from loaner.web_app.backend.api import chrome_api  # pylint: disable=unused-import
 from loaner.web_app.backend.api import root_api
+from loaner.web_app.backend.lib import task_collector
 
-CHROME_API = endpoints.api_server([root_api.ROOT_API])
+CHROME_API = task_collector.Middleware(
+    endpoints.api_server([root_api.ROOT_API]))
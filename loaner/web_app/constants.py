@@ -170,6 +170,12 @@ DIRECTORY_SCOPES = (
     'https://www.googleapis.com/auth/admin.directory.user.readonly',
 )
 
+# The absolute path to a saved copy of the Directory API (admin directory_v1)
+# discovery document. When set, Directory API clients are built from it rather
+# than fetching and parsing the document over the network.
+DIRECTORY_DISCOVERY_DOCUMENT = os.path.join(
+    os.path.dirname(__file__), 'backend', 'clients', 'admin_directory_v1.json')
+
 # Dictionary defining where Grab n Go Loaner devices will be moved to enable and
 # disable guest mode if guest mode is permitted for this version.
 # NOTE: whether Guest Mode is allowed is configured in config_defaults.yaml.
@@ -181,6 +187,9 @@ ORG_UNIT_DICT = {
 CHROME_FIELDS_MASK = 'deviceId,serialNumber,model,orgUnitPath'
 CHROME_LIST_FIELDS_MASK = (
     'chromeosdevices(deviceId,serialNumber,model,orgUnitPath)')
+CHROME_SYNC_FIELDS_MASK = (
+    'chromeosdevices(deviceId,serialNumber,model,orgUnitPath,lastSync),'
+    'nextPageToken')
 GROUP_MEMBER_FIELDS_MASK = 'members/email,nextPageToken'
 USER_NAME_FIELDS_MASK = 'name/givenName'
 ORG_UNIT_FIELDS_MASK = 'name'
@@ -196,9 +205,8 @@ BIGQUERY_DATASET_NAME = 'loaner'
 BIGQUERY_DEVICE_TABLE = 'Device'
 BIGQUERY_SHELF_TABLE = 'Shelf'
 BIGQUERY_SURVEY_TABLE = 'Question'
-BIGQUERY_ROW_TIME_THRESHOLD = 15  # Minutes.
-BIGQUERY_ROW_SIZE_THRESHOLD = 50  # Rows.
 BIGQUERY_ROW_MAX_BATCH_SIZE = 500  # Rows.
+BIGQUERY_ROW_QUEUE = 'bigquery-rows'
 
 DEFAULT_ACTING_USER = 'Loaner Role'
 
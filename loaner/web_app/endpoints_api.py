@@ -31,5 +31,7 @@ from loaner.web_app.backend.api import survey_api  # pylint: disable=unused-impo
 from loaner.web_app.backend.api import tag_api  # pylint: disable=unused-import
 from loaner.web_app.backend.api import template_api  # pylint: disable=unused-import
 from loaner.web_app.backend.api import user_api  # pylint: disable=unused-import
+from loaner.web_app.backend.lib import task_collector
 
-ENDPOINTS_API = endpoints.api_server([root_api.ROOT_API])
+ENDPOINTS_API = task_collector.Middleware(
+    endpoints.api_server([root_api.ROOT_API]))
@@ -24,24 +24,33 @@ from loaner.web_app import constants
 from loaner.web_app.backend.handlers import frontend
 from loaner.web_app.backend.handlers import maintenance
 from loaner.web_app.backend.handlers.cron import cloud_datastore_export
+from loaner.web_app.backend.handlers.cron import flush_heartbeats
 from loaner.web_app.backend.handlers.cron import run_custom_events
 from loaner.web_app.backend.handlers.cron import run_reminder_events
 from loaner.web_app.backend.handlers.cron import run_shelf_audit_events
+from loaner.web_app.backend.handlers.cron import stream_bigquery_rows
+from loaner.web_app.backend.handlers.cron import sync_directory_devices
 from loaner.web_app.backend.handlers.cron import sync_user_roles
 from loaner.web_app.backend.handlers.task import process_action
 from loaner.web_app.backend.handlers.task import process_emails
 from loaner.web_app.backend.handlers.task import stream_to_bigquery
+from loaner.web_app.backend.lib import task_collector
 
 web_app_routes = [
     (r'/_ah/queue/process-action', process_action.ProcessActionHandler),
     (r'/_ah/queue/send-email', process_emails.EmailTaskHandler),
     (r'/_ah/queue/stream-bq', stream_to_bigquery.StreamToBigQueryHandler),
     (r'/_cron/cloud_datastore_export', cloud_datastore_export.DatastoreExport),
+    (r'/_cron/flush_heartbeats', flush_heartbeats.FlushHeartbeatsHandler),
     (r'/_cron/run_custom_events', run_custom_events.RunCustomEventsHandler),
     (r'/_cron/run_reminder_events',
      run_reminder_events.RunReminderEventsHandler),
     (r'/_cron/run_shelf_audit_events',
      run_shelf_audit_events.RunShelfAuditEventsHandler),
+    (r'/_cron/stream_bigquery_rows',
+     stream_bigquery_rows.StreamBigQueryRowsHandler),
+    (r'/_cron/sync_directory_devices',
+     sync_directory_devices.SyncDirectoryDevicesHandler),
     (r'/_cron/sync_user_roles', sync_user_roles.SyncUserRolesHandler),
     (r'/maintenance', maintenance.MaintenanceHandler),
     (r'(/.*)', frontend.FrontendHandler),
@@ -51,4 +60,5 @@ if constants.MAINTENANCE:
   web_app_routes = [(r'/.*', maintenance.MaintenanceHandler)]
 
 
-web_app = webapp2.WSGIApplication(web_app_routes, debug=True)
+web_app = task_collector.Middleware(
+    webapp2.WSGIApplication(web_app_routes, debug=True))